@@ -19,13 +19,47 @@ import urlparse
 import time
 import pycurl
 import logging
+import threading
 import traceback
 import hashlib
 import types
 import unicodedata
 
+from SegmentedFetch import SegmentedDownload
+from FileUtils import WRITE_BUFFER_SIZE, preallocate
+
 LOG = logging.getLogger("grinder.BaseFetch")
 
+# Most data curl hands to a write callback at once
+CURL_BUFFER_SIZE = 256 * 1024
+
+# HTTP/2 is negotiated when pycurl and the libcurl it runs on support it
+HTTP2_AVAILABLE = hasattr(pycurl, "CURL_HTTP_VERSION_2TLS") and \
+    hasattr(pycurl, "INFO_HTTP_VERSION") and \
+    bool(pycurl.version_info()[4] & getattr(pycurl, "VERSION_HTTP2", 0))
+
+# Names of the values curl reports for INFO_HTTP_VERSION
+HTTP_VERSION_NAMES = {}
+for _name, _label in [("CURL_HTTP_VERSION_1_0", "HTTP/1.0"), ("CURL_HTTP_VERSION_1_1", "HTTP/1.1"),
+        ("CURL_HTTP_VERSION_2_0", "HTTP/2"), ("CURL_HTTP_VERSION_3", "HTTP/3")]:
+    if hasattr(pycurl, _name):
+        HTTP_VERSION_NAMES[getattr(pycurl, _name)] = _label
+
+def createCurlShare():
+    """
+    Returns a pycurl.CurlShare for curl handles to share DNS results and TLS
+    sessions through, and open connections where pycurl supports sharing them,
+    or None if pycurl can't share anything
+    """
+    if not hasattr(pycurl, "CurlShare"):
+        return None
+    share = pycurl.CurlShare()
+    share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+    share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+    if hasattr(pycurl, "LOCK_DATA_CONNECT"):
+        share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+    return share
+
 class BaseFetch(object):
     STATUS_NOOP = 'noop'
     STATUS_DOWNLOADED = 'downloaded'
@@ -33,21 +67,251 @@ class BaseFetch(object):
     STATUS_MD5_MISSMATCH = 'md5_missmatch'
     STATUS_ERROR = 'error'
     STATUS_UNAUTHORIZED = "unauthorized"
+    # Fetch was abandoned, e.g. a hedged request for the same item won
+    STATUS_CANCELLED = "cancelled"
+    # Statuses worth another attempt, a network glitch or issue with RHN may clear up
+    RETRY_STATUSES = [STATUS_ERROR, STATUS_SIZE_MISSMATCH, STATUS_MD5_MISSMATCH]
+    # Classes of errors behind a failed fetch, each has its own retry policy
+    ERROR_SERVER = 'server'
+    ERROR_TIMEOUT = 'timeout'
+    ERROR_CHECKSUM = 'checksum'
+    ERROR_OTHER = 'other'
+    # Seconds to wait for a connection
+    DEFAULT_CONNECT_TIMEOUT = 30
+    # A transfer slower than stallSpeed bytes/sec for stallTimeout seconds is aborted
+    DEFAULT_STALL_TIMEOUT = 60
+    DEFAULT_STALL_SPEED = 1000
 
     def __init__(self, cacert=None, clicert=None, clikey=None):
         self.sslcacert = cacert
         self.sslclientcert = clicert
         self.sslclientkey = clikey
+        # Each thread calling fetch() keeps its own curl handle and error state
+        self._local = threading.local()
+        self.checksumCache = None
+        self.deepVerify = False
+        self.rateLimiter = None
+        self.progress = None
+        self.packageStore = None
+        self.segmentThreshold = 0
+        self.numSegments = 4
+        self.connectTimeout = BaseFetch.DEFAULT_CONNECT_TIMEOUT
+        self.stallTimeout = BaseFetch.DEFAULT_STALL_TIMEOUT
+        self.stallSpeed = BaseFetch.DEFAULT_STALL_SPEED
+        # Stall speed last warned about as lowered for the rate limiter
+        self.stallSpeedWarned = None
+        self.useHttp2 = HTTP2_AVAILABLE
+        # Shared by the handles of all threads fetching with this instance, so
+        # a host is resolved and a full TLS handshake done with it only once
+        self.curlShare = createCurlShare()
+        # host -> {protocol: number of transfers}
+        self.protocols = {}
+        self.protocolsLock = threading.Lock()
 
-    def validateDownload(self, filePath, size, hashtype, checksum, verbose=False):
-        statinfo = os.stat(filePath)
-        fileName = os.path.basename(filePath)
+    def resetAfterFork(self):
+        """
+        Called in a process forked with this instance, e.g. by ProcessFetch,
+        so the curl handles and connections of the parent aren't used
+        """
+        self._local = threading.local()
+        self.curlShare = createCurlShare()
+        self.protocols = {}
+        self.protocolsLock = threading.Lock()
+
+    def getErrorClass(self):
+        """
+        Returns the class of error behind the calling thread's last failed fetch
+        """
+        return getattr(self._local, "errorClass", BaseFetch.ERROR_OTHER)
+
+    def setErrorClass(self, errorClass):
+        self._local.errorClass = errorClass
+
+    def getFetchControl(self):
+        """
+        Returns the FetchControl for the calling thread's fetches, or None
+        """
+        return getattr(self._local, "control", None)
+
+    def setFetchControl(self, control):
+        """
+        control = FetchControl the calling thread's next fetch runs under,
+            a download engine sets this to be able to cancel the fetch
+        """
+        self._local.control = control
+
+    def setTimeouts(self, connectTimeout, stallTimeout, stallSpeed=DEFAULT_STALL_SPEED):
+        """
+        connectTimeout = seconds to wait for a connection
+        stallTimeout = seconds a transfer may stay below stallSpeed bytes/sec
+            before it is aborted, 0 disables this
+        """
+        self.connectTimeout = connectTimeout
+        self.stallTimeout = stallTimeout
+        self.stallSpeed = stallSpeed
+
+    def setHttp2(self, useHttp2):
+        """
+        useHttp2 = if True HTTP/2 is offered to https servers, servers not
+            supporting it are talked to with HTTP/1.1.  Ignored when pycurl
+            has no HTTP/2 support.
+        """
+        self.useHttp2 = useHttp2 and HTTP2_AVAILABLE
+
+    def recordProtocol(self, fetchURL, curl):
+        """
+        Records the HTTP version the transfer of fetchURL on curl used
+        """
+        try:
+            protocol = HTTP_VERSION_NAMES.get(curl.getinfo(pycurl.INFO_HTTP_VERSION))
+        except (AttributeError, pycurl.error):
+            return
+        if protocol is None:
+            # No response was received
+            return
+        host = urlparse.urlparse(fetchURL)[1]
+        self.protocolsLock.acquire()
+        try:
+            counts = self.protocols.setdefault(host, {})
+            counts[protocol] = counts.get(protocol, 0) + 1
+        finally:
+            self.protocolsLock.release()
+
+    def getProtocols(self):
+        """
+        Returns dict of host -> sorted list of the HTTP versions used with it
+        """
+        self.protocolsLock.acquire()
+        try:
+            protocols = {}
+            for host, counts in self.protocols.items():
+                names = counts.keys()
+                names.sort()
+                protocols[host] = names
+            return protocols
+        finally:
+            self.protocolsLock.release()
+
+    def setChecksumCache(self, checksumCache, deepVerify=False):
+        """
+        checksumCache = ChecksumCache used to confirm files already on disk are
+            unchanged without hashing them again
+        deepVerify = if True existing files are always hashed, refreshing the cache
+        """
+        self.checksumCache = checksumCache
+        self.deepVerify = deepVerify
+
+    def setRateLimiter(self, rateLimiter):
+        """
+        rateLimiter = RateLimiter capping bandwidth and request rate, share one
+            instance between fetchers to cap them all together
+        """
+        self.rateLimiter = rateLimiter
+
+    def setProgress(self, progress):
+        """
+        progress = FetchProgress the data received is counted on, a download
+            engine sets this to report its progress
+        """
+        self.progress = progress
+
+    def setPackageStore(self, packageStore):
+        """
+        packageStore = PackageStore downloads are added to, items it already
+            holds are linked into place instead of downloaded
+        """
+        self.packageStore = packageStore
+
+    def storeVerified(self, filePath, hashtype, checksum):
+        """
+        Records that filePath was verified to have checksum, unless the
+        package store and checksum cache hold it as it is already
+        """
+        if self.packageStore and not self.packageStore.isStored(filePath, hashtype, checksum):
+            # May replace filePath with a link to an existing copy
+            self.packageStore.add(filePath, hashtype, checksum)
+        if self.checksumCache and self.checksumCache.lookup(filePath, hashtype) != checksum:
+            self.checksumCache.store(filePath, hashtype, checksum)
+
+    def setSegmentation(self, threshold, numSegments=4):
+        """
+        threshold = items of at least this many bytes are fetched as numSegments
+            concurrent byte ranges, 0 disables segmented fetches
+        """
+        self.segmentThreshold = threshold
+        self.numSegments = numSegments
+
+    def shouldSegment(self, itemSize, filePath):
+        """
+        Returns True if the item should be fetched as a SegmentedDownload.
+        An existing partial file is resumed as a single stream instead.
+        """
+        return self.segmentThreshold and self.numSegments > 1 and \
+            int(itemSize) >= self.segmentThreshold and \
+            not os.path.exists(filePath + ".part")
+
+    def verifyExisting(self, filePath, hashtype, checksum):
+        """
+        Returns True if the file at filePath has the expected checksum.
+        A file that had to be hashed is recorded, see storeVerified(), one
+        the checksum cache vouches for already was.
+        """
+        if self.checksumCache and not self.deepVerify:
+            cached = self.checksumCache.lookup(filePath, hashtype)
+            if cached is not None:
+                return cached == checksum
         calchecksum = getFileChecksum(hashtype, filename=filePath)
+        if calchecksum == checksum:
+            self.storeVerified(filePath, hashtype, checksum)
+        elif self.checksumCache:
+            self.checksumCache.store(filePath, hashtype, calchecksum)
+        return calchecksum == checksum
+
+    def getCurl(self):
+        """
+        Returns the curl handle owned by the calling thread, creating it on first use.
+        The handle is reset between transfers but not closed, so libcurl can keep
+        the connection to the server alive across files.
+        """
+        curl = getattr(self._local, "curl", None)
+        if curl is None:
+            curl = pycurl.Curl()
+            self._local.curl = curl
+        else:
+            curl.reset()
+        return curl
+
+    def closeCurl(self):
+        """
+        Closes the curl handle owned by the calling thread, if any.
+        """
+        curl = getattr(self._local, "curl", None)
+        if curl is not None:
+            curl.close()
+            self._local.curl = None
+
+    def validateDownload(self, filePath, size, hashtype, checksum, verbose=False, downloadFile=None):
+        """
+        Checks the file at filePath against the expected size and checksum.
+        If the DownloadFile it was written through is passed in, the size and checksum
+        computed while the data arrived are used instead of re-reading the file.
+        """
+        fileName = os.path.basename(filePath)
+        if downloadFile:
+            calsize = downloadFile.size
+            calchecksum = downloadFile.hexdigest()
+        else:
+            calsize = os.stat(filePath).st_size
+            calchecksum = getFileChecksum(hashtype, filename=filePath)
         # validate fetched data
-        if statinfo.st_size != int(size):
+        if calsize != int(size):
             LOG.error("%s size mismatch, read: %s bytes, was expecting %s bytes" \
-                      % (fileName, statinfo.st_size, size))
-            os.remove(filePath)
+                      % (fileName, calsize, size))
+            if downloadFile and calsize < int(size):
+                # Transfer was cut short, keep what we have so the next attempt can resume
+                LOG.info("Keeping %s bytes of %s to resume from" % (calsize, fileName))
+            else:
+                os.remove(filePath)
             return BaseFetch.STATUS_SIZE_MISSMATCH
         elif calchecksum != checksum:
             LOG.error("%s md5sum mismatch, read md5sum of: %s expected md5sum of %s" \
@@ -56,15 +320,24 @@ class BaseFetch(object):
             return BaseFetch.STATUS_MD5_MISSMATCH
         LOG.debug("Package [%s] is valid with checksum [%s] and size [%s]" % (fileName, checksum, size))
         return BaseFetch.STATUS_DOWNLOADED
-    
-    def fetch(self, fileName, fetchURL, itemSize, hashtype, checksum, savePath, headers=None, retryTimes=2):
+
+    def getFetchRequest(self, itemInfo):
         """
         Input:
-            itemInfo = dict with keys: 'file_name', 'fetch_url', 'item_size', 'hashtype', 'checksum'
-            retryTimes = how many times to retry fetch if an error occurs
-        Will return a true/false if item was fetched successfully 
+            itemInfo = item description as queued on a ParallelFetch/MultiFetch
+        Output:
+            dict of keyword arguments for fetch(): 'fileName', 'fetchURL', 'itemSize',
+            'hashtype', 'checksum', 'savePath' and optionally 'headers', 'mirrorURLs'
+        Subclasses implement this so the download engines can drive them.
         """
+        raise NotImplementedError
 
+    def prepareFetch(self, fileName, hashtype, checksum, savePath):
+        """
+        Creates the directory fileName will be saved into.
+        Returns the path to download to, or None if a valid copy already exists
+        or could be linked from the package store.
+        """
         filePath = os.path.join(savePath, fileName)
         tempDirPath = os.path.dirname(filePath)
         if not os.path.isdir(tempDirPath):
@@ -81,70 +354,437 @@ class BaseFetch(object):
                     raise e
                 
         if os.path.exists(filePath) and \
-            verifyChecksum(filePath, hashtype, checksum):
+            self.verifyExisting(filePath, hashtype, checksum):
             LOG.info("%s exists with correct size and md5sum, no need to fetch." % (filePath))
+            if self.packageStore and not self.packageStore.isStored(filePath, hashtype, checksum):
+                # Synced before the package store was used
+                self.storeVerified(filePath, hashtype, checksum)
+            return None
+        if self.packageStore and self.packageStore.linkTo(filePath, hashtype, checksum):
+            if self.checksumCache:
+                self.checksumCache.store(filePath, hashtype, checksum)
+            return None
+        return filePath
+
+    def setupCurl(self, curl, fetchURL, headers, downloadFile):
+        """
+        Sets the options on a (reset) curl handle for a download of fetchURL into
+        downloadFile, asking for the remainder only if downloadFile is resuming.
+        """
+        curl.setopt(curl.VERBOSE,0)
+        if type(fetchURL) == types.UnicodeType:
+            #pycurl does not accept unicode strings for a URL, so we need to convert
+            fetchURL = unicodedata.normalize('NFKD', fetchURL).encode('ascii','ignore')
+        curl.setopt(curl.URL, fetchURL)
+        self.setupConnection(curl)
+        if headers:
+            curl.setopt(pycurl.HTTPHEADER, curlifyHeaders(headers))
+        write = downloadFile.write
+        if self.progress:
+            write = self.progress.countWrites(write)
+        if self.rateLimiter:
+            self.rateLimiter.acquireRequest()
+            write = self.rateLimiter.limitWrites(write)
+        curl.setopt(curl.WRITEFUNCTION, write)
+        curl.setopt(curl.HEADERFUNCTION, downloadFile.header)
+        curl.setopt(curl.PROGRESSFUNCTION, downloadFile.progress)
+        curl.setopt(curl.NOPROGRESS, 0)
+        curl.setopt(curl.FOLLOWLOCATION, 1)
+        # Signals can't be used for timeouts in a threaded program
+        curl.setopt(curl.NOSIGNAL, 1)
+        # Fewer, larger calls into python for the data, libcurl defaults to 16KB
+        try:
+            curl.setopt(curl.BUFFERSIZE, CURL_BUFFER_SIZE)
+        except pycurl.error, e:
+            # Refused while the handle is still tied to a connection another
+            # stream multiplexed over it is using, the default size then does.
+            # The option is cleared by reset(), so it is set for every transfer.
+            LOG.debug("Unable to set buffer size for %s: %s" % (fetchURL, e))
+        curl.setopt(curl.CONNECTTIMEOUT, self.connectTimeout)
+        if self.useHttp2:
+            # Offered through ALPN on https, plain http and servers without
+            # HTTP/2 get HTTP/1.1
+            curl.setopt(curl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+            if fetchURL.lower().startswith("https:"):
+                # Under a CurlMulti, wait to multiplex over a connection being
+                # set up to the same host instead of opening another one.  A
+                # plain http connection never multiplexes, waiting on it would
+                # hold the transfer back until the one before it is done.
+                curl.setopt(curl.PIPEWAIT, 1)
+        else:
+            # Newer libcurl offers HTTP/2 by default
+            curl.setopt(curl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_1_1)
+        stallSpeed = self.getStallSpeed()
+        if self.stallTimeout and stallSpeed:
+            curl.setopt(curl.LOW_SPEED_LIMIT, stallSpeed)
+            curl.setopt(curl.LOW_SPEED_TIME, self.stallTimeout)
+        if downloadFile.offset:
+            LOG.info("Resuming fetch of %s from byte %s" % (fetchURL, downloadFile.offset))
+            curl.setopt(curl.RESUME_FROM_LARGE, downloadFile.offset)
+
+    def getStallSpeed(self):
+        """
+        Returns the speed in bytes/sec below which a transfer counts as stalled.
+        A transfer held by the rate limiter to less than stallSpeed would be
+        aborted as stalled, the speed is then lowered to half of what each
+        transfer is allowed, or 0 when that is under 1 byte/sec.
+        """
+        if not self.rateLimiter:
+            return self.stallSpeed
+        rate = self.rateLimiter.getTransferRate()
+        if not rate or rate >= self.stallSpeed:
+            return self.stallSpeed
+        stallSpeed = int(rate / 2)
+        if self.stallSpeedWarned != stallSpeed:
+            self.stallSpeedWarned = stallSpeed
+            LOG.warn("Bandwidth limit leaves each transfer %s bytes/sec, below the stall speed " \
+                    "of %s bytes/sec; lowering the stall speed to %s bytes/sec (0 disables it)" % \
+                    (int(rate), self.stallSpeed, stallSpeed))
+        return stallSpeed
+
+    def getItemHost(self, itemInfo):
+        """
+        Returns the host itemInfo will be fetched from, used to cap the
+        fetches in flight to each host.  Subclasses must implement
+        getFetchRequest() for this.
+        """
+        return urlparse.urlparse(self.getFetchRequest(itemInfo)['fetchURL'])[1]
+
+    def setupConnection(self, curl):
+        """
+        Sets the options on a (reset) curl handle for connecting to the server:
+        TLS client certificate and the share handle
+        """
+        if self.sslcacert and self.sslclientcert and self.sslclientkey:
+            curl.setopt(curl.CAINFO, self.sslcacert)
+            curl.setopt(curl.SSLCERT, self.sslclientcert)
+            curl.setopt(curl.SSLKEY, self.sslclientkey)
+        # A handle stays attached to its share handle through reset(), and
+        # can't be attached again
+        if self.curlShare is not None and getattr(curl, "curlShare", None) is not self.curlShare:
+            curl.setopt(curl.SHARE, self.curlShare)
+            curl.curlShare = self.curlShare
+
+    def transferFinished(self, fetchURL, status, curl):
+        """
+        Called when a transfer of fetchURL has ended with fetch status 'status',
+        curl is the handle it ran on.  Subclasses may extend it to keep track
+        of how their sources perform.
+        """
+        if curl is not None:
+            self.recordProtocol(fetchURL, curl)
+
+    def checkFetchResult(self, status, downloadFile, fetchURL, itemSize, hashtype, checksum):
+        """
+        Input:
+            status = HTTP response code of the finished transfer
+            downloadFile = closed DownloadFile the transfer was written to
+        Output:
+            fetch status of the downloaded file, it is only moved into place
+            if it is valid
+        """
+        if status == 401:
+            LOG.warn("Unauthorized request from: %s" % (fetchURL))
+            return BaseFetch.STATUS_UNAUTHORIZED
+        if status not in [200, 206]:
+            LOG.critical("ERROR: Response = %s fetching %s." % (status, fetchURL))
+            if status == 416 or not downloadFile.size:
+                # Nothing worth resuming from
+                downloadFile.discard()
+            if status >= 500:
+                self.setErrorClass(BaseFetch.ERROR_SERVER)
+            else:
+                self.setErrorClass(BaseFetch.ERROR_OTHER)
+            return BaseFetch.STATUS_ERROR
+        # validate the fetched bits
+        vstatus = self.validateDownload(downloadFile.partPath, int(itemSize), hashtype, checksum,
+                downloadFile=downloadFile)
+        if vstatus in [BaseFetch.STATUS_SIZE_MISSMATCH, BaseFetch.STATUS_MD5_MISSMATCH]:
+            self.setErrorClass(BaseFetch.ERROR_CHECKSUM)
+        elif vstatus == BaseFetch.STATUS_DOWNLOADED:
+            downloadFile.commit()
+            self.storeVerified(downloadFile.filePath, hashtype, checksum)
+        return vstatus
+
+    def checkSegmentedResult(self, download, itemSize, hashtype, checksum):
+        """
+        Input:
+            download = finished SegmentedDownload
+        Output:
+            fetch status of the downloaded file, or None if the server doesn't
+            support range requests and the item needs fetching as a single stream
+        """
+        if download.rangeIgnored or download.failed:
+            if os.path.exists(download.partPath):
+                os.remove(download.partPath)
+            if download.rangeIgnored:
+                return None
+            self.setErrorClass(BaseFetch.ERROR_OTHER)
+            return BaseFetch.STATUS_ERROR
+        # Segments arrive out of order, so this is the one case the file is hashed again
+        vstatus = self.validateDownload(download.partPath, int(itemSize), hashtype, checksum)
+        if vstatus in [BaseFetch.STATUS_SIZE_MISSMATCH, BaseFetch.STATUS_MD5_MISSMATCH]:
+            self.setErrorClass(BaseFetch.ERROR_CHECKSUM)
+        elif vstatus == BaseFetch.STATUS_DOWNLOADED:
+            os.rename(download.partPath, download.filePath)
+            self.storeVerified(download.filePath, hashtype, checksum)
+        return vstatus
+
+    def fetch(self, fileName, fetchURL, itemSize, hashtype, checksum, savePath, headers=None, retryTimes=0,
+            mirrorURLs=None):
+        """
+        Input:
+            itemInfo = dict with keys: 'file_name', 'fetch_url', 'item_size', 'hashtype', 'checksum'
+            mirrorURLs = other urls the item can be fetched from, used to spread
+                the segments of a large item
+            retryTimes = how many times to immediately retry fetch if an error occurs,
+                ParallelFetch and MultiFetch leave this at 0 and schedule retries
+                with a backoff delay themselves
+        Will return a true/false if item was fetched successfully 
+        """
+        filePath = self.prepareFetch(fileName, hashtype, checksum, savePath)
+        if filePath is None:
             return BaseFetch.STATUS_NOOP
 
+        control = self.getFetchControl()
+        hedge = control is not None and control.hedge
+        if not hedge and self.shouldSegment(itemSize, filePath):
+            urls = [fetchURL]
+            if mirrorURLs:
+                urls.extend(mirrorURLs)
+            download = None
+            try:
+                download = SegmentedDownload(self, filePath, urls, itemSize, headers, self.numSegments,
+                        control)
+                download.perform()
+                vstatus = self.checkSegmentedResult(download, itemSize, hashtype, checksum)
+            except Exception, e:
+                tb_info = traceback.format_exc()
+                LOG.debug("%s" % (tb_info))
+                LOG.warn("Caught exception<%s> in segmented fetch(%s, %s)" % (e, fileName, fetchURL))
+                if download:
+                    download.failed = True
+                    download.close()
+                    self.checkSegmentedResult(download, itemSize, hashtype, checksum)
+                self.setErrorClass(BaseFetch.ERROR_OTHER)
+                vstatus = BaseFetch.STATUS_ERROR
+            if control is not None and control.cancelled:
+                return BaseFetch.STATUS_CANCELLED
+            if vstatus is not None:
+                return vstatus
+            # Fall through to fetching it as a single stream
+
+        f = None
+        curl = None
         try:
-            f = open(filePath, "wb")
-            curl = pycurl.Curl()
-            curl.setopt(curl.VERBOSE,0)
-            if type(fetchURL) == types.UnicodeType:
-                #pycurl does not accept unicode strings for a URL, so we need to convert
-                fetchURL = unicodedata.normalize('NFKD', fetchURL).encode('ascii','ignore')
-            curl.setopt(curl.URL, fetchURL)
-            if self.sslcacert and self.sslclientcert and self.sslclientkey:
-                curl.setopt(curl.CAINFO, self.sslcacert)
-                curl.setopt(curl.SSLCERT, self.sslclientcert)
-                curl.setopt(curl.SSLKEY, self.sslclientkey)
-            if headers:
-                curl.setopt(pycurl.HTTPHEADER, curlifyHeaders(headers))
-            curl.setopt(curl.WRITEFUNCTION, f.write)
-            curl.setopt(curl.FOLLOWLOCATION, 1)
+            f = DownloadFile(filePath, hashtype, itemSize, control)
+            curl = self.getCurl()
+            self.setupCurl(curl, fetchURL, headers, f)
             LOG.info("Fetching %s bytes: %s from %s" % (itemSize, fileName, fetchURL))
             curl.perform()
             status = curl.getinfo(curl.HTTP_CODE)
-            curl.close()
             f.close()
-            
-            if status == 401:
-                LOG.warn("Unauthorized request from: %s" % (fetchURL))
-                return BaseFetch.STATUS_UNAUTHORIZED
-            if status != 200:
-                LOG.critical("ERROR: Response = %s fetching %s." % (status, fetchURL))
-                if retryTimes > 0:
-                    retryTimes -= 1
-                    LOG.warn("Retrying fetch of: %s with %s retry attempts left." % (fileName, retryTimes))
-                    return self.fetch(fileName, fetchURL, itemSize, hashtype, checksum, savePath, headers, retryTimes)
-                return BaseFetch.STATUS_ERROR
-            # validate the fetched bits
-            vstatus = self.validateDownload(filePath, int(itemSize), hashtype, checksum)
-            if vstatus in [BaseFetch.STATUS_ERROR, BaseFetch.STATUS_SIZE_MISSMATCH, 
-                BaseFetch.STATUS_MD5_MISSMATCH] and retryTimes > 0:
+            vstatus = self.checkFetchResult(status, f, fetchURL, itemSize, hashtype, checksum)
+            f.finished(vstatus)
+            self.transferFinished(fetchURL, vstatus, curl)
+            if vstatus in BaseFetch.RETRY_STATUSES and retryTimes > 0:
                 #
                 # Incase of a network glitch or issue with RHN, retry the rpm fetch
                 #
                 retryTimes -= 1
                 LOG.warn("Retrying fetch of: %s with %s retry attempts left." % (fileName, retryTimes))
-                return self.fetch(fileName, fetchURL, itemSize, hashtype, checksum, savePath, headers, retryTimes)
+                return self.fetch(fileName, fetchURL, itemSize, hashtype, checksum, savePath, headers, retryTimes,
+                        mirrorURLs)
             LOG.debug("Successfully Fetched Package - [%s]" % filePath)
             return vstatus
         except Exception, e:
+            if control is not None and control.cancelled:
+                LOG.info("Fetch of %s from %s cancelled" % (fileName, fetchURL))
+                if f:
+                    f.close()
+                    if not control.keepsPartial():
+                        f.discard()
+                return BaseFetch.STATUS_CANCELLED
+            if isinstance(e, pycurl.error) and e.args[0] == pycurl.E_RANGE_ERROR and f and f.offset:
+                # The server answered our Range request with the whole file,
+                # curl won't take it.  Drop the part file and start over.
+                LOG.info("Unable to resume %s, fetching it from the start" % (filePath))
+                f.close()
+                f.discard()
+                return self.fetch(fileName, fetchURL, itemSize, hashtype, checksum, savePath, headers, retryTimes,
+                        mirrorURLs)
             tb_info = traceback.format_exc()
             LOG.debug("%s" % (tb_info))
             LOG.warn("Caught exception<%s> in fetch(%s, %s)" % (e, fileName, fetchURL))
+            if isinstance(e, pycurl.error):
+                self.setErrorClass(getCurlErrorClass(e.args[0]))
+                self.transferFinished(fetchURL, BaseFetch.STATUS_ERROR, curl)
+            else:
+                self.setErrorClass(BaseFetch.ERROR_OTHER)
+            if f:
+                # Partial data is kept, a retry resumes from it
+                f.close()
+                f.finished(BaseFetch.STATUS_ERROR)
             if retryTimes > 0:
                 retryTimes -= 1
                 LOG.warn("Retrying fetch of: %s with %s retry attempts left." % (fileName, retryTimes))
-                return self.fetch(fileName, fetchURL, itemSize, hashtype, checksum, savePath, headers, retryTimes)
+                return self.fetch(fileName, fetchURL, itemSize, hashtype, checksum, savePath, headers, retryTimes,
+                        mirrorURLs)
             return BaseFetch.STATUS_ERROR
 
-def getFileChecksum(hashtype, filename=None, fd=None, file=None, buffer_size=None):
-    """ Compute a file's checksum
+class FetchControl(object):
+    """
+    Lets a download engine cancel a fetch running in another thread, the
+    transfer is aborted from curl's progress callback.  A hedge is a second,
+    speculative request for an item, it downloads to its own part file.
+    """
+    def __init__(self, hedge=False):
+        self.hedge = hedge
+        self.cancelled = False
+        # Set if cancelled by stopping the engine, see stop()
+        self.stopped = False
+        self.started = time.time()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def stop(self):
+        """
+        Cancels the fetch as its engine is stopped, the data received so far
+        is kept in the part file for the next attempt to resume from
+        """
+        self.stopped = True
+        self.cancel()
+
+    def keepsPartial(self):
+        # A hedge's part file is never resumed from
+        return self.stopped and not self.hedge
+
+class DownloadFile(object):
+    """
+    File a download is written to.  The size and checksum of the data are
+    computed as it is written, so validating it doesn't read the file again.
+    Data goes to filePath + ".part", which is renamed to filePath by commit().
+    A partial file left by an earlier attempt is resumed from, offset is the
+    number of bytes already there.
+    When size is known the space for the rest of the file is reserved up
+    front, and writes are collected into WRITE_BUFFER_SIZE blocks.
+    """
+    def __init__(self, filePath, hashtype, size=None, control=None):
+        self.filePath = filePath
+        self.partPath = filePath + ".part"
+        if control is not None and control.hedge:
+            self.partPath = filePath + ".hedge.part"
+        self.control = control
+        self.hashtype = hashtype
+        self.size = 0
+        self.offset = 0
+        self.status = None
+        self.checksum = newChecksum(hashtype)
+        if os.path.exists(self.partPath):
+            partSize = os.path.getsize(self.partPath)
+            if size is not None and partSize < int(size) and not self.isHedge():
+                self.offset = partSize
+            else:
+                os.remove(self.partPath)
+        if self.offset:
+            # The checksum covers the whole file, start it with what we already have
+            f = open(self.partPath, "rb")
+            while 1:
+                buffer = f.read(65536)
+                if not buffer:
+                    break
+                self.checksum.update(buffer)
+            f.close()
+            self.size = self.offset
+            self.file = open(self.partPath, "ab", WRITE_BUFFER_SIZE)
+        else:
+            self.file = open(self.partPath, "wb", WRITE_BUFFER_SIZE)
+        if size is not None:
+            # The file's size stays that of the data written, so a short part
+            # file is still resumed from the right offset
+            preallocate(self.file, self.offset, int(size) - self.offset)
+
+    def isHedge(self):
+        return self.control is not None and self.control.hedge
+
+    def header(self, line):
+        # With redirects there is a status line per response, the last one is the data's
+        if line.startswith("HTTP/"):
+            try:
+                self.status = int(line.split()[1])
+            except (IndexError, ValueError):
+                self.status = None
+
+    def progress(self, downloadTotal, downloaded, uploadTotal, uploaded):
+        # A true return value aborts the transfer
+        return self.control is not None and self.control.cancelled
+
+    def write(self, data):
+        if self.control is not None and self.control.cancelled:
+            # Returning a count other than len(data) aborts the transfer, the
+            # progress callback may not be called while data keeps coming
+            return 0
+        if self.status is not None and self.status not in [200, 206]:
+            # Error page, don't let it into the file
+            return
+        if self.offset and self.status != 206:
+            # Server ignored our Range request and is sending the whole file
+            LOG.info("Unable to resume %s, fetching it from the start" % (self.filePath))
+            self.restart()
+        self.file.write(data)
+        self.checksum.update(data)
+        self.size += len(data)
+
+    def restart(self):
+        self.file.seek(0)
+        self.file.truncate()
+        self.checksum = newChecksum(self.hashtype)
+        self.size = 0
+        self.offset = 0
+
+    def close(self):
+        self.file.close()
+
+    def discard(self):
+        if os.path.exists(self.partPath):
+            os.remove(self.partPath)
+
+    def finished(self, status):
+        """
+        Called with the fetch status once the transfer is over, a hedge's
+        part file is dropped unless it was moved into place.  A hedge is
+        never resumed from, its item's own part file is.
+        """
+        if self.isHedge() and status != BaseFetch.STATUS_DOWNLOADED:
+            self.discard()
+
+    def commit(self):
+        """
+        Moves the completed download into place
+        """
+        os.rename(self.partPath, self.filePath)
+
+    def hexdigest(self):
+        return self.checksum.hexdigest()
+
+def getCurlErrorClass(errno):
+    """ Returns the BaseFetch error class for a libcurl error number
+    """
+    if errno == pycurl.E_OPERATION_TIMEOUTED:
+        return BaseFetch.ERROR_TIMEOUT
+    return BaseFetch.ERROR_OTHER
+
+def newChecksum(hashtype):
+    """ Returns a hashlib object for the hashtype names used by RHN and yum
     """
     if hashtype in ['sha', 'SHA']:
         hashtype = 'sha1'
+    return hashlib.new(hashtype)
 
+def getFileChecksum(hashtype, filename=None, fd=None, file=None, buffer_size=None):
+    """ Compute a file's checksum
+    """
     if buffer_size is None:
         buffer_size = 65536
 
@@ -158,7 +798,7 @@ def getFileChecksum(hashtype, filename=None, fd=None, file=None, buffer_size=Non
         f = open(filename, "r")
     # Rewind it
     f.seek(0, 0)
-    m = hashlib.new(hashtype)
+    m = newChecksum(hashtype)
     while 1:
         buffer = f.read(buffer_size)
         if not buffer:
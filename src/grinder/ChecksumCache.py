@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import os
+import logging
+import threading
+
+LOG = logging.getLogger("grinder.ChecksumCache")
+
+CACHE_FILENAME = ".grinder-checksums"
+
+class ChecksumCache(object):
+    """
+    Remembers the verified checksum of files already on disk, so an unchanged
+    file can be confirmed with a stat() instead of reading and hashing it again.
+    An entry is only used while the file's size, mtime and inode are the same
+    as when its checksum was recorded.
+
+    Entries are appended to a log file as they are stored, so they survive an
+    interrupted sync.  The log is compacted on close().
+    """
+    def __init__(self, cachePath):
+        self.cachePath = cachePath
+        self.entries = {}
+        self.numLines = 0
+        self.lock = threading.Lock()
+        self.file = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.cachePath):
+            return
+        f = open(self.cachePath, "r")
+        for line in f:
+            fields = line.rstrip("\n").split(" ", 5)
+            if len(fields) != 6:
+                continue
+            checksum, hashtype, size, mtime, inode, path = fields
+            self.entries[path] = (hashtype, checksum, "%s %s %s" % (size, mtime, inode))
+            self.numLines += 1
+        f.close()
+        LOG.debug("Loaded %s cached checksums from %s" % (len(self.entries), self.cachePath))
+
+    def reload(self):
+        """
+        Reads the entries again, picking up those stored by other processes
+        """
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            self.numLines = 0
+            self.load()
+        finally:
+            self.lock.release()
+
+    def _statKey(self, filePath):
+        st = os.stat(filePath)
+        return "%s %r %s" % (st.st_size, st.st_mtime, st.st_ino)
+
+    def lookup(self, filePath, hashtype):
+        """
+        Returns the cached checksum of filePath, or None if there is no entry
+        for it or the file has changed since it was recorded.
+        """
+        path = os.path.abspath(filePath)
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(path)
+        finally:
+            self.lock.release()
+        if entry is None or entry[0] != hashtype:
+            return None
+        try:
+            if entry[2] != self._statKey(path):
+                return None
+        except OSError:
+            return None
+        return entry[1]
+
+    def store(self, filePath, hashtype, checksum):
+        """
+        Records checksum for filePath as it is on disk now.
+        """
+        path = os.path.abspath(filePath)
+        statKey = self._statKey(path)
+        self.lock.acquire()
+        try:
+            if self.file is None:
+                self.file = open(self.cachePath, "a")
+            self.entries[path] = (hashtype, checksum, statKey)
+            self.file.write("%s %s %s %s\n" % (checksum, hashtype, statKey, path))
+            self.file.flush()
+            self.numLines += 1
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if self.numLines > len(self.entries):
+                # Drop the entries which have been superseded
+                tmpPath = self.cachePath + ".tmp"
+                f = open(tmpPath, "w")
+                for path, (hashtype, checksum, statKey) in self.entries.items():
+                    f.write("%s %s %s %s\n" % (checksum, hashtype, statKey, path))
+                f.close()
+                os.rename(tmpPath, self.cachePath)
+                self.numLines = len(self.entries)
+        finally:
+            self.lock.release()
+
+class ChecksumCacheSet(object):
+    """
+    The ChecksumCaches of several directories used as one, e.g. by a fetcher
+    syncing several channels.  A file's checksum is looked up in and stored
+    to the cache of the directory it is in, or of the nearest parent added.
+    """
+    def __init__(self):
+        # absolute directory -> ChecksumCache
+        self.caches = {}
+        self.lock = threading.Lock()
+
+    def add(self, savePath, cache):
+        self.lock.acquire()
+        try:
+            self.caches[os.path.abspath(savePath)] = cache
+        finally:
+            self.lock.release()
+
+    def remove(self, savePath):
+        """
+        Removes and returns the cache of savePath, None if it has none
+        """
+        self.lock.acquire()
+        try:
+            return self.caches.pop(os.path.abspath(savePath), None)
+        finally:
+            self.lock.release()
+
+    def getCache(self, filePath):
+        dirPath = os.path.dirname(os.path.abspath(filePath))
+        self.lock.acquire()
+        try:
+            while True:
+                cache = self.caches.get(dirPath)
+                if cache is not None:
+                    return cache
+                parent = os.path.dirname(dirPath)
+                if parent == dirPath:
+                    return None
+                dirPath = parent
+        finally:
+            self.lock.release()
+
+    def lookup(self, filePath, hashtype):
+        cache = self.getCache(filePath)
+        if cache is None:
+            return None
+        return cache.lookup(filePath, hashtype)
+
+    def store(self, filePath, hashtype, checksum):
+        cache = self.getCache(filePath)
+        if cache is not None:
+            cache.store(filePath, hashtype, checksum)
+
+    def getCaches(self):
+        self.lock.acquire()
+        try:
+            return self.caches.values()
+        finally:
+            self.lock.release()
+
+    def reload(self):
+        for cache in self.getCaches():
+            cache.reload()
+
+    def close(self):
+        for cache in self.getCaches():
+            cache.close()
+
+def getChecksumCache(savePath):
+    """
+    Returns the ChecksumCache kept alongside the content synced into savePath
+    """
+    if not os.path.isdir(savePath):
+        os.makedirs(savePath)
+    return ChecksumCache(os.path.join(savePath, CACHE_FILENAME))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import time
+import logging
+import threading
+
+from BaseFetch import BaseFetch
+
+LOG = logging.getLogger("grinder.ConcurrencyControl")
+
+class ConcurrencyController(object):
+    """
+    Tunes how many fetches run at once, between minimum and maximum, from
+    what the fetches of the last interval seconds achieved.  While things go
+    well one more fetch is allowed each interval.  The number is halved when
+    too many fetches fail, or when fetches take much longer per byte than the
+    best seen without the total throughput having grown, a sign they are
+    queueing at the server or on the network rather than adding bandwidth.
+    """
+    # Seconds of fetching each adjustment is based on
+    INTERVAL = 5
+    # Share of failed fetches above which the server is taken to be overloaded
+    MAX_ERROR_RATE = 0.05
+    # Fetches taking this many times longer per byte than the best seen are queueing
+    LATENCY_FACTOR = 2.0
+    # Smallest growth of the throughput, as a share, which counts as a gain
+    MIN_GAIN = 0.05
+    DECREASE_FACTOR = 0.5
+
+    def __init__(self, initial, minimum, maximum, interval=INTERVAL):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.interval = interval
+        self.active = 0
+        self.lastThroughput = None
+        self.bestLatency = None
+        self.cond = threading.Condition()
+        self.resetWindow(time.time())
+
+    def resetWindow(self, now):
+        self.windowStart = now
+        self.windowFetches = 0
+        self.windowErrors = 0
+        self.windowBytes = 0
+        self.windowSeconds = 0.0
+
+    def getLimit(self):
+        return self.limit
+
+    def acquire(self, stopEvent=None):
+        """
+        Waits until one more fetch may run.
+        Returns False if stopEvent was set while waiting.
+        """
+        self.cond.acquire()
+        try:
+            while self.active >= self.limit:
+                if stopEvent is not None and stopEvent.isSet():
+                    return False
+                # Timed so stopEvent is noticed
+                self.cond.wait(1.0)
+            self.active += 1
+            return True
+        finally:
+            self.cond.release()
+
+    def release(self):
+        self.cond.acquire()
+        try:
+            self.active -= 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def record(self, numBytes, seconds, ok):
+        """
+        Records a finished fetch.
+            numBytes = bytes downloaded
+            seconds = how long the fetch took
+            ok = False if the fetch failed
+        """
+        self.cond.acquire()
+        try:
+            self.windowFetches += 1
+            if ok:
+                self.windowBytes += numBytes
+                if numBytes:
+                    self.windowSeconds += seconds
+            else:
+                self.windowErrors += 1
+            now = time.time()
+            if now - self.windowStart >= self.interval:
+                self.adjust(now)
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def recordStatus(self, status, seconds, itemSize):
+        """
+        Records a fetch of an item of itemSize bytes which ended with fetch
+        status 'status' after the given number of seconds
+        """
+        if status in [BaseFetch.STATUS_NOOP, BaseFetch.STATUS_CANCELLED, BaseFetch.STATUS_UNAUTHORIZED]:
+            # Says nothing about how the server copes
+            return
+        numBytes = 0
+        if status == BaseFetch.STATUS_DOWNLOADED:
+            try:
+                numBytes = int(itemSize)
+            except (TypeError, ValueError):
+                pass
+        self.record(numBytes, seconds, status not in BaseFetch.RETRY_STATUSES)
+
+    def adjust(self, now):
+        throughput = self.windowBytes / max(now - self.windowStart, 0.001)
+        errorRate = float(self.windowErrors) / self.windowFetches
+        latency = None
+        if self.windowBytes:
+            latency = self.windowSeconds / self.windowBytes
+            if self.bestLatency is None or latency < self.bestLatency:
+                self.bestLatency = latency
+        gained = self.lastThroughput is None or \
+            throughput >= self.lastThroughput * (1 + ConcurrencyController.MIN_GAIN)
+        queueing = latency is not None and \
+            latency > self.bestLatency * ConcurrencyController.LATENCY_FACTOR
+        oldLimit = self.limit
+        if errorRate > ConcurrencyController.MAX_ERROR_RATE or (queueing and not gained):
+            self.limit = max(self.minimum, int(self.limit * ConcurrencyController.DECREASE_FACTOR))
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+        if self.limit != oldLimit:
+            LOG.info("Concurrency %s -> %s: %.0f KB/sec, %.0f%% of %s fetches failed" % \
+                    (oldLimit, self.limit, throughput / 1024, errorRate * 100, self.windowFetches))
+        self.lastThroughput = throughput
+        self.resetWindow(now)
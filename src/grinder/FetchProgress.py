@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import time
+import logging
+import threading
+import traceback
+from threading import Thread
+
+LOG = logging.getLogger("grinder.FetchProgress")
+
+class WorkerState(object):
+    """
+    What one worker of a download engine is doing.  For a MultiFetch each
+    transfer in flight is a worker.
+    """
+    IDLE = 'idle'
+    FETCHING = 'fetching'
+    ENDED = 'ended'
+
+    def __init__(self, name, state, itemInfo=None, host=None):
+        self.name = name
+        self.state = state
+        self.itemInfo = itemInfo
+        self.host = host
+        # When the worker entered this state
+        self.since = time.time()
+
+    def __str__(self):
+        if self.state == WorkerState.FETCHING:
+            return "%s fetching %s for %.1fs" % (self.name, self.itemInfo, time.time() - self.since)
+        return "%s %s" % (self.name, self.state)
+
+class ProgressSnapshot(object):
+    """
+    Progress of a sync at one point in time, handed to progress listeners
+    """
+    def __init__(self):
+        self.itemsTotal = 0
+        # Items finished, whether they were downloaded, already there or failed
+        self.itemsDone = 0
+        self.itemsFailed = 0
+        # Sum of the sizes of the items added and of those finished
+        self.bytesTotal = 0
+        self.bytesDone = 0
+        # Bytes received from the network, retries and hedges included
+        self.bytesReceived = 0
+        # Download rate over the last RATE_WINDOW seconds
+        self.bytesPerSec = 0.0
+        # Seconds until the remaining bytes are in at the current rate, None if unknown
+        self.eta = None
+        self.elapsed = 0.0
+        self.workers = []
+        # True for the snapshot sent once the engine has finished
+        self.finished = False
+
+    def getItemsRemaining(self):
+        return self.itemsTotal - self.itemsDone
+
+    def getBytesRemaining(self):
+        return max(self.bytesTotal - self.bytesDone, 0)
+
+    def __str__(self):
+        s = "%s/%s items, %s failed, %.1f/%.1f MB, %.0f KB/sec" % (self.itemsDone, self.itemsTotal,
+                self.itemsFailed, self.bytesDone / 1048576.0, self.bytesTotal / 1048576.0,
+                self.bytesPerSec / 1024)
+        if self.eta is not None:
+            s += ", %ds left" % (self.eta)
+        busy = len([w for w in self.workers if w.state == WorkerState.FETCHING])
+        s += ", %s of %s workers fetching" % (busy, len(self.workers))
+        return s
+
+class FetchProgress(object):
+    """
+    Live progress of a download engine: items and bytes done and remaining,
+    the current download rate, an ETA and what each worker is doing.
+    Bytes are counted as curl hands them over, see BaseFetch.setProgress(),
+    the rate is kept in one second buckets so counting costs a lock and an
+    addition per write.
+    Listeners are called with a ProgressSnapshot every 'interval' seconds
+    from a thread of their own, a slow listener never holds up a transfer.
+    getSnapshot() may be polled instead.
+    """
+    # Seconds of transfers the download rate is averaged over
+    RATE_WINDOW = 10
+    DEFAULT_INTERVAL = 1.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.itemsTotal = 0
+        self.itemsDone = 0
+        self.itemsFailed = 0
+        self.bytesTotal = 0
+        self.bytesDone = 0
+        self.bytesReceived = 0
+        # [second, bytes received in that second], oldest first
+        self.buckets = []
+        self.workers = {}
+        self.workerOrder = []
+        self.finished = False
+        # list of [callback, interval, time of the next call]
+        self.listeners = []
+        self.reporter = None
+        # Set by start(), the listeners aren't called before
+        self.running = False
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Called by the engine as it starts, the reporter thread calling the
+        listeners runs from then on.  Not before, e.g. so ProcessFetch forks
+        its processes without it.
+        """
+        self.lock.acquire()
+        try:
+            self.running = True
+            self.startReporter()
+        finally:
+            self.lock.release()
+
+    def startReporter(self):
+        """
+        Starts the reporter thread if it is due, called holding the lock
+        """
+        if self.reporter is None and self.running and self.listeners and not self.finished:
+            self.reporter = Thread(target=self.report, name="FetchProgress")
+            self.reporter.setDaemon(True)
+            self.reporter.start()
+
+    def addListener(self, callback, interval=DEFAULT_INTERVAL):
+        """
+        callback = function called with a ProgressSnapshot every interval
+            seconds once the engine has started, and once more when it has
+            finished
+        """
+        self.lock.acquire()
+        try:
+            self.listeners.append([callback, interval, time.time()])
+            self.startReporter()
+        finally:
+            self.lock.release()
+
+    def removeListener(self, callback):
+        self.lock.acquire()
+        try:
+            self.listeners = [l for l in self.listeners if l[0] != callback]
+        finally:
+            self.lock.release()
+
+    def itemAdded(self, itemSize):
+        self.lock.acquire()
+        try:
+            self.itemsTotal += 1
+            self.bytesTotal += itemSize
+        finally:
+            self.lock.release()
+
+    def itemFinished(self, itemSize, failed=False):
+        """
+        Records an item done with, itemSize counts as done even if it failed
+        so what remains to do goes down to 0
+        """
+        self.lock.acquire()
+        try:
+            self.itemsDone += 1
+            self.bytesDone += itemSize
+            if failed:
+                self.itemsFailed += 1
+        finally:
+            self.lock.release()
+
+    def countBytes(self, numBytes):
+        second = int(time.time())
+        self.lock.acquire()
+        try:
+            self.bytesReceived += numBytes
+            if self.buckets and self.buckets[-1][0] == second:
+                self.buckets[-1][1] += numBytes
+            else:
+                self.buckets.append([second, numBytes])
+                if len(self.buckets) > FetchProgress.RATE_WINDOW + 1:
+                    del self.buckets[0]
+        finally:
+            self.lock.release()
+
+    def countWrites(self, writeFunction):
+        """
+        Returns writeFunction, a curl WRITEFUNCTION, wrapped to count the data it is passed
+        """
+        def write(data):
+            self.countBytes(len(data))
+            return writeFunction(data)
+        return write
+
+    def setWorkerState(self, name, state, itemInfo=None, host=None):
+        self.lock.acquire()
+        try:
+            if not self.workers.has_key(name):
+                self.workerOrder.append(name)
+            self.workers[name] = WorkerState(name, state, itemInfo, host)
+        finally:
+            self.lock.release()
+
+    def removeWorker(self, name):
+        self.lock.acquire()
+        try:
+            if self.workers.has_key(name):
+                del self.workers[name]
+                self.workerOrder.remove(name)
+        finally:
+            self.lock.release()
+
+    def getRate(self, now):
+        """
+        Returns the bytes/sec received over the last RATE_WINDOW seconds,
+        called holding the lock
+        """
+        oldest = int(now) - FetchProgress.RATE_WINDOW
+        received = 0
+        for second, numBytes in self.buckets:
+            if second > oldest:
+                received += numBytes
+        # The current second is only partly over
+        window = min(now - oldest - 1, now - self.started)
+        if window <= 0:
+            return 0.0
+        return received / window
+
+    def fillSnapshot(self, s, now):
+        """
+        Sets the counts of ProgressSnapshot s, called holding the lock
+        """
+        s.itemsTotal = self.itemsTotal
+        s.itemsDone = self.itemsDone
+        s.itemsFailed = self.itemsFailed
+        s.bytesTotal = self.bytesTotal
+        s.bytesDone = self.bytesDone
+        s.bytesReceived = self.bytesReceived
+        s.bytesPerSec = self.getRate(now)
+        s.workers = [self.workers[name] for name in self.workerOrder]
+
+    def getSnapshot(self):
+        now = time.time()
+        s = ProgressSnapshot()
+        self.lock.acquire()
+        try:
+            self.fillSnapshot(s, now)
+            s.finished = self.finished
+        finally:
+            self.lock.release()
+        s.elapsed = now - self.started
+        if s.finished:
+            s.eta = 0
+        elif s.bytesPerSec > 0:
+            s.eta = s.getBytesRemaining() / s.bytesPerSec
+        return s
+
+    def notify(self, listeners, snapshot):
+        for callback in listeners:
+            try:
+                callback(snapshot)
+            except Exception, e:
+                tb_info = traceback.format_exc()
+                LOG.debug("%s" % (tb_info))
+                LOG.warn("Caught exception<%s> from progress listener %s" % (e, callback))
+
+    def report(self):
+        while not self._stop.isSet():
+            now = time.time()
+            due = []
+            wait = FetchProgress.DEFAULT_INTERVAL
+            self.lock.acquire()
+            try:
+                for listener in self.listeners:
+                    if listener[2] <= now:
+                        due.append(listener[0])
+                        listener[2] = now + listener[1]
+                    wait = min(wait, listener[2] - now)
+            finally:
+                self.lock.release()
+            if due:
+                self.notify(due, self.getSnapshot())
+            self._stop.wait(max(wait, 0.01))
+
+    def finish(self):
+        """
+        Called by the engine once all its workers have ended, listeners get a
+        last snapshot with finished set
+        """
+        self.lock.acquire()
+        try:
+            self.finished = True
+            reporter = self.reporter
+            self.reporter = None
+            listeners = [l[0] for l in self.listeners]
+        finally:
+            self.lock.release()
+        self._stop.set()
+        if reporter is not None:
+            reporter.join()
+        self.notify(listeners, self.getSnapshot())
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import logging
+
+LOG = logging.getLogger("grinder.FileUtils")
+
+# Buffer size of files downloads are written to, data from curl is
+# collected into writes of this size
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# fallocate() mode which reserves space without changing the file's size
+FALLOC_FL_KEEP_SIZE = 0x01
+
+# There is no fallocate() in the python standard library, call it through
+# ctypes where it is available.
+_fallocate = None
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"))
+    if hasattr(_libc, "fallocate64"):
+        _fallocate = _libc.fallocate64
+    else:
+        _fallocate = _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    _fallocate.restype = ctypes.c_int
+except (ImportError, OSError, AttributeError, TypeError):
+    LOG.debug("fallocate() is not available, downloads won't be preallocated")
+    _fallocate = None
+
+def preallocate(f, offset, length, keepSize=True):
+    """
+    Reserves disk space for length bytes of the open file f from offset, so
+    the data later written there is laid out contiguously on disk.  With
+    keepSize the file's size is left unchanged.
+    Returns False if space couldn't be reserved, e.g. the filesystem
+    doesn't support it, which is harmless.
+    """
+    if _fallocate is None or length <= 0:
+        return False
+    mode = 0
+    if keepSize:
+        mode = FALLOC_FL_KEEP_SIZE
+    return _fallocate(f.fileno(), mode, offset, length) == 0
@@ -24,6 +24,8 @@ import GrinderLog
 from optparse import OptionParser
 from RepoFetch import YumRepoGrinder
 from RHNSync import RHNSync
+from PackageStore import getPackageStore
+from PriorityClasses import DEFAULT_PRIORITY_CLASSES
 
 LOG = logging.getLogger("grinder.GrinderCLI")
 
@@ -77,6 +79,18 @@ class RHNDriver(CliDriver):
                 help='Entitlement Certificate')
         self.parser.add_option('-C', '--config', action='store', 
                 help='Configuration file')
+        self.parser.add_option('--deepverify', action='store_true',
+                help='Checksum every existing file instead of trusting the checksum cache')
+        self.parser.add_option('--bandwidth', action='store', type='float',
+                help='Limit total download bandwidth to this many Mbit/s')
+        self.parser.add_option('--store', action='store_true',
+                help='Keep packages once in a content addressed store under basepath, linked into each channel')
+        self.parser.add_option('--concurrent', action='store_true',
+                help='Sync the channels at once, sharing one pool of fetches between them')
+        self.parser.add_option('--resume', action='store_true',
+                help='Continue each channel with the packages its last, interrupted, sync did not get to')
+        self.parser.add_option('--retry-failed', action='store_true', dest='retryfailed',
+                help='Fetch again only the packages which failed in the last sync of each channel')
         self.parser.add_option('-k', '--kickstarts', action='store_true', 
                 help='Sync all kickstart trees for channels specified')
         self.parser.add_option('-K', '--skippackages', action='store_true', 
@@ -87,6 +101,19 @@ class RHNDriver(CliDriver):
                 help='RHN Password')
         self.parser.add_option('-P', '--parallel', action='store',
                 help='Number of threads to fetch in parallel.')
+        self.parser.add_option('--min-parallel', dest='minparallel', action='store', type='int',
+                help='Fewest fetches to run in parallel when tuning it, see --max-parallel')
+        self.parser.add_option('--max-parallel', dest='maxparallel', action='store', type='int',
+                help='Tune the number of parallel fetches, starting from --parallel, up to this many')
+        self.parser.add_option('--max-per-host', dest='maxperhost', action='store', type='int',
+                help='Most fetches to run in parallel against one host')
+        self.parser.add_option('--engine', action='store', type='choice',
+                choices=['threads', 'multi'],
+                help="Download engine, 'threads' or 'multi' (single thread CurlMulti)")
+        self.parser.add_option('--processes', dest='processes', action='store', type='int',
+                help='Spread the fetches over this many processes, each running the engine')
+        self.parser.add_option('--priority-classes', dest='priorityclasses', action='store',
+                help="Comma separated package classes to fetch one after the other, from 'newest', 'security' and 'older'")
         self.parser.add_option('-r', '--removeold', action='store_true', 
                 help='Remove older rpms')
         self.parser.add_option('-s', '--systemid', action='store', help='System ID')
@@ -117,6 +144,30 @@ class RHNDriver(CliDriver):
             self.rhnSync.setSystemId(sysid)
         if self.options.parallel:
             self.rhnSync.setParallel(self.options.parallel)
+        if self.options.minparallel:
+            self.rhnSync.setMinParallel(self.options.minparallel)
+        if self.options.maxparallel:
+            self.rhnSync.setMaxParallel(self.options.maxparallel)
+        if self.options.maxperhost:
+            self.rhnSync.setMaxPerHost(self.options.maxperhost)
+        if self.options.engine:
+            self.rhnSync.setFetchEngine(self.options.engine)
+        if self.options.processes:
+            self.rhnSync.setFetchProcesses(self.options.processes)
+        if self.options.priorityclasses is not None:
+            self.rhnSync.setPriorityClasses(parsePriorityClasses(self.options.priorityclasses))
+        if self.options.concurrent:
+            self.rhnSync.setConcurrentChannels(self.options.concurrent)
+        if self.options.resume:
+            self.rhnSync.setResume(self.options.resume)
+        if self.options.retryfailed:
+            self.rhnSync.setRetryFailed(self.options.retryfailed)
+        if self.options.deepverify:
+            self.rhnSync.setDeepVerify(self.options.deepverify)
+        if self.options.bandwidth:
+            self.rhnSync.setMaxBandwidth(self.options.bandwidth)
+        if self.options.store:
+            self.rhnSync.setUsePackageStore(self.options.store)
         if self.options.debug:
             self.rhnSync.setVerbose(self.options.debug)
         if self.options.removeold:
@@ -148,14 +199,23 @@ class RHNDriver(CliDriver):
             for c in self.args:
                 channels.append({'label':c, 'relpath':os.path.join(basePath,c)})
             report = {}
+            concurrent = self.rhnSync.getConcurrentChannels() and not self.options.skippackages
+            if concurrent:
+                pkgReports = self.rhnSync.syncChannels(channels, self.rhnSync.getVerbose())
             for info in channels:
                 label = info['label']
                 savePath = info['relpath']
                 report[label] = {}
-                if not self.options.skippackages:
+                if concurrent:
+                    if pkgReports.has_key(label):
+                        report[label]["packages"] = pkgReports[label]
+                if self.rhnSync.stopped:
+                    LOG.warn("Stopped, skipping the rest of the sync of %s" % (label))
+                    continue
+                if not concurrent and not self.options.skippackages:
                     report[label]["packages"] = self.rhnSync.syncPackages(label, 
                             savePath, self.rhnSync.getVerbose())
-                if self.options.kickstarts:
+                if self.options.kickstarts and not self.rhnSync.stopped:
                     report[label]["kickstarts"] = self.rhnSync.syncKickstarts(label, 
                             savePath, self.rhnSync.getVerbose())
             for r in report:
@@ -170,6 +230,7 @@ class RHNDriver(CliDriver):
 
 class RepoDriver(CliDriver):
     parallel = 5
+    engine = "threads"
     def __init__(self):
         usage = "usage: %prog yum [OPTIONS]"
         shortdesc = "Fetches content from a yum repo."
@@ -189,8 +250,28 @@ class RepoDriver(CliDriver):
                           help="Path location to Client Certificate Key.")
         self.parser.add_option("--parallel", dest="parallel",
                           help="Thread count to fetch the bits in parallel. Defaults to 5")
+        self.parser.add_option("--min-parallel", dest="minparallel", type="int", default=0,
+                          help="Fewest fetches to run in parallel when tuning it, see --max-parallel. Defaults to 1")
+        self.parser.add_option("--max-parallel", dest="maxparallel", type="int", default=0,
+                          help="Tune the number of parallel fetches, starting from --parallel, up to this many")
+        self.parser.add_option("--max-per-host", dest="maxperhost", type="int", default=0,
+                          help="Most fetches to run in parallel against one mirror. Defaults to no limit")
+        self.parser.add_option("--engine", dest="engine", type="choice",
+                          choices=["threads", "multi"],
+                          help="Download engine, 'threads' or 'multi' (single thread CurlMulti). Defaults to threads")
+        self.parser.add_option("--processes", dest="processes", type="int", default=0,
+                          help="Spread the fetches over this many processes, each running the engine. Defaults to 1")
+        self.parser.add_option("--priority-classes", dest="priorityclasses",
+                          default=",".join(DEFAULT_PRIORITY_CLASSES),
+                          help="Comma separated package classes to fetch one after the other, from 'newest', 'security' and 'older'. Defaults to %s" % (",".join(DEFAULT_PRIORITY_CLASSES)))
         self.parser.add_option("--dir", dest="dir",
                           help="Directory path to store the fetched content. Defaults to Current working Directory")
+        self.parser.add_option("--deepverify", dest="deepverify", action="store_true", default=False,
+                          help="Checksum every existing file instead of trusting the checksum cache")
+        self.parser.add_option("--bandwidth", dest="bandwidth", type="float", default=0,
+                          help="Limit total download bandwidth to this many Mbit/s. Defaults to no limit")
+        self.parser.add_option("--store", dest="store", action="store_true", default=False,
+                          help="Keep packages once in a content addressed store under --dir, linked into the repo")
 
     def _validate_options(self):
         if not self.options.label:
@@ -204,6 +285,9 @@ class RepoDriver(CliDriver):
         if self.options.parallel:
             self.parallel = self.options.parallel
 
+        if self.options.engine:
+            self.engine = self.options.engine
+
     def _do_command(self):
         """
         Executes the command.
@@ -212,10 +296,19 @@ class RepoDriver(CliDriver):
         if self.options.cacert and self.options.clicert and self.options.clikey:
             self.yfetch = YumRepoGrinder(self.options.label, self.options.url, \
                                 self.parallel, cacert=self.options.cacert, \
-                                clicert=self.options.clicert, clikey=self.options.clikey)
+                                clicert=self.options.clicert, clikey=self.options.clikey, \
+                                engine=self.engine, deepVerify=self.options.deepverify, \
+                                maxBandwidth=self.options.bandwidth, usePackageStore=self.options.store, \
+                                minParallel=self.options.minparallel, maxParallel=self.options.maxparallel, \
+                                maxPerHost=self.options.maxperhost, numProcesses=self.options.processes, \
+                                priorityClasses=parsePriorityClasses(self.options.priorityclasses))
         else:
             self.yfetch = YumRepoGrinder(self.options.label, self.options.url, \
-                                self.parallel)
+                                self.parallel, engine=self.engine, deepVerify=self.options.deepverify, \
+                                maxBandwidth=self.options.bandwidth, usePackageStore=self.options.store, \
+                                minParallel=self.options.minparallel, maxParallel=self.options.maxparallel, \
+                                maxPerHost=self.options.maxperhost, numProcesses=self.options.processes, \
+                                priorityClasses=parsePriorityClasses(self.options.priorityclasses))
         if self.options.dir:
             self.yfetch.fetchYumRepo(self.options.dir)
         else:
@@ -224,12 +317,33 @@ class RepoDriver(CliDriver):
     def stop(self):
         self.yfetch.stop()
 
+class GCDriver(CliDriver):
+    def __init__(self):
+        usage = "usage: %prog gc [OPTIONS]"
+        shortdesc = "Removes packages from the package store no longer in any channel or repo."
+        desc = "gc"
+        CliDriver.__init__(self, "gc", usage, shortdesc, desc)
+        GrinderLog.setup(self.debug)
+
+        self.parser.add_option('-b', '--basepath', action='store',
+                help='Path the package store was created under. Defaults to Current working Directory')
+
+    def _do_command(self):
+        """
+        Executes the command.
+        """
+        basePath = self.options.basepath
+        if not basePath:
+            basePath = "./"
+        numRemoved, bytesFreed = getPackageStore(basePath).gc()
+        print "Removed %s packages, %s bytes" % (numRemoved, bytesFreed)
+
 # this is similar to how rho does parsing
 class CLI:
     def __init__(self):
 
         self.cli_commands = {}
-        for clazz in [ RepoDriver, RHNDriver]:
+        for clazz in [ RepoDriver, RHNDriver, GCDriver]:
             cmd = clazz()
             # ignore the base class
             if cmd.name != "cli":
@@ -298,14 +412,20 @@ class CLI:
             sys.exit(0)
         cmd.main()
 
+def parsePriorityClasses(value):
+    """
+    Returns the list of class names in a comma separated --priority-classes value
+    """
+    return [name.strip() for name in value.split(",") if name.strip()]
+
 def handleKeyboardInterrupt(signalNumer, frame):
     if (cmd.killcount > 0):
         LOG.error("force quitting.")
         sys.exit()
     if (cmd.killcount == 0):
         cmd.killcount = 1
-        msg = "SIGINT caught, will finish currently downloading" + \
-              " packages and exit. Press CTRL+C again to force quit"
+        msg = "SIGINT caught, will abort the downloads in progress, keeping" + \
+              " what was received to resume from, and exit. Press CTRL+C again to force quit"
         LOG.error(msg)
         cmd.stop()
 
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import time
+import logging
+import threading
+
+from BaseFetch import BaseFetch, FetchControl
+
+LOG = logging.getLogger("grinder.HedgeTracker")
+
+DEFAULT_HEDGE_FACTOR = 4
+
+class InFlightItem(object):
+    def __init__(self, itemInfo, size, attempt):
+        self.itemInfo = itemInfo
+        self.size = size
+        self.attempt = attempt
+        self.started = time.time()
+        self.controls = []
+        self.hedged = False
+        self.done = False
+
+class HedgeTracker(object):
+    """
+    Tracks the items being fetched so that, once there is nothing left on the
+    queue, idle workers can send a second request for an item that is taking
+    far longer than it should.  That is 'factor' times longer than its size
+    over the median rate of the downloads finished so far, and at least
+    minTime seconds.  The first attempt to finish with a good result wins,
+    the other one is cancelled.
+    """
+    # Finished downloads needed before their median rate is trusted
+    MIN_SAMPLES = 5
+
+    def __init__(self, factor=DEFAULT_HEDGE_FACTOR, minTime=30):
+        self.factor = factor
+        self.minTime = minTime
+        self.inFlight = {}
+        self.rates = []
+        self.lock = threading.Lock()
+
+    def start(self, itemInfo, size, attempt=0):
+        """
+        Registers a fetch of itemInfo, returns the FetchControl to run it under
+        """
+        control = FetchControl()
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            size = 0
+        self.lock.acquire()
+        try:
+            entry = InFlightItem(itemInfo, size, attempt)
+            entry.controls.append(control)
+            self.inFlight[id(itemInfo)] = entry
+        finally:
+            self.lock.release()
+        return control
+
+    def getMedianRate(self):
+        if len(self.rates) < HedgeTracker.MIN_SAMPLES:
+            return None
+        rates = self.rates[:]
+        rates.sort()
+        return rates[len(rates) / 2]
+
+    def getHedge(self):
+        """
+        Returns (itemInfo, attempt, FetchControl) for a hedged request of the
+        slowest item worth one, or None
+        """
+        self.lock.acquire()
+        try:
+            rate = self.getMedianRate()
+            if not rate:
+                return None
+            now = time.time()
+            best = None
+            bestRatio = self.factor
+            for entry in self.inFlight.values():
+                if entry.hedged or entry.done or not entry.size:
+                    continue
+                elapsed = now - entry.started
+                if elapsed < self.minTime:
+                    continue
+                ratio = elapsed / max(entry.size / rate, 1.0)
+                if ratio >= bestRatio:
+                    best = entry
+                    bestRatio = ratio
+            if best is None:
+                return None
+            LOG.info("Sending a hedged request for %s, running %.0f seconds, %.1f times longer than expected" % \
+                    (best.itemInfo, now - best.started, bestRatio))
+            best.hedged = True
+            control = FetchControl(hedge=True)
+            best.controls.append(control)
+            return (best.itemInfo, best.attempt, control)
+        finally:
+            self.lock.release()
+
+    def hasHedgeable(self):
+        """
+        Returns True while an item which may still need a hedged request is in flight
+        """
+        self.lock.acquire()
+        try:
+            for entry in self.inFlight.values():
+                if not entry.hedged and not entry.done and entry.size:
+                    return True
+            return False
+        finally:
+            self.lock.release()
+
+    def finish(self, itemInfo, control, status):
+        """
+        Records the result of the fetch run under control.
+        Returns the status to report for the item, or None if the item's
+        other attempt is still running or has already reported.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.inFlight.get(id(itemInfo))
+            if entry is None or control not in entry.controls:
+                return status
+            entry.controls.remove(control)
+            if not entry.controls:
+                del self.inFlight[id(itemInfo)]
+            if entry.done:
+                return None
+            if status in [BaseFetch.STATUS_DOWNLOADED, BaseFetch.STATUS_NOOP]:
+                entry.done = True
+                for other in entry.controls:
+                    other.cancel()
+                if status == BaseFetch.STATUS_DOWNLOADED and entry.size:
+                    elapsed = time.time() - control.started
+                    self.rates.append(entry.size / max(elapsed, 0.001))
+                if control.hedge:
+                    LOG.info("Hedged request won for %s" % (itemInfo))
+                return status
+            if entry.controls:
+                # The other attempt may still succeed
+                return None
+            entry.done = True
+            return status
+        finally:
+            self.lock.release()
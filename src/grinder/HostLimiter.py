@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import bisect
+import logging
+import threading
+
+LOG = logging.getLogger("grinder.HostLimiter")
+
+# Most items deferred at once, see HostLimiter
+DEFAULT_MAX_DEFERRED = 8
+
+class HostLimiter(object):
+    """
+    Caps the number of fetches in flight to each host.  A download engine
+    acquires the item's host before fetching it; an item whose host is at
+    its limit is deferred and the engine moves on to items for other hosts.
+    Deferred items are handed out in the order of the queue they were taken
+    from once their host has room again.  Once maxDeferred items are
+    deferred the engine takes no more items off its queue until one of them
+    can go, so a bounded queue stays bounded and later items don't overtake
+    those ahead of them.  Workers already waiting on the queue may each
+    defer one more.
+    """
+    def __init__(self, maxPerHost=0, hostLimits=None, maxDeferred=DEFAULT_MAX_DEFERRED):
+        """
+        maxPerHost = most fetches in flight to a host, 0 for no limit
+        hostLimits = dict of host to its own limit, overriding maxPerHost
+        maxDeferred = most items deferred at once
+        """
+        self.maxPerHost = maxPerHost
+        self.hostLimits = hostLimits or {}
+        self.maxDeferred = max(maxDeferred, 1)
+        self.inFlight = {}
+        # Sorted list of (key, counter, host, work) waiting for room, see defer()
+        self.deferred = []
+        self.counter = 0
+        self.lock = threading.Lock()
+        # Notified when a host gets room, and by wake()
+        self.roomChanged = threading.Condition(self.lock)
+
+    def getLimit(self, host):
+        return self.hostLimits.get(host, self.maxPerHost)
+
+    def hasRoom(self, host):
+        limit = self.getLimit(host)
+        return not limit or self.inFlight.get(host, 0) < limit
+
+    def tryAcquire(self, host):
+        """
+        Counts a fetch from host in flight if the host has room.
+        Returns False if it hasn't.
+        """
+        if host is None:
+            return True
+        self.lock.acquire()
+        try:
+            if not self.hasRoom(host):
+                return False
+            self.inFlight[host] = self.inFlight.get(host, 0) + 1
+            return True
+        finally:
+            self.lock.release()
+
+    def acquire(self, host):
+        """
+        Counts a fetch from host in flight whether or not it has room
+        """
+        if host is None:
+            return
+        self.lock.acquire()
+        try:
+            self.inFlight[host] = self.inFlight.get(host, 0) + 1
+        finally:
+            self.lock.release()
+
+    def release(self, host):
+        if host is None:
+            return
+        self.lock.acquire()
+        try:
+            self.inFlight[host] -= 1
+            if not self.inFlight[host]:
+                del self.inFlight[host]
+            self.roomChanged.notifyAll()
+        finally:
+            self.lock.release()
+
+    def wake(self):
+        """
+        Wakes the callers waiting in getDeferred(), e.g. to stop
+        """
+        self.lock.acquire()
+        try:
+            self.roomChanged.notifyAll()
+        finally:
+            self.lock.release()
+
+    def defer(self, host, work, key=()):
+        """
+        work = (itemInfo, attempt, control) to start once host has room
+        key = the item's place in the order of the queue it was taken from,
+            deferred items are handed out lowest key first, then in the order
+            they were deferred
+        """
+        self.lock.acquire()
+        try:
+            LOG.debug("%s has %s fetches in flight, deferring %s" % \
+                    (host, self.inFlight.get(host, 0), work[0]))
+            bisect.insort(self.deferred, (key, self.counter, host, work))
+            self.counter += 1
+        finally:
+            self.lock.release()
+
+    def isFull(self):
+        """
+        Returns True if maxDeferred items are deferred, no more should be
+        taken off the queue until one of them goes
+        """
+        self.lock.acquire()
+        try:
+            return len(self.deferred) >= self.maxDeferred
+        finally:
+            self.lock.release()
+
+    def getDeferred(self, limitKey=None, timeout=0):
+        """
+        Returns (host, work) for the first deferred item whose host has room,
+        with the host acquired for it, or None
+          limitKey = only items whose key isn't above this are handed out,
+              e.g. the key of the next item on the queue
+          timeout = seconds to wait for a host to get room if no item can go,
+              None to wait until one does or wake() is called
+        """
+        self.lock.acquire()
+        try:
+            found = self.popDeferred(limitKey)
+            if found is None and timeout != 0:
+                self.roomChanged.wait(timeout)
+                found = self.popDeferred(limitKey)
+            return found
+        finally:
+            self.lock.release()
+
+    def popDeferred(self, limitKey):
+        """
+        See getDeferred(), called holding the lock
+        """
+        for index in range(len(self.deferred)):
+            key, counter, host, work = self.deferred[index]
+            if limitKey is not None and key > limitKey:
+                break
+            if self.hasRoom(host):
+                del self.deferred[index]
+                self.inFlight[host] = self.inFlight.get(host, 0) + 1
+                return (host, work)
+        return None
+
+    def hasDeferred(self):
+        self.lock.acquire()
+        try:
+            return len(self.deferred) > 0
+        finally:
+            self.lock.release()
@@ -35,22 +35,20 @@ class KickstartFetch(BaseFetch):
     def getFetchURL(self, channelLabel, ksLabel, ksFilePath):
         return self.baseURL + "/SAT/$RHN/" + channelLabel + "/getKickstartFile/" + ksLabel + "/" + ksFilePath;
 
-    def fetchItem(self, itemInfo):
-        authMap = self.login()
-
+    def getFetchRequest(self, itemInfo):
         fileName = itemInfo['relative-path']
-        itemSize = itemInfo['size']
-        md5sum = itemInfo['md5sum']
-        hashType = itemInfo['hashtype']
-        ksLabel = itemInfo['ksLabel']
-        channelLabel = itemInfo['channelLabel']
-        savePath = itemInfo['savePath']
-        fetchURL = self.getFetchURL(channelLabel, ksLabel, fileName)
-        status = self.fetch(fileName, fetchURL, itemSize, hashType, md5sum, savePath, headers=authMap)
+        fetchURL = self.getFetchURL(itemInfo['channelLabel'], itemInfo['ksLabel'], fileName)
+        return {'fileName': fileName, 'fetchURL': fetchURL,
+                'itemSize': itemInfo['size'], 'hashtype': itemInfo['hashtype'],
+                'checksum': itemInfo['md5sum'], 'savePath': itemInfo['savePath'],
+                'headers': self.login()}
+
+    def fetchItem(self, itemInfo):
+        status = self.fetch(**self.getFetchRequest(itemInfo))
         if status == BaseFetch.STATUS_UNAUTHORIZED:
             LOG.warn("Unauthorized request from fetch().  Will attempt to update authentication credentials and retry")
-            authMap = self.login(refresh=True)
-            return self.fetch(fileName, fetchURL, itemSize, md5sum, savePath, headers=authMap)
+            self.login(refresh=True)
+            return self.fetch(**self.getFetchRequest(itemInfo))
         return status
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import time
+import random
+import logging
+import threading
+
+LOG = logging.getLogger("grinder.MirrorSelector")
+
+class MirrorStats(object):
+    """
+    What is known about how one mirror performs
+    """
+    # Weight of the newest measurement in the running averages
+    ALPHA = 0.3
+    # Consecutive failures after which a mirror is taken out of rotation
+    MAX_FAILURES = 3
+    # Seconds a failing mirror sits out, doubled for every further failure
+    DISABLE_TIME = 60
+    MAX_DISABLE_TIME = 600
+
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.throughput = None
+        self.failures = 0
+        self.disabledUntil = 0
+
+    def isEnabled(self, now=None):
+        if now is None:
+            now = time.time()
+        return now >= self.disabledUntil
+
+    def average(self, old, new):
+        if old is None:
+            return new
+        return (1 - MirrorStats.ALPHA) * old + MirrorStats.ALPHA * new
+
+    def recordSuccess(self, latency, throughput=None):
+        self.failures = 0
+        self.disabledUntil = 0
+        self.latency = self.average(self.latency, latency)
+        if throughput is not None:
+            self.throughput = self.average(self.throughput, throughput)
+
+    def recordFailure(self):
+        self.failures += 1
+        if self.failures >= MirrorStats.MAX_FAILURES:
+            self.disable()
+
+    def disable(self):
+        self.failures = max(self.failures, MirrorStats.MAX_FAILURES)
+        delay = min(MirrorStats.DISABLE_TIME * 2 ** (self.failures - MirrorStats.MAX_FAILURES),
+                MirrorStats.MAX_DISABLE_TIME)
+        LOG.warn("Not using mirror %s for %s seconds, it has failed %s times" % \
+                (self.url, delay, self.failures))
+        self.disabledUntil = time.time() + delay
+
+class MirrorSelector(object):
+    """
+    Spreads the items of a repo over its mirrors, favouring the healthiest.
+    Mirrors are scored by the time they would take for a typical item,
+    from their latency and download rate.  Both are seeded by probing the
+    mirrors and kept up to date from the transfers made.  A mirror an item
+    failed on isn't used for that item again while others are available,
+    and a mirror failing repeatedly is taken out of rotation for a while.
+    """
+    # Size of the item the scores are worked out for
+    TYPICAL_SIZE = 1024 * 1024
+    # Rate assumed for mirrors nothing has been downloaded from yet, when
+    # nothing has been downloaded from any mirror.  Otherwise they are
+    # assumed to be as fast as the fastest, so they get their share of items.
+    DEFAULT_THROUGHPUT = 1024 * 1024
+    # Transfers smaller than this say little about a mirror's download rate
+    MIN_RATE_SAMPLE = 64 * 1024
+    # How many of the best mirrors items are spread over
+    NUM_PREFERRED = 3
+
+    def __init__(self, urls):
+        self.mirrors = []
+        for url in urls:
+            self.mirrors.append(MirrorStats(url.rstrip('/')))
+        self.itemFailures = {}
+        self.lock = threading.Lock()
+
+    def getURLs(self):
+        return [m.url for m in self.mirrors]
+
+    def getDefaultThroughput(self):
+        measured = [m.throughput for m in self.mirrors if m.throughput]
+        if not measured:
+            return MirrorSelector.DEFAULT_THROUGHPUT
+        return max(measured)
+
+    def getScore(self, mirror, defaultThroughput=DEFAULT_THROUGHPUT):
+        if mirror.latency is None:
+            latency = 1.0
+        else:
+            latency = mirror.latency
+        throughput = mirror.throughput
+        if not throughput:
+            throughput = defaultThroughput
+        return 1.0 / (latency + MirrorSelector.TYPICAL_SIZE / throughput)
+
+    def findMirror(self, url):
+        """
+        Returns (MirrorStats, relative path) for a url on one of the mirrors,
+        or (None, None)
+        """
+        for m in self.mirrors:
+            if url.startswith(m.url + '/'):
+                return (m, url[len(m.url) + 1:])
+        return (None, None)
+
+    def getItemURLs(self, relativePath):
+        """
+        Returns the urls of relativePath to try, best first.  The first is
+        picked at random, weighted by score, from the best NUM_PREFERRED
+        mirrors so the load is spread over them.
+        """
+        self.lock.acquire()
+        try:
+            now = time.time()
+            failed = self.itemFailures.get(relativePath, [])
+            candidates = [m for m in self.mirrors if m.isEnabled(now) and m not in failed]
+            if not candidates:
+                candidates = [m for m in self.mirrors if m not in failed]
+            if not candidates:
+                # Failed everywhere, start over
+                candidates = self.mirrors[:]
+            defaultThroughput = self.getDefaultThroughput()
+            scored = [(self.getScore(m, defaultThroughput), m) for m in candidates]
+            scored.sort(lambda a, b: cmp(b[0], a[0]))
+            preferred = scored[:MirrorSelector.NUM_PREFERRED]
+            total = 0
+            for score, m in preferred:
+                total += score
+            pick = random.uniform(0, total)
+            first = preferred[0][1]
+            for score, m in preferred:
+                pick -= score
+                if pick <= 0:
+                    first = m
+                    break
+            ordered = [first]
+            for score, m in scored:
+                if m is not first:
+                    ordered.append(m)
+            return [m.url + '/' + relativePath for m in ordered]
+        finally:
+            self.lock.release()
+
+    def recordProbe(self, url, ok, latency=None):
+        """
+        Records the result of a probe of a mirror's base url
+        """
+        self.lock.acquire()
+        try:
+            for m in self.mirrors:
+                if m.url == url.rstrip('/'):
+                    if ok:
+                        m.recordSuccess(latency)
+                    else:
+                        m.disable()
+        finally:
+            self.lock.release()
+
+    def recordTransfer(self, url, ok, numBytes=0, seconds=0, latency=0):
+        """
+        Records how a transfer of url went.
+            numBytes = bytes transferred
+            seconds = duration of the transfer
+            latency = seconds until the first byte arrived
+        """
+        self.lock.acquire()
+        try:
+            m, relativePath = self.findMirror(url)
+            if m is None:
+                return
+            if ok:
+                throughput = None
+                if numBytes >= MirrorSelector.MIN_RATE_SAMPLE and seconds > latency:
+                    throughput = numBytes / (seconds - latency)
+                m.recordSuccess(latency, throughput)
+                if self.itemFailures.has_key(relativePath):
+                    del self.itemFailures[relativePath]
+            else:
+                m.recordFailure()
+                self.itemFailures.setdefault(relativePath, []).append(m)
+        finally:
+            self.lock.release()
+
+    def __str__(self):
+        lines = []
+        for m in self.mirrors:
+            lines.append("%s latency=%s throughput=%s failures=%s score=%.3f" % \
+                    (m.url, m.latency, m.throughput, m.failures,
+                    self.getScore(m, self.getDefaultThroughput())))
+        return "\n".join(lines)
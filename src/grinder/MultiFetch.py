@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import os
+import time
+import errno
+import fcntl
+import select
+import logging
+import threading
+import traceback
+from threading import Thread
+import Queue
+import pycurl
+
+from BaseFetch import BaseFetch, FetchControl, DownloadFile, getCurlErrorClass
+from ParallelFetch import SyncReport, END_OF_ITEMS, getItemSize, storeItemSize, getItemHost, createQueue, \
+        getQueueKey, peekQueueKey, putWhileRunning, notifyCompletion, logClasses
+from RetryQueue import RetryQueue
+from HedgeTracker import HedgeTracker
+from SegmentedFetch import SegmentedDownload
+from FetchProgress import FetchProgress, WorkerState
+
+LOG = logging.getLogger("grinder.MultiFetch")
+
+class Transfer(object):
+    """
+    State of one item being downloaded by MultiFetch
+    """
+    def __init__(self, itemInfo, attempt=0, authRetried=False, allowSegments=True, control=None, host=None):
+        self.itemInfo = itemInfo
+        self.attempt = attempt
+        self.authRetried = authRetried
+        self.allowSegments = allowSegments
+        self.control = control
+        # Host acquired from the HostLimiter for this item
+        self.host = host
+        self.started = time.time()
+        # Worker name the transfer is reported under by FetchProgress
+        self.name = None
+        self.request = None
+        self.filePath = None
+        self.file = None
+        # A segmented transfer holds one of the free handles as its connection
+        # slot while its SegmentedDownload runs the segments on its own handles
+        self.segmented = None
+        self.slot = None
+
+class MultiFetch(object):
+    """
+    Download engine built on pycurl.CurlMulti.  A single thread drives up to
+    numConnections concurrent transfers, so concurrency is not bounded by the
+    cost of a python thread per transfer.
+    Same interface as ParallelFetch, the fetcher must implement getFetchRequest().
+    """
+    def __init__(self, fetcher, numConnections=50, retryPolicies=None, hedgeFactor=0, scheduleBySize=True,
+            controller=None, hostLimiter=None, toSyncQ=None, priorities=None, maxQueued=0,
+            getGroup=None):
+        """
+        controller = ConcurrencyController tuning how many transfers run at
+            once, numConnections is then its maximum
+        hostLimiter = HostLimiter capping the transfers in flight to each host
+        See ParallelFetch for the other arguments.
+        """
+        self.closed = False
+        if toSyncQ is not None:
+            self.toSyncQ = toSyncQ
+            self.closed = True
+        else:
+            self.toSyncQ = createQueue(fetcher, scheduleBySize, priorities, maxQueued, getGroup)
+        self.priorities = priorities
+        self.completionListeners = []
+        self.syncCompleteQ = Queue.Queue()
+        self.syncErrorQ = Queue.Queue()
+        self.retryQ = RetryQueue(retryPolicies)
+        self.hedger = None
+        if hedgeFactor:
+            self.hedger = HedgeTracker(hedgeFactor)
+        self.fetcher = fetcher
+        self.numConnections = numConnections
+        self.controller = controller
+        if controller:
+            self.numConnections = controller.maximum
+        self.hostLimiter = hostLimiter
+        self.syncStatusDict = dict()
+        self.syncStatusDict[BaseFetch.STATUS_NOOP] = 0
+        self.syncStatusDict[BaseFetch.STATUS_DOWNLOADED] = 0
+        self.syncStatusDict[BaseFetch.STATUS_SIZE_MISSMATCH] = 0
+        self.syncStatusDict[BaseFetch.STATUS_MD5_MISSMATCH] = 0
+        self.syncStatusDict[BaseFetch.STATUS_ERROR] = 0
+        self.transfers = {}
+        self.segmentTransfers = {}
+        self.numStarted = 0
+        self.progress = FetchProgress()
+        fetcher.setProgress(self.progress)
+        if fetcher.rateLimiter:
+            fetcher.rateLimiter.setTransfers(self.numConnections)
+        # Set once run() has taken END_OF_ITEMS off the queue
+        self.ended = False
+        self._stop = threading.Event()
+        # Written to by wake(), so run() notices new items without waiting
+        # out its select() on the transfers in flight
+        self.wakeRead, self.wakeWrite = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.thread = Thread(target=self.run)
+
+    def getNumConsumers(self):
+        """
+        Returns how many END_OF_ITEMS it takes to end run()
+        """
+        return 1
+
+    def getProgress(self):
+        """
+        Returns a ProgressSnapshot, see ParallelFetch.getProgress()
+        """
+        return self.progress.getSnapshot()
+
+    def addProgressListener(self, callback, interval=FetchProgress.DEFAULT_INTERVAL):
+        """
+        See ParallelFetch.addProgressListener(), each transfer in flight is
+        reported as a worker
+        """
+        self.progress.addListener(callback, interval)
+
+    def addCompletionListener(self, callback):
+        """
+        See ParallelFetch.addCompletionListener(), called from the thread
+        driving the transfers
+        """
+        self.completionListeners.append(callback)
+
+    def addItem(self, item):
+        """
+        See ParallelFetch.addItem()
+        """
+        if self._stop.isSet():
+            LOG.debug("Stopped, dropping %s" % (item))
+            return
+        if self.closed:
+            raise ValueError("Items can't be added after close()")
+        self.progress.itemAdded(storeItemSize(self.fetcher, item))
+        if self.priorities:
+            self.priorities.itemAdded(item)
+        putWhileRunning(self.toSyncQ, item, self._stop)
+        self.wake()
+
+    def addItemList(self, items):
+        for p in items:
+            self.addItem(p)
+
+    def start(self):
+        self.progress.start()
+        self.thread.start()
+
+    def close(self):
+        """
+        Signals no more items will be added, see ParallelFetch.close()
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.toSyncQ.put(END_OF_ITEMS)
+        self.wake()
+
+    def wake(self):
+        """
+        Wakes run() from waiting on the transfers in flight
+        """
+        fd = self.wakeWrite
+        if fd is None:
+            return
+        try:
+            os.write(fd, "x")
+        except OSError, e:
+            # A full pipe will wake run() already
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def stop(self):
+        """
+        Aborts the transfers in flight, see ParallelFetch.stop()
+        """
+        self._stop.set()
+        # From their callbacks, perform() may not return while data keeps coming
+        for transfer in self.transfers.values() + self.segmentTransfers.values():
+            if transfer.control is not None:
+                transfer.control.stop()
+        self.close()
+        self.wake()
+
+    def waitForFinish(self):
+        """
+        Closes the queue and waits for all transfers to finish
+        Returns a SyncReport
+        """
+        self.close()
+        while self.thread.isAlive():
+            # An untimed join can't be interrupted by a signal
+            self.thread.join(1.0)
+        if self.wakeWrite is not None:
+            fd = self.wakeWrite
+            self.wakeWrite = None
+            os.close(fd)
+            os.close(self.wakeRead)
+        self.progress.finish()
+        LOG.info("All transfers have finished.")
+        report = SyncReport()
+        report.addStatusCounts(self.syncStatusDict)
+        report.protocols = self.fetcher.getProtocols()
+        if self.priorities:
+            report.priorityClasses = self.priorities.getCompletion()
+            logClasses(report)
+        LOG.info("MultiFetch: %s items successfully processed, %s downloaded, %s items had errors" %
+            (report.successes, report.downloads, report.errors))
+        return report
+
+    def run(self):
+        LOG.debug("Run has started with %s connections" % (self.numConnections))
+        multi = pycurl.CurlMulti()
+        if self.fetcher.useHttp2:
+            # Transfers to a host speaking HTTP/2 share one connection as streams
+            multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+        freeHandles = []
+        for i in range(self.numConnections):
+            freeHandles.append(pycurl.Curl())
+        while not self._stop.isSet():
+            while freeHandles and self.mayStartTransfer(freeHandles):
+                full = False
+                if self.hostLimiter:
+                    limitKey = None
+                    full = self.hostLimiter.isFull()
+                    if not full:
+                        # An item queued since, and ahead of the deferred ones, comes first
+                        limitKey = peekQueueKey(self.toSyncQ)
+                    deferred = self.hostLimiter.getDeferred(limitKey)
+                    if deferred:
+                        host, (itemInfo, attempt, control) = deferred
+                        self.startTransfer(multi, freeHandles,
+                                Transfer(itemInfo, attempt, control=control, host=host))
+                        continue
+                retry = self.retryQ.getReady()
+                if retry:
+                    itemInfo, attempt = retry
+                    self.admitTransfer(multi, freeHandles, itemInfo, attempt)
+                    continue
+                try:
+                    if self.ended or full:
+                        # With as many items deferred as the HostLimiter
+                        # takes, no more are taken until one of them goes
+                        raise Queue.Empty
+                    itemInfo = self.toSyncQ.get_nowait()
+                except Queue.Empty:
+                    hedge = None
+                    if self.hedger:
+                        hedge = self.hedger.getHedge()
+                    if hedge is None:
+                        break
+                    itemInfo, attempt, control = hedge
+                    self.admitTransfer(multi, freeHandles, itemInfo, attempt, control)
+                    continue
+                if itemInfo is END_OF_ITEMS:
+                    self.ended = True
+                    continue
+                self.admitTransfer(multi, freeHandles, itemInfo)
+            if not self.transfers and not self.segmentTransfers:
+                wait = self.retryQ.timeUntilReady()
+                if self.ended:
+                    if wait is None:
+                        break
+                    # Only items waiting out their retry delay are left
+                    self._stop.wait(min(wait, 1.0))
+                    continue
+                # Sleep until an item is added, close() wakes us with END_OF_ITEMS
+                try:
+                    if wait is None:
+                        itemInfo = self.toSyncQ.get()
+                    else:
+                        itemInfo = self.toSyncQ.get(True, wait)
+                except Queue.Empty:
+                    continue
+                if itemInfo is END_OF_ITEMS:
+                    self.ended = True
+                else:
+                    self.admitTransfer(multi, freeHandles, itemInfo)
+                continue
+            while 1:
+                ret, numHandles = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            numFinished = 0
+            while 1:
+                numQueued, okList, errList = multi.info_read()
+                for curl in okList:
+                    self.finishTransfer(multi, freeHandles, curl, 0, None)
+                for curl, errno, errmsg in errList:
+                    self.finishTransfer(multi, freeHandles, curl, errno, errmsg)
+                numFinished += len(okList) + len(errList)
+                if numQueued == 0:
+                    break
+            if not numFinished:
+                # Nothing to hand out, wait for activity on the open transfers
+                self.waitForActivity(multi, 1.0)
+        for curl in self.transfers.keys():
+            # stop() was called, abandon what is still in flight.  The data
+            # received is kept for the next attempt to resume from.
+            transfer = self.transfers.pop(curl)
+            multi.remove_handle(curl)
+            transfer.file.close()
+            if transfer.control is not None and transfer.control.hedge:
+                transfer.file.discard()
+            freeHandles.append(curl)
+            self.progress.removeWorker(transfer.name)
+        for curl in self.segmentTransfers.keys():
+            transfer = self.segmentTransfers.pop(curl)
+            self.progress.removeWorker(transfer.name)
+            if transfer.segmented.getHandles():
+                transfer.segmented.abort(multi)
+                freeHandles.append(transfer.slot)
+                # Segments are written out of order, there is nothing to resume from
+                if os.path.exists(transfer.segmented.partPath):
+                    os.remove(transfer.segmented.partPath)
+        for curl in freeHandles:
+            curl.close()
+        multi.close()
+        LOG.debug("Run ending")
+
+    def waitForActivity(self, multi, timeout):
+        """
+        Waits up to timeout seconds for activity on the transfers in flight,
+        or for wake()
+        """
+        readFds, writeFds, exceptFds = multi.fdset()
+        curlTimeout = multi.timeout()
+        if curlTimeout >= 0:
+            timeout = min(timeout, curlTimeout / 1000.0)
+        try:
+            ready = select.select(readFds + [self.wakeRead], writeFds, exceptFds, timeout)[0]
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            return
+        if self.wakeRead in ready:
+            try:
+                while os.read(self.wakeRead, 4096):
+                    pass
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def mayStartTransfer(self, freeHandles):
+        """
+        Returns True if the ConcurrencyController, if any, allows one more transfer
+        """
+        if self.controller is None:
+            return True
+        return self.numConnections - len(freeHandles) < self.controller.getLimit()
+
+    def admitTransfer(self, multi, freeHandles, itemInfo, attempt=0, control=None):
+        """
+        Starts a transfer of itemInfo, or defers it if its host has as many
+        transfers in flight as the HostLimiter allows
+        """
+        host = None
+        if self.hostLimiter:
+            host = getItemHost(self.fetcher, itemInfo)
+            if control is not None:
+                # A hedged request isn't held back, its item is late already
+                self.hostLimiter.acquire(host)
+            elif not self.hostLimiter.tryAcquire(host):
+                self.hostLimiter.defer(host, (itemInfo, attempt, control),
+                        getQueueKey(self.toSyncQ, itemInfo))
+                return
+        self.startTransfer(multi, freeHandles, Transfer(itemInfo, attempt, control=control, host=host))
+
+    def startTransfer(self, multi, freeHandles, transfer):
+        curl = None
+        try:
+            transfer.request = self.fetcher.getFetchRequest(transfer.itemInfo)
+            r = transfer.request
+            if self.hedger and transfer.control is None:
+                transfer.control = self.hedger.start(transfer.itemInfo, r['itemSize'], transfer.attempt)
+            elif transfer.control is None:
+                # Lets stop() abort the transfer
+                transfer.control = FetchControl()
+            if self._stop.isSet():
+                transfer.control.stop()
+            transfer.filePath = self.fetcher.prepareFetch(r['fileName'], r['hashtype'],
+                    r['checksum'], r['savePath'])
+            if transfer.filePath is None:
+                self.handleStatus(multi, freeHandles, transfer, BaseFetch.STATUS_NOOP)
+                return
+            self.numStarted += 1
+            transfer.name = "transfer-%s" % (self.numStarted)
+            self.progress.setWorkerState(transfer.name, WorkerState.FETCHING, transfer.itemInfo, transfer.host)
+            hedge = transfer.control is not None and transfer.control.hedge
+            if transfer.allowSegments and not hedge and \
+                    self.fetcher.shouldSegment(r['itemSize'], transfer.filePath):
+                self.startSegmentedTransfer(multi, freeHandles, transfer)
+                return
+            transfer.file = DownloadFile(transfer.filePath, r['hashtype'], r['itemSize'], transfer.control)
+            curl = freeHandles.pop()
+            curl.reset()
+            self.fetcher.setupCurl(curl, r['fetchURL'], r.get('headers'), transfer.file)
+            LOG.info("Fetching %s bytes: %s from %s" % (r['itemSize'], r['fileName'], r['fetchURL']))
+            multi.add_handle(curl)
+            self.transfers[curl] = transfer
+        except Exception, e:
+            tb_info = traceback.format_exc()
+            LOG.debug("%s" % (tb_info))
+            LOG.warn("Caught exception<%s> starting fetch of %s" % (e, transfer.itemInfo))
+            if transfer.file:
+                transfer.file.close()
+            if curl is not None:
+                freeHandles.append(curl)
+            self.fetcher.setErrorClass(BaseFetch.ERROR_OTHER)
+            self.handleStatus(multi, freeHandles, transfer, BaseFetch.STATUS_ERROR)
+
+    def startSegmentedTransfer(self, multi, freeHandles, transfer):
+        r = transfer.request
+        urls = [r['fetchURL']]
+        if r.get('mirrorURLs'):
+            urls.extend(r['mirrorURLs'])
+        transfer.segmented = SegmentedDownload(self.fetcher, transfer.filePath, urls,
+                r['itemSize'], r.get('headers'), self.fetcher.numSegments, transfer.control)
+        transfer.slot = freeHandles.pop()
+        try:
+            transfer.segmented.start(multi)
+        except:
+            transfer.segmented.abort(multi)
+            freeHandles.append(transfer.slot)
+            raise
+        for curl in transfer.segmented.getHandles():
+            self.segmentTransfers[curl] = transfer
+
+    def finishSegment(self, multi, freeHandles, curl, errmsg):
+        transfer = self.segmentTransfers[curl]
+        if not transfer.segmented.finish(multi, curl, errmsg):
+            # Other segments are still running, or this one was restarted
+            return
+        for c in self.segmentTransfers.keys():
+            if self.segmentTransfers[c] is transfer:
+                del self.segmentTransfers[c]
+        freeHandles.append(transfer.slot)
+        r = transfer.request
+        try:
+            status = self.fetcher.checkSegmentedResult(transfer.segmented, r['itemSize'],
+                    r['hashtype'], r['checksum'])
+        except Exception, e:
+            tb_info = traceback.format_exc()
+            LOG.debug("%s" % (tb_info))
+            LOG.warn("Caught exception<%s> validating %s" % (e, transfer.filePath))
+            self.fetcher.setErrorClass(BaseFetch.ERROR_OTHER)
+            status = BaseFetch.STATUS_ERROR
+        if transfer.control is not None and transfer.control.cancelled:
+            status = BaseFetch.STATUS_CANCELLED
+        if status is None:
+            # Server doesn't do range requests, fetch it as a single stream
+            self.progress.removeWorker(transfer.name)
+            self.startTransfer(multi, freeHandles, Transfer(transfer.itemInfo, transfer.attempt,
+                    transfer.authRetried, False, transfer.control, transfer.host))
+            return
+        self.handleStatus(multi, freeHandles, transfer, status)
+
+    def finishTransfer(self, multi, freeHandles, curl, errno, errmsg):
+        if self.segmentTransfers.has_key(curl):
+            self.finishSegment(multi, freeHandles, curl, errmsg)
+            return
+        if not self.transfers.has_key(curl):
+            # Segment of a download aborted earlier in this batch of results
+            return
+        transfer = self.transfers.pop(curl)
+        multi.remove_handle(curl)
+        transfer.file.close()
+        r = transfer.request
+        if transfer.control is not None and transfer.control.cancelled:
+            LOG.info("Fetch of %s from %s cancelled" % (r['fileName'], r['fetchURL']))
+            if not transfer.control.keepsPartial():
+                transfer.file.discard()
+            status = BaseFetch.STATUS_CANCELLED
+        elif errno == pycurl.E_RANGE_ERROR and transfer.file.offset:
+            # Server doesn't do range requests, drop the part file and start over
+            LOG.info("Unable to resume %s, fetching it from the start" % (transfer.filePath))
+            transfer.file.discard()
+            freeHandles.append(curl)
+            self.progress.removeWorker(transfer.name)
+            self.startTransfer(multi, freeHandles, Transfer(transfer.itemInfo, transfer.attempt,
+                    transfer.authRetried, False, transfer.control, transfer.host))
+            return
+        elif errmsg:
+            LOG.warn("Caught error<%s> fetching %s" % (errmsg, r['fetchURL']))
+            self.fetcher.setErrorClass(getCurlErrorClass(errno))
+            status = BaseFetch.STATUS_ERROR
+        else:
+            try:
+                status = self.fetcher.checkFetchResult(curl.getinfo(curl.HTTP_CODE),
+                        transfer.file, r['fetchURL'], r['itemSize'], r['hashtype'], r['checksum'])
+            except Exception, e:
+                tb_info = traceback.format_exc()
+                LOG.debug("%s" % (tb_info))
+                LOG.warn("Caught exception<%s> validating %s" % (e, transfer.filePath))
+                self.fetcher.setErrorClass(BaseFetch.ERROR_OTHER)
+                status = BaseFetch.STATUS_ERROR
+        if status != BaseFetch.STATUS_CANCELLED:
+            transfer.file.finished(status)
+            self.fetcher.transferFinished(r['fetchURL'], status, curl)
+        freeHandles.append(curl)
+        self.handleStatus(multi, freeHandles, transfer, status)
+
+    def handleStatus(self, multi, freeHandles, transfer, status):
+        """
+        Records the outcome of a finished transfer, or schedules it again
+        """
+        self.progress.removeWorker(transfer.name)
+        if self.controller and transfer.request:
+            self.controller.recordStatus(status, time.time() - transfer.started,
+                    transfer.request['itemSize'])
+        if status == BaseFetch.STATUS_UNAUTHORIZED and not transfer.authRetried \
+                and hasattr(self.fetcher, "login"):
+            LOG.warn("Unauthorized request for %s.  Will attempt to update authentication credentials and retry" \
+                    % (transfer.request['fileName']))
+            self.fetcher.login(refresh=True)
+            self.startTransfer(multi, freeHandles,
+                    Transfer(transfer.itemInfo, transfer.attempt, True, control=transfer.control,
+                    host=transfer.host))
+            return
+        if self.hostLimiter:
+            self.hostLimiter.release(transfer.host)
+        if self.hedger:
+            status = self.hedger.finish(transfer.itemInfo, transfer.control, status)
+            if status is None:
+                return
+        if status == BaseFetch.STATUS_CANCELLED and transfer.control is not None and \
+                transfer.control.stopped:
+            # Abandoned by stop(), the item isn't done
+            LOG.debug("Fetch of %s stopped" % (transfer.itemInfo))
+            return
+        if status in BaseFetch.RETRY_STATUSES and \
+                self.retryQ.schedule(transfer.itemInfo, self.fetcher.getErrorClass(), transfer.attempt + 1):
+            return
+        self.recordStatus(transfer, status)
+
+    def recordStatus(self, transfer, status):
+        if status in self.syncStatusDict:
+            self.syncStatusDict[status] = self.syncStatusDict[status] + 1
+        else:
+            self.syncStatusDict[status] = 1
+        self.progress.itemFinished(getItemSize(self.fetcher, transfer.itemInfo),
+                status in BaseFetch.RETRY_STATUSES)
+        if self.priorities:
+            self.priorities.itemFinished(transfer.itemInfo)
+        notifyCompletion(self.completionListeners, transfer.itemInfo, status)
+        if status != BaseFetch.STATUS_ERROR:
+            self.syncCompleteQ.put(transfer.itemInfo)
+        else:
+            self.syncErrorQ.put(transfer.itemInfo)
@@ -21,8 +21,12 @@ LOG = logging.getLogger("grinder.PackageFetch")
 
 
 class PackageFetch(BaseFetch):
-    
-    def __init__(self, systemId, baseURL, channelLabel, savePath):
+    """
+    Fetches packages of channelLabel into savePath.  An item may name its
+    own 'channel_label' and 'save_path' instead, so one PackageFetch can
+    serve several channels.
+    """
+    def __init__(self, systemId, baseURL, channelLabel=None, savePath=None):
         BaseFetch.__init__(self)
         self.systemId = systemId
         self.baseURL = baseURL
@@ -40,19 +44,20 @@ class PackageFetch(BaseFetch):
     def getFetchURL(self, channelLabel, fetchName):
         return self.baseURL + "/SAT/$RHN/" + channelLabel + "/getPackage/" + fetchName;
 
+    def getFetchRequest(self, itemInfo):
+        channelLabel = itemInfo.get('channel_label', self.channelLabel)
+        fetchURL = self.getFetchURL(channelLabel, itemInfo['fetch_name'])
+        return {'fileName': itemInfo['filename'], 'fetchURL': fetchURL,
+                'itemSize': itemInfo['package_size'], 'hashtype': itemInfo['hashtype'],
+                'checksum': itemInfo['md5sum'], 'savePath': itemInfo.get('save_path', self.savePath),
+                'headers': self.login()}
+
     def fetchItem(self, itemInfo):
-        authMap = self.login()
-        fileName = itemInfo['filename']
-        fetchName = itemInfo['fetch_name']
-        itemSize = itemInfo['package_size']
-        md5sum = itemInfo['md5sum']
-        hashType = itemInfo['hashtype']
-        fetchURL = self.getFetchURL(self.channelLabel, fetchName)
-        status = self.fetch(fileName, fetchURL, itemSize, hashType, md5sum, self.savePath, headers=authMap)
+        status = self.fetch(**self.getFetchRequest(itemInfo))
         if status == BaseFetch.STATUS_UNAUTHORIZED:
             LOG.warn("Unauthorized request from fetch().  Will attempt to update authentication credentials and retry")
-            authMap = self.login(refresh=True)
-            return self.fetch(fileName, fetchURL, itemSize, md5sum, self.savePath, headers=authMap)
+            self.login(refresh=True)
+            return self.fetch(**self.getFetchRequest(itemInfo))
         return status
 
 if __name__ == "__main__":
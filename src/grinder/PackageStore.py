@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import os
+import errno
+import logging
+import threading
+
+LOG = logging.getLogger("grinder.PackageStore")
+
+STORE_DIRNAME = ".grinder-store"
+
+class PackageStore(object):
+    """
+    Content addressed store of downloaded files, kept as
+        storePath/<hashtype>/<first 2 chars of checksum>/<checksum>
+    Channel and repo directories hold hardlinks to these blobs, so a package
+    found in several channels is downloaded and stored once.  A blob nothing
+    links to any more has a link count of 1 and is removed by gc().
+    The store must be on the same filesystem as the directories linking to it.
+    """
+    def __init__(self, storePath):
+        self.storePath = storePath
+        self.lock = threading.Lock()
+
+    def getBlobPath(self, hashtype, checksum):
+        return os.path.join(self.storePath, hashtype, checksum[:2], checksum)
+
+    def hasBlob(self, hashtype, checksum):
+        return os.path.exists(self.getBlobPath(hashtype, checksum))
+
+    def isStored(self, filePath, hashtype, checksum):
+        """
+        Returns True if filePath is a link to the stored blob, same inode
+        """
+        try:
+            return os.path.samefile(filePath, self.getBlobPath(hashtype, checksum))
+        except OSError:
+            return False
+
+    def linkTo(self, filePath, hashtype, checksum):
+        """
+        Makes filePath a hardlink to the stored blob, replacing what is there.
+        Returns False if there is no such blob or the link can't be made.
+        """
+        blobPath = self.getBlobPath(hashtype, checksum)
+        if self.isStored(filePath, hashtype, checksum):
+            return True
+        try:
+            # Link under a temporary name first so filePath is replaced atomically
+            tmpPath = filePath + ".link"
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            os.link(blobPath, tmpPath)
+            os.rename(tmpPath, filePath)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                LOG.warn("Unable to link %s to %s: %s" % (filePath, blobPath, e))
+            return False
+        LOG.info("Linked %s from package store" % (filePath))
+        return True
+
+    def add(self, filePath, hashtype, checksum):
+        """
+        Adds the verified file at filePath to the store.  If another copy was
+        stored first, filePath is replaced with a link to that copy.
+        """
+        blobPath = self.getBlobPath(hashtype, checksum)
+        blobDir = os.path.dirname(blobPath)
+        self.lock.acquire()
+        try:
+            if not os.path.isdir(blobDir):
+                os.makedirs(blobDir)
+        finally:
+            self.lock.release()
+        try:
+            os.link(filePath, blobPath)
+            return
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                LOG.warn("Unable to add %s to package store: %s" % (filePath, e))
+                return
+        self.linkTo(filePath, hashtype, checksum)
+
+    def gc(self):
+        """
+        Removes blobs no channel or repo directory links to any more.
+        Returns (number of blobs removed, bytes freed)
+        """
+        numRemoved = 0
+        bytesFreed = 0
+        for dirPath, dirNames, fileNames in os.walk(self.storePath):
+            for f in fileNames:
+                blobPath = os.path.join(dirPath, f)
+                st = os.lstat(blobPath)
+                if st.st_nlink > 1:
+                    continue
+                LOG.debug("Removing unreferenced blob %s" % (blobPath))
+                os.remove(blobPath)
+                numRemoved += 1
+                bytesFreed += st.st_size
+        LOG.info("Removed %s unreferenced blobs, %s bytes, from %s" % \
+                (numRemoved, bytesFreed, self.storePath))
+        return (numRemoved, bytesFreed)
+
+def getPackageStore(basePath):
+    """
+    Returns the PackageStore kept under basePath
+    """
+    return PackageStore(os.path.join(basePath, STORE_DIRNAME))
@@ -15,71 +15,496 @@
 # granted to use or replicate Red Hat trademarks that are incorporated
 # in this software or its documentation.
 #
+import sys
 import time
+import heapq
 import logging
 import threading
+import traceback
 from threading import Thread
 import Queue
 
-from BaseFetch import BaseFetch
+from BaseFetch import BaseFetch, FetchControl
+from RetryQueue import RetryQueue
+from HedgeTracker import HedgeTracker
+from ConcurrencyControl import ConcurrencyController
+from HostLimiter import HostLimiter
+from FetchProgress import FetchProgress, WorkerState
 
 LOG = logging.getLogger("grinder.ParallelFetch")
 
+class EndOfItems(object):
+    def __reduce__(self):
+        # Unpickles as the same object, it crosses process boundaries in ProcessFetch
+        return "END_OF_ITEMS"
+
+# Put on the queue by close(), once per worker, after the last item
+END_OF_ITEMS = EndOfItems()
+
+# Items queued ahead of the workers by a producer streaming them in as it
+# reads them, see maxQueued
+STREAM_QUEUE_SIZE = 2000
+
+# The size of a dict item is worked out once, when it is added, and kept
+# in the item under this key, see storeItemSize()
+SIZE_KEY = "fetch_size"
+
+def getItemSize(fetcher, itemInfo):
+    """
+    Returns the size in bytes of itemInfo from the fetcher's
+    getFetchRequest(), or 0 if it isn't known
+    """
+    if isinstance(itemInfo, dict) and itemInfo.has_key(SIZE_KEY):
+        return itemInfo[SIZE_KEY]
+    try:
+        return int(fetcher.getFetchRequest(itemInfo)['itemSize'])
+    except Exception, e:
+        LOG.debug("Unable to get size of %s: %s" % (itemInfo, e))
+        return 0
+
+def storeItemSize(fetcher, itemInfo):
+    """
+    Returns the size of itemInfo, as getItemSize(), keeping it in a dict
+    item so the fetcher isn't asked again every time it is needed
+    """
+    size = getItemSize(fetcher, itemInfo)
+    if isinstance(itemInfo, dict):
+        itemInfo[SIZE_KEY] = size
+    return size
+
+def getItemHost(fetcher, itemInfo):
+    """
+    Returns the host the fetcher will fetch itemInfo from, see
+    BaseFetch.getItemHost(), or None if it isn't known
+    """
+    try:
+        return fetcher.getItemHost(itemInfo)
+    except Exception, e:
+        LOG.debug("Unable to get host of %s: %s" % (itemInfo, e))
+        return None
+
+class SizeOrderedQueue(Queue.Queue):
+    """
+    Queue handing out the largest item first, items of the same size in the
+    order they were added.  Fetching the largest items first keeps a big
+    item picked up last from holding up the end of a sync while the other
+    workers sit idle, the small items fill in around the big ones.
+    With getPriority items of a lower priority number come first, ordered
+    by size among themselves.  END_OF_ITEMS always comes last, and doesn't
+    count against maxsize so close() never waits for room.
+    """
+    def __init__(self, getSize, maxsize=0, getPriority=None):
+        """
+        getSize = function returning the size of an item
+        getPriority = function returning the priority number of an item,
+            e.g. PriorityClasses.getPriority()
+        """
+        self.getSize = getSize
+        self.getPriority = getPriority
+        Queue.Queue.__init__(self, maxsize)
+
+    def put(self, item, block=True, timeout=None):
+        # Sized here rather than in _put(), which runs holding the queue's lock
+        if item is END_OF_ITEMS:
+            self.mutex.acquire()
+            try:
+                self._put((sys.maxint, -1, item))
+                if hasattr(self, "unfinished_tasks"):
+                    self.unfinished_tasks += 1
+                self.not_empty.notify()
+            finally:
+                self.mutex.release()
+            return
+        key = self.getKey(item)
+        Queue.Queue.put(self, (key[0], -key[1], item), block, timeout)
+
+    def getKey(self, item):
+        """
+        Returns (priority, -size) of item, items are handed out lowest first
+        """
+        priority = 0
+        if self.getPriority:
+            priority = self.getPriority(item)
+        return (priority, -self.getSize(item))
+
+    def peekKey(self):
+        """
+        Returns getKey() of the next item to be handed out, None if there is none
+        """
+        self.mutex.acquire()
+        try:
+            return self._peekKey()
+        finally:
+            self.mutex.release()
+
+    def _peekKey(self):
+        if not self.queue or self.queue[0][3] is END_OF_ITEMS:
+            return None
+        return self.queue[0][:2]
+
+    def _init(self, maxsize):
+        self.maxsize = maxsize
+        self.queue = []
+        self.counter = 0
+
+    def _put(self, entry):
+        priority, size, item = entry
+        heapq.heappush(self.queue, (priority, -size, self.counter, item))
+        self.counter += 1
+
+    def _get(self):
+        return heapq.heappop(self.queue)[3]
+
+class FairQueue(SizeOrderedQueue):
+    """
+    SizeOrderedQueue sharing its items out fairly between groups, e.g. the
+    channels of a multi channel sync.  Of the groups whose next item has the
+    lowest priority number, the one handed the fewest bytes so far comes
+    next, in the group items come in the order of a SizeOrderedQueue.
+    A group becoming active starts level with the least served active group,
+    so a channel whose items come in late doesn't take over until it has
+    caught up.
+    """
+    def __init__(self, getSize, getGroup, maxsize=0, getPriority=None):
+        """
+        getGroup = function returning the group of an item
+        """
+        self.getGroup = getGroup
+        SizeOrderedQueue.__init__(self, getSize, maxsize, getPriority)
+
+    def _init(self, maxsize):
+        SizeOrderedQueue._init(self, maxsize)
+        # group -> heap of its items, as in SizeOrderedQueue
+        self.groups = {}
+        # group -> bytes handed out to it
+        self.served = {}
+        self.numItems = 0
+        self.numEnds = 0
+
+    def _qsize(self, len=len):
+        return self.numItems + self.numEnds
+
+    def _empty(self):
+        return not self._qsize()
+
+    def _full(self):
+        return self.maxsize > 0 and self._qsize() >= self.maxsize
+
+    def _put(self, entry):
+        priority, size, item = entry
+        if item is END_OF_ITEMS:
+            self.numEnds += 1
+            return
+        group = self.getGroup(item)
+        if not self.groups.has_key(group):
+            level = 0
+            if self.groups:
+                level = min([self.served[g] for g in self.groups.keys()])
+            self.served[group] = max(self.served.get(group, 0), level)
+            self.groups[group] = []
+        heapq.heappush(self.groups[group], (priority, -size, self.counter, item))
+        self.counter += 1
+        self.numItems += 1
+
+    def _pickGroup(self):
+        """
+        Returns the group whose item comes next, None if there are no items
+        """
+        best = None
+        for group, heap in self.groups.items():
+            key = (heap[0][0], self.served[group], heap[0][2])
+            if best is None or key < best[0]:
+                best = (key, group)
+        if best is None:
+            return None
+        return best[1]
+
+    def _peekKey(self):
+        group = self._pickGroup()
+        if group is None:
+            return None
+        return self.groups[group][0][:2]
+
+    def _get(self):
+        group = self._pickGroup()
+        if group is None:
+            self.numEnds -= 1
+            return END_OF_ITEMS
+        heap = self.groups[group]
+        priority, size, counter, item = heapq.heappop(heap)
+        if not heap:
+            del self.groups[group]
+        # Items of unknown size count for something, so their groups take turns
+        self.served[group] += max(-size, 1)
+        self.numItems -= 1
+        return item
+
+def createQueue(fetcher, scheduleBySize=True, priorities=None, maxQueued=0, getGroup=None):
+    """
+    Returns the queue a download engine hands its items out from, see
+    SizeOrderedQueue and FairQueue, or a plain FIFO if no option is used
+      maxQueued = most items queued at once, adding more waits for room
+      getGroup = function returning the group of an item, the groups get
+          a fair share of the fetches
+    """
+    if not scheduleBySize and priorities is None and not maxQueued and getGroup is None:
+        return Queue.Queue()
+    if scheduleBySize:
+        getSize = lambda itemInfo: getItemSize(fetcher, itemInfo)
+    else:
+        getSize = lambda itemInfo: 0
+    getPriority = None
+    if priorities is not None:
+        getPriority = priorities.getPriority
+    if getGroup is not None:
+        return FairQueue(getSize, getGroup, maxQueued, getPriority)
+    return SizeOrderedQueue(getSize, maxQueued, getPriority)
+
+def getQueueKey(queue, item):
+    """
+    Returns the key of item in the order queue hands items out in, see
+    SizeOrderedQueue.getKey(), () for a FIFO
+    """
+    if hasattr(queue, "getKey"):
+        return queue.getKey(item)
+    return ()
+
+def peekQueueKey(queue):
+    """
+    Returns the key of the next item queue hands out, None if there is
+    none or queue is a FIFO
+    """
+    if hasattr(queue, "peekKey"):
+        return queue.peekKey()
+    return None
+
+def putWhileRunning(queue, item, stopEvent):
+    """
+    Puts item on queue, waiting for room if it is bounded.  Returns False
+    without putting it if stopEvent is set first.  Waits in steps, an
+    untimed put can't be interrupted by a signal.
+    """
+    while not stopEvent.isSet():
+        try:
+            queue.put(item, True, 1.0)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def notifyCompletion(listeners, itemInfo, status):
+    """
+    Calls the completion listeners of an engine for an item done with, see
+    ParallelFetch.addCompletionListener()
+    """
+    for callback in listeners:
+        try:
+            callback(itemInfo, status)
+        except Exception, e:
+            tb_info = traceback.format_exc()
+            LOG.debug("%s" % (tb_info))
+            LOG.warn("Caught exception<%s> from completion listener %s" % (e, callback))
+
+def describeClass(completion):
+    """
+    Returns a description of one entry of PriorityClasses.getCompletion()
+    """
+    name, numDone, numAdded, lastDone = completion
+    s = "%s %s/%s" % (name, numDone, numAdded)
+    if lastDone is not None:
+        s += " done in %.1fs" % (lastDone)
+    return s
+
+def logClasses(report):
+    for completion in report.priorityClasses:
+        LOG.info("Priority class %s" % (describeClass(completion)))
+
 class SyncReport:
     def __init__(self):
         self.successes = 0
         self.downloads = 0
         self.errors = 0
+        # host -> list of the HTTP versions used with it
+        self.protocols = {}
+        # See PriorityClasses.getCompletion()
+        self.priorityClasses = []
     def __str__(self):
-        return "%s successes, %s downloads, %s errors" % (self.successes, self.downloads, self.errors)
+        s = "%s successes, %s downloads, %s errors" % (self.successes, self.downloads, self.errors)
+        if self.protocols:
+            hosts = self.protocols.keys()
+            hosts.sort()
+            s += ", protocols: %s" % (", ".join(["%s %s" % (h, "+".join(self.protocols[h])) \
+                    for h in hosts]))
+        if self.priorityClasses:
+            s += ", classes: %s" % (", ".join([describeClass(c) for c in self.priorityClasses]))
+        return s
+
+    def addStatusCounts(self, syncStatusDict):
+        """
+        Adds the per status item counts kept by a fetch worker to this report
+        """
+        self.successes = self.successes + syncStatusDict.get(BaseFetch.STATUS_DOWNLOADED, 0)
+        self.successes = self.successes + syncStatusDict.get(BaseFetch.STATUS_NOOP, 0)
+        self.downloads = self.downloads + syncStatusDict.get(BaseFetch.STATUS_DOWNLOADED, 0)
+        self.errors = self.errors + syncStatusDict.get(BaseFetch.STATUS_ERROR, 0)
+        self.errors = self.errors + syncStatusDict.get(BaseFetch.STATUS_MD5_MISSMATCH, 0)
+        self.errors = self.errors + syncStatusDict.get(BaseFetch.STATUS_SIZE_MISSMATCH, 0)
 
 class ParallelFetch(object):
-    def __init__(self, fetcher, numThreads=3):
-        self.toSyncQ = Queue.Queue()
+    def __init__(self, fetcher, numThreads=3, retryPolicies=None, hedgeFactor=0, scheduleBySize=True,
+            controller=None, hostLimiter=None, toSyncQ=None, priorities=None, maxQueued=0,
+            getGroup=None):
+        """
+        retryPolicies = dict of BaseFetch error class to RetryPolicy, defaults
+            to RetryQueue.DEFAULT_RETRY_POLICIES
+        hedgeFactor = once the queue is empty, send a second request for items
+            taking this many times longer than expected, 0 disables this.
+            The fetcher must implement getFetchRequest() and setFetchControl()
+        scheduleBySize = if True the largest items are fetched first, see
+            SizeOrderedQueue, otherwise items are fetched in the order added
+        controller = ConcurrencyController tuning how many of the workers
+            fetch at once, numThreads is then its maximum
+        hostLimiter = HostLimiter capping the fetches in flight to each host,
+            the fetcher must implement getItemHost()
+        toSyncQ = queue to take the items from instead of one of its own, e.g.
+            one shared with other processes by ProcessFetch.  Its producer
+            ends the workers by putting getNumConsumers() END_OF_ITEMS on it,
+            addItem() and close() aren't used.
+        priorities = PriorityClasses the items are fetched in the order of,
+            the report says when each class was done
+        maxQueued = most items waiting to be fetched, addItem() waits for
+            room beyond that.  Lets a producer stream items in as the workers
+            take them, at the cost of ordering only the items queued.
+        getGroup = function returning the group of an item, e.g. its channel,
+            the groups get a fair share of the fetches, see FairQueue
+        Items may be added before or after start(), until close() or
+        waitForFinish() is called.  Workers wait for more items until then.
+        Progress is reported through a FetchProgress, see addProgressListener().
+        """
+        self.closed = False
+        if toSyncQ is not None:
+            self.toSyncQ = toSyncQ
+            self.closed = True
+        else:
+            self.toSyncQ = createQueue(fetcher, scheduleBySize, priorities, maxQueued, getGroup)
+        self.priorities = priorities
+        self.completionListeners = []
         self.syncCompleteQ = Queue.Queue()
         self.syncErrorQ = Queue.Queue()
+        self.retryQ = RetryQueue(retryPolicies)
         self.threads = []
         self.numThreads = numThreads
+        self.controller = controller
+        if controller:
+            self.numThreads = controller.maximum
         self.fetcher = fetcher
+        self.hedger = None
+        if hedgeFactor and hasattr(fetcher, "setFetchControl"):
+            self.hedger = HedgeTracker(hedgeFactor)
+        self.progress = FetchProgress()
+        if hasattr(fetcher, "setProgress"):
+            fetcher.setProgress(self.progress)
+        if getattr(fetcher, "rateLimiter", None):
+            fetcher.rateLimiter.setTransfers(self.numThreads)
+        self._stop = threading.Event()
         for i in range(self.numThreads):
-            wt = WorkerThread(self.toSyncQ, self.syncCompleteQ, self.syncErrorQ, fetcher)
+            wt = WorkerThread(self.toSyncQ, self.syncCompleteQ, self.syncErrorQ, fetcher, self.retryQ,
+                    self.hedger, controller, hostLimiter, self.progress, priorities,
+                    self.completionListeners)
             self.threads.append(wt)
 
+    def getNumConsumers(self):
+        """
+        Returns how many END_OF_ITEMS it takes to end all the workers
+        """
+        return len(self.threads)
+
+    def getProgress(self):
+        """
+        Returns a ProgressSnapshot of the items and bytes done so far
+        """
+        return self.progress.getSnapshot()
+
+    def addProgressListener(self, callback, interval=FetchProgress.DEFAULT_INTERVAL):
+        """
+        callback = function called with a ProgressSnapshot every interval
+            seconds while the items are fetched, and once more at the end
+        """
+        self.progress.addListener(callback, interval)
+
+    def addCompletionListener(self, callback):
+        """
+        callback = function called with (itemInfo, status) as each item is
+            done with, retries included, from the worker which did it.
+            Add before start().
+        """
+        self.completionListeners.append(callback)
+
     def addItem(self, item):
-        self.toSyncQ.put(item)
+        """
+        Queues item, waiting for room if maxQueued is set.  Items added
+        once stop() is called are dropped.
+        """
+        if self._stop.isSet():
+            LOG.debug("Stopped, dropping %s" % (item))
+            return
+        if self.closed:
+            raise ValueError("Items can't be added after close()")
+        self.progress.itemAdded(storeItemSize(self.fetcher, item))
+        if self.priorities:
+            self.priorities.itemAdded(item)
+        putWhileRunning(self.toSyncQ, item, self._stop)
 
     def addItemList(self, items):
         for p in items:
-            self.toSyncQ.put(p)
+            self.addItem(p)
 
     def start(self):
+        self.progress.start()
         for t in self.threads:
             t.start()
 
-    def stop(self):
+    def close(self):
+        """
+        Signals no more items will be added, the workers end once the items
+        queued, and their retries, are done
+        """
+        if self.closed:
+            return
+        self.closed = True
         for t in self.threads:
-            t.stop()
+            self.toSyncQ.put(END_OF_ITEMS)
 
-    def _running(self):
-        working = 0
+    def stop(self):
+        """
+        Ends the workers without waiting for the items queued.  Fetches in
+        progress are aborted from curl's write and progress callbacks, and
+        their partial downloads kept to resume from.  Items abandoned aren't
+        reported as done.
+        """
+        self._stop.set()
         for t in self.threads:
-            if (t.isAlive()):
-                working += 1
-        return (working > 0)
+            t.stop()
+        # Wakes workers waiting for items
+        self.close()
 
     def _waitForThreads(self):
-        while (self._running()):
-            LOG.debug("Wait 1.  check again")
-            time.sleep(0.5)
+        for t in self.threads:
+            # Joined with a timeout so signal handlers still run, an untimed
+            # join can't be interrupted
+            while t.isAlive():
+                t.join(1.0)
 
     def waitForFinish(self):
         """
-        Will wait for all worker threads to finish
+        Closes the queue, see close(), and waits for all worker threads to finish
         Returns (successList, errorList)
          successList is a list of all items successfully synced
          errorList is a list of all items which couldn't be synced
         """
+        self.close()
         self._waitForThreads()
+        self.progress.finish()
 
         LOG.info("All threads have finished.")
         successList = []
@@ -92,12 +517,12 @@ class ParallelFetch(object):
             errorList.append(p)
         report = SyncReport()
         for t in self.threads:
-            report.successes = report.successes + t.syncStatusDict[BaseFetch.STATUS_DOWNLOADED]
-            report.successes = report.successes + t.syncStatusDict[BaseFetch.STATUS_NOOP]
-            report.downloads = report.downloads + t.syncStatusDict[BaseFetch.STATUS_DOWNLOADED]
-            report.errors = report.errors + t.syncStatusDict[BaseFetch.STATUS_ERROR]
-            report.errors = report.errors + t.syncStatusDict[BaseFetch.STATUS_MD5_MISSMATCH]
-            report.errors = report.errors + t.syncStatusDict[BaseFetch.STATUS_SIZE_MISSMATCH]
+            report.addStatusCounts(t.syncStatusDict)
+        if hasattr(self.fetcher, "getProtocols"):
+            report.protocols = self.fetcher.getProtocols()
+        if self.priorities:
+            report.priorityClasses = self.priorities.getCompletion()
+            logClasses(report)
 
         LOG.info("ParallelFetch: %s items successfully processed, %s downloaded, %s items had errors" %
             (report.successes, report.downloads, report.errors))
@@ -105,11 +530,81 @@ class ParallelFetch(object):
         return report
 
 
+def createParallelFetch(fetcher, numThreads, engine="threads", hedgeFactor=0, minThreads=0, maxThreads=0,
+        maxPerHost=0, hostLimits=None, numProcesses=0, toSyncQ=None, priorities=None, maxQueued=0,
+        getGroup=None):
+    """
+    Returns the download engine to sync items with, both have the same interface.
+      engine = 'threads' for a ParallelFetch running numThreads worker threads,
+               'multi' for a MultiFetch driving numThreads concurrent transfers
+               from a single thread
+      hedgeFactor = see ParallelFetch
+      minThreads, maxThreads = if maxThreads is set, the number of concurrent
+               fetches starts at numThreads and is tuned between these from
+               the throughput achieved, see ConcurrencyController
+      maxPerHost = most fetches in flight to one host, 0 for no limit
+      hostLimits = dict of host to its own limit, overriding maxPerHost
+      numProcesses = if more than 1, a ProcessFetch spreading the items over
+               this many processes, each running an engine with its share
+               of the fetches and limits
+      toSyncQ = queue the engine takes its items from, see ParallelFetch
+      priorities = PriorityClasses to fetch the items in the order of
+      maxQueued = most items waiting to be fetched, see ParallelFetch
+      getGroup = function returning the group of an item, see ParallelFetch
+    """
+    if numProcesses > 1:
+        from ProcessFetch import ProcessFetch, PROCESSES_AVAILABLE
+        if PROCESSES_AVAILABLE:
+            def share(value):
+                # Rounded up, so each process can run at least one fetch
+                return (value + numProcesses - 1) / numProcesses
+            perHostLimits = None
+            if hostLimits:
+                perHostLimits = {}
+                for host, limit in hostLimits.items():
+                    perHostLimits[host] = share(limit)
+            def createEngine(sharedQ):
+                return createParallelFetch(fetcher, share(numThreads), engine, hedgeFactor,
+                        share(minThreads), share(maxThreads), share(maxPerHost), perHostLimits,
+                        toSyncQ=sharedQ, priorities=priorities)
+            return ProcessFetch(fetcher, numProcesses, createEngine, priorities=priorities,
+                    maxQueued=maxQueued, getGroup=getGroup)
+        LOG.warn("multiprocessing is not available, fetching from a single process")
+    controller = None
+    if maxThreads:
+        controller = ConcurrencyController(numThreads, minThreads, maxThreads)
+    hostLimiter = None
+    if maxPerHost or hostLimits:
+        hostLimiter = HostLimiter(maxPerHost, hostLimits)
+    if engine == "multi":
+        from MultiFetch import MultiFetch
+        return MultiFetch(fetcher, numThreads, hedgeFactor=hedgeFactor, controller=controller,
+                hostLimiter=hostLimiter, toSyncQ=toSyncQ, priorities=priorities, maxQueued=maxQueued,
+                getGroup=getGroup)
+    return ParallelFetch(fetcher, numThreads, hedgeFactor=hedgeFactor, controller=controller,
+            hostLimiter=hostLimiter, toSyncQ=toSyncQ, priorities=priorities, maxQueued=maxQueued,
+            getGroup=getGroup)
+
+
 class WorkerThread(Thread):
 
-    def __init__(self, toSyncQ, syncCompleteQ, syncErrorQ, fetcher):
+    def __init__(self, toSyncQ, syncCompleteQ, syncErrorQ, fetcher, retryQ=None, hedger=None,
+            controller=None, hostLimiter=None, progress=None, priorities=None, completionListeners=None):
         Thread.__init__(self)
+        if retryQ is None:
+            retryQ = RetryQueue()
+        if progress is None:
+            progress = FetchProgress()
         self.toSyncQ = toSyncQ
+        self.retryQ = retryQ
+        self.hedger = hedger
+        self.controller = controller
+        self.hostLimiter = hostLimiter
+        self.progress = progress
+        self.priorities = priorities
+        if completionListeners is None:
+            completionListeners = []
+        self.completionListeners = completionListeners
         self.syncCompleteQ = syncCompleteQ
         self.syncErrorQ = syncErrorQ
         self.fetcher = fetcher
@@ -120,27 +615,214 @@ class WorkerThread(Thread):
         self.syncStatusDict[BaseFetch.STATUS_MD5_MISSMATCH] = 0
         self.syncStatusDict[BaseFetch.STATUS_ERROR] = 0
         self._stop = threading.Event()
+        # Set once this worker has taken its END_OF_ITEMS off the queue
+        self.ended = False
+        # FetchControl of the fetch in progress, if any
+        self.control = None
 
     def stop(self):
+        """
+        Ends the worker, a fetch in progress is aborted and its partial
+        download kept to be resumed from later
+        """
         self._stop.set()
+        control = self.control
+        if control is not None:
+            control.stop()
+        if self.hostLimiter:
+            self.hostLimiter.wake()
 
-    def run(self):
-        LOG.debug("Run has started")
-        while not self.toSyncQ.empty() and not self._stop.isSet():
-            LOG.info("%s items left on Queue" % (self.toSyncQ.qsize()))
+    def admit(self, work):
+        """
+        Returns work, (itemInfo, attempt, control), with the host of the item
+        appended once it is acquired from the HostLimiter.  Returns None if the
+        host is at its limit, the item is then deferred.
+        """
+        itemInfo, attempt, control = work
+        if self.hostLimiter is None:
+            return work + (None,)
+        host = getItemHost(self.fetcher, itemInfo)
+        if control is not None:
+            # A hedged request isn't held back, its item is late already
+            self.hostLimiter.acquire(host)
+        elif not self.hostLimiter.tryAcquire(host):
+            self.hostLimiter.defer(host, work, getQueueKey(self.toSyncQ, itemInfo))
+            return None
+        return work + (host,)
+
+    def getDeferred(self, timeout=0):
+        """
+        Returns (itemInfo, attempt, control, host) for a deferred item whose
+        host has room, or None, see HostLimiter.getDeferred()
+        """
+        limitKey = None
+        if not self.hostLimiter.isFull():
+            # An item queued since, and ahead of the deferred ones, comes first
+            limitKey = peekQueueKey(self.toSyncQ)
+        deferred = self.hostLimiter.getDeferred(limitKey, timeout)
+        if deferred is None:
+            return None
+        host, work = deferred
+        return work + (host,)
+
+    def getNextItem(self):
+        """
+        Returns (itemInfo, attempt, control, host) for the next item to fetch,
+        deferred items whose host has room again come first, unless the queue
+        has an item ahead of them, then items due for a retry.  control is the
+        FetchControl of a hedged request, otherwise None.  host is the host
+        acquired from the HostLimiter, if any.
+        Waits for more items, a pending retry, or a slow item to hedge, if
+        there is nothing else to do.  While the HostLimiter holds as many
+        deferred items as it takes, waits for one of their hosts to have room
+        instead of taking more items.
+        Returns None when there is no work left.  Items still deferred then are
+        left to the workers fetching from their hosts.
+        """
+        while not self._stop.isSet():
+            full = False
+            if self.hostLimiter:
+                work = self.getDeferred()
+                if work:
+                    return work
+                full = self.hostLimiter.isFull()
+            retry = self.retryQ.getReady()
+            if retry:
+                work = self.admit((retry[0], retry[1], None))
+                if work:
+                    return work
+                continue
+            if not self.ended and not full:
+                try:
+                    itemInfo = self.toSyncQ.get_nowait()
+                    if itemInfo is not END_OF_ITEMS:
+                        work = self.admit((itemInfo, 0, None))
+                        if work:
+                            return work
+                        continue
+                    self.ended = True
+                except Queue.Empty:
+                    pass
+            if self.hedger:
+                hedge = self.hedger.getHedge()
+                if hedge:
+                    return self.admit(hedge)
+            wait = self.retryQ.timeUntilReady()
+            if self.hedger and self.hedger.hasHedgeable():
+                # Check again for a slow item to hedge
+                wait = min(wait or 1.0, 1.0)
+            if self.ended:
+                if wait is None:
+                    LOG.debug("No items left, thread will end")
+                    return None
+                self._stop.wait(wait)
+                continue
+            if full:
+                # Sleep until a host has room, or stop() wakes us
+                work = self.getDeferred(wait)
+                if work:
+                    return work
+                continue
+            # Sleep until an item is added, stop() and close() wake us with END_OF_ITEMS
             try:
-                itemInfo = self.toSyncQ.get_nowait()
-                status = self.fetcher.fetchItem(itemInfo)
-                if status in self.syncStatusDict:
-                    self.syncStatusDict[status] = self.syncStatusDict[status] + 1
-                else:
-                    self.syncStatusDict[status] = 1
-                if status != BaseFetch.STATUS_ERROR:
-                    self.syncCompleteQ.put(itemInfo)
+                if wait is None:
+                    itemInfo = self.toSyncQ.get()
                 else:
-                    self.syncErrorQ.put(itemInfo)
+                    itemInfo = self.toSyncQ.get(True, wait)
             except Queue.Empty:
-                LOG.debug("Queue is empty, thread will end")
+                continue
+            if itemInfo is END_OF_ITEMS:
+                self.ended = True
+                continue
+            work = self.admit((itemInfo, 0, None))
+            if work:
+                return work
+        return None
+
+    def fetchNext(self):
+        """
+        Fetches the next item, returns False when there is no work left
+        """
+        work = self.getNextItem()
+        if work is None:
+            return False
+        itemInfo, attempt, control, host = work
+        LOG.info("%s items left on Queue, %s waiting to be retried" % \
+                (self.toSyncQ.qsize(), len(self.retryQ)))
+        self.progress.setWorkerState(self.getName(), WorkerState.FETCHING, itemInfo, host)
+        if self.hedger:
+            if control is None:
+                control = self.hedger.start(itemInfo, getItemSize(self.fetcher, itemInfo), attempt)
+        elif hasattr(self.fetcher, "setFetchControl"):
+            # Lets stop() abort the transfer
+            control = FetchControl()
+        if control is not None:
+            self.fetcher.setFetchControl(control)
+            self.control = control
+            if self._stop.isSet():
+                control.stop()
+        started = time.time()
+        try:
+            status = self.fetcher.fetchItem(itemInfo)
+        finally:
+            self.control = None
+            if control is not None:
+                self.fetcher.setFetchControl(None)
+            if self.hostLimiter:
+                self.hostLimiter.release(host)
+            self.progress.setWorkerState(self.getName(), WorkerState.IDLE)
+        if self.controller:
+            self.controller.recordStatus(status, time.time() - started, getItemSize(self.fetcher, itemInfo))
+        if self.hedger:
+            status = self.hedger.finish(itemInfo, control, status)
+            if status is None:
+                return True
+        if status == BaseFetch.STATUS_CANCELLED and control is not None and control.stopped:
+            # Abandoned by stop(), the item isn't done
+            LOG.debug("Fetch of %s stopped" % (itemInfo))
+            return False
+        if status in BaseFetch.RETRY_STATUSES:
+            errorClass = BaseFetch.ERROR_OTHER
+            if hasattr(self.fetcher, "getErrorClass"):
+                errorClass = self.fetcher.getErrorClass()
+            if self.retryQ.schedule(itemInfo, errorClass, attempt + 1):
+                return True
+        if status in self.syncStatusDict:
+            self.syncStatusDict[status] = self.syncStatusDict[status] + 1
+        else:
+            self.syncStatusDict[status] = 1
+        self.progress.itemFinished(getItemSize(self.fetcher, itemInfo),
+                status in BaseFetch.RETRY_STATUSES)
+        if self.priorities:
+            self.priorities.itemFinished(itemInfo)
+        notifyCompletion(self.completionListeners, itemInfo, status)
+        if status != BaseFetch.STATUS_ERROR:
+            self.syncCompleteQ.put(itemInfo)
+        else:
+            self.syncErrorQ.put(itemInfo)
+        return True
+
+    def run(self):
+        LOG.debug("Run has started")
+        self.progress.setWorkerState(self.getName(), WorkerState.IDLE)
+        while not self._stop.isSet():
+            if self.controller is None:
+                if not self.fetchNext():
+                    break
+                continue
+            # Only as many workers as the controller allows fetch at once
+            if not self.controller.acquire(self._stop):
+                break
+            try:
+                more = self.fetchNext()
+            finally:
+                self.controller.release()
+            if not more:
+                break
+        if hasattr(self.fetcher, "closeCurl"):
+            # Release this thread's persistent connection
+            self.fetcher.closeCurl()
+        self.progress.setWorkerState(self.getName(), WorkerState.ENDED)
         LOG.debug("Thread ending")
 
 
@@ -167,3 +849,37 @@ if __name__ == "__main__":
     print "Error: ", report.errors
     assert(report.successes == numPkgs)
 
+
+    # Benchmark of fetching the largest items first against fetching them in
+    # the order given.  Fetches are simulated by sleeping as long as the item
+    # would take at 100MB/s, a couple of big items come last in the list as
+    # they may in pkgInfo.values()
+    import random
+    class SizedFetcher(object):
+        RATE = 100 * 1024 * 1024
+        def getFetchRequest(self, itemInfo):
+            return {'itemSize': itemInfo['size']}
+        def fetchItem(self, itemInfo):
+            time.sleep(float(itemInfo['size']) / SizedFetcher.RATE)
+            return BaseFetch.STATUS_DOWNLOADED
+
+    random.seed(0)
+    items = []
+    for i in range(150):
+        items.append({'size': random.randint(1, 10) * 1024 * 1024})
+    items.append({'size': 250 * 1024 * 1024})
+    items.append({'size': 250 * 1024 * 1024})
+    numThreads = 4
+    totalTime = 0
+    for item in items:
+        totalTime += float(item['size']) / SizedFetcher.RATE
+    print "%s items, %.2f seconds of fetching over %s threads, %.2f seconds at best" % \
+            (len(items), totalTime, numThreads, totalTime / numThreads)
+    for scheduleBySize in [False, True]:
+        pf = ParallelFetch(SizedFetcher(), numThreads, scheduleBySize=scheduleBySize)
+        pf.addItemList(items)
+        start = time.time()
+        pf.start()
+        report = pf.waitForFinish()
+        assert(report.successes == len(items))
+        print "scheduleBySize=%s: %.2f seconds" % (scheduleBySize, time.time() - start)
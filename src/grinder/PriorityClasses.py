@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import os
+import gzip
+import time
+import logging
+import threading
+try:
+    from cElementTree import iterparse
+except:
+    from xml.etree.cElementTree import iterparse
+import rpmUtils.miscutils
+
+LOG = logging.getLogger("grinder.PriorityClasses")
+
+# Package priority classes
+# The newest build of each name.arch
+NEWEST = 'newest'
+# Packages of a security erratum in the channel's updateinfo
+SECURITY = 'security'
+# Everything else
+OLDER = 'older'
+DEFAULT_PRIORITY_CLASSES = [NEWEST, SECURITY, OLDER]
+
+class PriorityClasses(object):
+    """
+    Sorts items into classes which are fetched one after the other, e.g.
+    the newest build of every package before the older builds, and keeps
+    track of when each class was done.  An item is in the first class whose
+    test it passes, a class without a test takes every item reaching it.
+    Items in none of the classes come last.
+    The class of an item is worked out once, when it is added, and kept in
+    a dict item under CLASS_KEY, so it can't change while the item is queued
+    or fetched, e.g. in another process.  The class of another item is kept
+    in self.classes until it is finished.  Tests may depend on the items
+    added before, seen by the added functions.
+    """
+    CLASS_KEY = "priority_class"
+
+    def __init__(self, names, tests, added=None):
+        """
+        names = the class names, in the order their items are fetched
+        tests = dict of class name to a function returning True if an item
+            is in the class
+        added = list of functions called with every item added, before it
+            is classified, e.g. to track the newest build added so far
+        """
+        self.names = names
+        self.tests = tests
+        self.added = added or []
+        # item -> index of its class, for items that aren't dicts
+        self.classes = {}
+        self.started = time.time()
+        # Per class, and one for the unclassified items
+        self.numAdded = [0] * (len(names) + 1)
+        self.numDone = [0] * (len(names) + 1)
+        # Seconds after started the last item of the class was done
+        self.lastDone = [None] * (len(names) + 1)
+        self.lock = threading.Lock()
+
+    def getPriority(self, itemInfo):
+        """
+        Returns the index of the class of itemInfo, lower is fetched first
+        """
+        if isinstance(itemInfo, dict):
+            index = itemInfo.get(PriorityClasses.CLASS_KEY)
+        else:
+            try:
+                index = self.classes.get(itemInfo)
+            except TypeError:
+                # Not hashable
+                index = None
+        if index is None:
+            index = self.classify(itemInfo)
+        return index
+
+    def classify(self, itemInfo):
+        for index in range(len(self.names)):
+            test = self.tests.get(self.names[index])
+            if test is None or test(itemInfo):
+                return index
+        return len(self.names)
+
+    def getName(self, index):
+        if index < len(self.names):
+            return self.names[index]
+        return "unclassified"
+
+    def noteAdded(self, itemInfo):
+        """
+        Calls the added functions with itemInfo
+        """
+        for added in self.added:
+            added(itemInfo)
+
+    def itemAdded(self, itemInfo):
+        self.noteAdded(itemInfo)
+        index = self.classify(itemInfo)
+        if isinstance(itemInfo, dict):
+            itemInfo[PriorityClasses.CLASS_KEY] = index
+        self.lock.acquire()
+        try:
+            if not isinstance(itemInfo, dict):
+                try:
+                    self.classes[itemInfo] = index
+                except TypeError:
+                    pass
+            self.numAdded[index] += 1
+        finally:
+            self.lock.release()
+
+    def itemFinished(self, itemInfo):
+        index = self.getPriority(itemInfo)
+        self.lock.acquire()
+        try:
+            if not isinstance(itemInfo, dict):
+                try:
+                    self.classes.pop(itemInfo, None)
+                except TypeError:
+                    pass
+            self.numDone[index] += 1
+            self.lastDone[index] = time.time() - self.started
+        finally:
+            self.lock.release()
+
+    def getCompletion(self):
+        """
+        Returns list of (class name, items done, items added, seconds until
+        the last item done) for the classes items were added to or done in
+        """
+        self.lock.acquire()
+        try:
+            completion = []
+            for index in range(len(self.names) + 1):
+                if self.numAdded[index] or self.numDone[index]:
+                    completion.append((self.getName(index), self.numDone[index],
+                            self.numAdded[index], self.lastDone[index]))
+            return completion
+        finally:
+            self.lock.release()
+
+    def merge(self, completion):
+        """
+        Adds the items done elsewhere, completion as returned by getCompletion()
+        of a copy of this instance, e.g. in a ProcessFetch worker process
+        """
+        self.lock.acquire()
+        try:
+            for name, numDone, numAdded, lastDone in completion:
+                if name in self.names:
+                    index = self.names.index(name)
+                else:
+                    index = len(self.names)
+                self.numDone[index] += numDone
+                if lastDone is not None and (self.lastDone[index] is None or lastDone > self.lastDone[index]):
+                    self.lastDone[index] = lastDone
+        finally:
+            self.lock.release()
+
+def packageKey(info):
+    """
+    Returns (name, epoch, version, release, arch) of a package dict, with
+    a missing epoch as "0"
+    """
+    return (info.get("name"), info.get("epoch") or "0", info.get("version"), info.get("release"),
+            info.get("arch"))
+
+def getSecurityPackages(updateinfoPath):
+    """
+    Returns the set of packageKey()s in the security errata of an
+    updateinfo.xml, which may be gzipped
+    """
+    packages = {}
+    if updateinfoPath.endswith(".gz"):
+        f = gzip.open(updateinfoPath)
+    else:
+        f = open(updateinfoPath)
+    security = False
+    try:
+        for event, elem in iterparse(f, events=("start", "end")):
+            if elem.tag == "update":
+                if event == "start":
+                    security = elem.get("type") == "security"
+                else:
+                    elem.clear()
+            elif elem.tag == "package" and event == "end" and security:
+                packages[packageKey(elem.attrib)] = 1
+    finally:
+        f.close()
+    return packages
+
+def isNewer(key, otherKey):
+    """
+    Returns True if packageKey() key is a newer build than otherKey
+    """
+    return rpmUtils.miscutils.compareEVR(key[1:4], otherKey[1:4]) > 0
+
+def createPackagePriorities(names, packages=None, updateinfoPath=None):
+    """
+    Returns PriorityClasses for package dicts with 'name', 'epoch',
+    'version', 'release' and 'arch', or None if names is empty
+      names = class names, see DEFAULT_PRIORITY_CLASSES
+      packages = the packages to be fetched, newest is worked out from these.
+          None if they are streamed in as they are read, a package is then
+          newest if no newer build of it was added before, so they should
+          be added newest first.
+      updateinfoPath = updateinfo.xml(.gz) the security errata are read from
+    """
+    if not names:
+        return None
+    tests = {}
+    added = []
+    for name in names:
+        if name not in DEFAULT_PRIORITY_CLASSES:
+            LOG.warn("Unknown priority class '%s', it takes every package reaching it" % (name))
+    if NEWEST in names and packages is None:
+        # name.arch -> packageKey() of the newest build added so far
+        newestSoFar = {}
+        # packageKey() -> True if no newer build was added before it
+        newestWhenAdded = {}
+        def packageAdded(info):
+            # Every package counts, whichever class it ends up in
+            if not info.get("name"):
+                return
+            key = (info["name"], info["arch"])
+            pkgKey = packageKey(info)
+            other = newestSoFar.get(key)
+            isNewest = other is None or isNewer(pkgKey, other)
+            if isNewest:
+                newestSoFar[key] = pkgKey
+            newestWhenAdded.setdefault(pkgKey, isNewest)
+        added.append(packageAdded)
+        tests[NEWEST] = lambda info: newestWhenAdded.get(packageKey(info), False)
+    elif NEWEST in names:
+        newest = {}
+        for info in packages:
+            if not info.get("name"):
+                # e.g. a delta rpm
+                continue
+            key = (info["name"], info["arch"])
+            other = newest.get(key)
+            if other is None or isNewer(packageKey(info), packageKey(other)):
+                newest[key] = info
+        newestKeys = {}
+        for info in newest.values():
+            newestKeys[packageKey(info)] = 1
+        tests[NEWEST] = lambda info: newestKeys.has_key(packageKey(info))
+    if SECURITY in names:
+        securityKeys = {}
+        if updateinfoPath and os.path.exists(updateinfoPath):
+            try:
+                securityKeys = getSecurityPackages(updateinfoPath)
+            except Exception, e:
+                LOG.warn("Unable to read security errata from %s: %s" % (updateinfoPath, e))
+        else:
+            LOG.info("No updateinfo, no packages are prioritized as security updates")
+        tests[SECURITY] = lambda info: securityKeys.has_key(packageKey(info))
+    return PriorityClasses(names, tests, added)
+
+def createGroupPriorities(names, groupPriorities, getGroup):
+    """
+    Returns PriorityClasses for items of several groups, e.g. channels, each
+    classified by the PriorityClasses of its group, or None if names is empty
+      names = class names, the same for every group
+      groupPriorities = dict of group to its PriorityClasses, groups may be
+          added until their first item is
+      getGroup = function returning the group of an item
+    """
+    if not names:
+        return None
+    tests = {}
+    for name in names:
+        def test(itemInfo, name=name):
+            groupTest = groupPriorities[getGroup(itemInfo)].tests.get(name)
+            return groupTest is None or groupTest(itemInfo)
+        tests[name] = test
+    def itemAdded(itemInfo):
+        groupPriorities[getGroup(itemInfo)].noteAdded(itemInfo)
+    return PriorityClasses(names, tests, [itemAdded])
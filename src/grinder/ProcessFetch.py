@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import time
+import signal
+import logging
+import threading
+import traceback
+from threading import Thread
+import Queue
+try:
+    import multiprocessing
+    PROCESSES_AVAILABLE = True
+except ImportError:
+    # python < 2.6
+    PROCESSES_AVAILABLE = False
+
+from ParallelFetch import SyncReport, END_OF_ITEMS, getItemSize, storeItemSize, createQueue, \
+        putWhileRunning, notifyCompletion, logClasses
+from FetchProgress import FetchProgress
+
+LOG = logging.getLogger("grinder.ProcessFetch")
+
+class ProcessProgress(FetchProgress):
+    """
+    FetchProgress of a ProcessFetch, adds up the snapshots the worker
+    processes send.  The items and bytes to do are counted as they are added.
+    """
+    def __init__(self):
+        FetchProgress.__init__(self)
+        # index of the process -> its last ProgressSnapshot
+        self.processSnapshots = {}
+
+    def update(self, index, snapshot):
+        for w in snapshot.workers:
+            w.name = "process-%s %s" % (index, w.name)
+        self.lock.acquire()
+        try:
+            self.processSnapshots[index] = snapshot
+        finally:
+            self.lock.release()
+
+    def fillSnapshot(self, s, now):
+        s.itemsTotal = self.itemsTotal
+        s.bytesTotal = self.bytesTotal
+        indexes = self.processSnapshots.keys()
+        indexes.sort()
+        for index in indexes:
+            p = self.processSnapshots[index]
+            s.itemsDone += p.itemsDone
+            s.itemsFailed += p.itemsFailed
+            s.bytesDone += p.bytesDone
+            s.bytesReceived += p.bytesReceived
+            s.bytesPerSec += p.bytesPerSec
+            s.workers.extend(p.workers)
+
+class ProcessFetch(object):
+    """
+    Download engine spreading the items over numProcesses worker processes,
+    each running its own ParallelFetch or MultiFetch, so checksumming and
+    the per item bookkeeping aren't serialized by one interpreter lock.
+    Items are handed to the processes through a short shared queue as they
+    ask for them, the largest first, and their results merged into one
+    SyncReport.  The processes are forked, each gets its own connections.
+    Same interface as ParallelFetch.
+    """
+    # Items queued for the processes beyond the one each is waiting for
+    PREFETCH = 2
+    # Seconds between the progress snapshots each process sends
+    PROGRESS_INTERVAL = 1.0
+
+    def __init__(self, fetcher, numProcesses, createEngine, scheduleBySize=True, priorities=None,
+            maxQueued=0, getGroup=None):
+        """
+        createEngine = function returning the download engine a process runs,
+            called in the process with the queue to take items from
+        priorities = PriorityClasses the engines created are given too
+        maxQueued = most items waiting to be handed to the processes, see
+            ParallelFetch
+        getGroup = function returning the group of an item, the groups get
+            a fair share of the items handed to the processes
+        """
+        self.toSyncQ = createQueue(fetcher, scheduleBySize, priorities, maxQueued, getGroup)
+        self.priorities = priorities
+        self.completionListeners = []
+        self.syncCompleteQ = Queue.Queue()
+        self.syncErrorQ = Queue.Queue()
+        self.fetcher = fetcher
+        self.numProcesses = numProcesses
+        self.createEngine = createEngine
+        self.sharedQ = multiprocessing.Queue(numProcesses * (1 + ProcessFetch.PREFETCH))
+        self.resultQ = multiprocessing.Queue()
+        # Tells the processes to stop
+        self.stopEvent = multiprocessing.Event()
+        self._stop = threading.Event()
+        self.processes = []
+        for i in range(numProcesses):
+            self.processes.append(multiprocessing.Process(target=self.runProcess, args=(i,),
+                    name="ProcessFetch-%s" % (i)))
+        self.progress = ProcessProgress()
+        self.closed = False
+        # index of a process -> how many END_OF_ITEMS its engine needs
+        self.numConsumers = {}
+        self.reports = {}
+        self.lock = threading.Lock()
+        self.started = threading.Event()
+        self.feeder = Thread(target=self.feed, name="ProcessFetch-feeder")
+        self.collector = Thread(target=self.collect, name="ProcessFetch-collector")
+
+    def getProgress(self):
+        return self.progress.getSnapshot()
+
+    def addProgressListener(self, callback, interval=FetchProgress.DEFAULT_INTERVAL):
+        """
+        See ParallelFetch.addProgressListener(), workers are named after
+        the process running them
+        """
+        self.progress.addListener(callback, interval)
+
+    def addCompletionListener(self, callback):
+        """
+        See ParallelFetch.addCompletionListener(), the processes report each
+        item as it is done and callback is called from a thread of this one
+        """
+        self.completionListeners.append(callback)
+
+    def addItem(self, item):
+        """
+        See ParallelFetch.addItem()
+        """
+        if self._stop.isSet():
+            LOG.debug("Stopped, dropping %s" % (item))
+            return
+        if self.closed:
+            raise ValueError("Items can't be added after close()")
+        self.progress.itemAdded(storeItemSize(self.fetcher, item))
+        if self.priorities:
+            self.priorities.itemAdded(item)
+        putWhileRunning(self.toSyncQ, item, self._stop)
+
+    def addItemList(self, items):
+        for p in items:
+            self.addItem(p)
+
+    def start(self):
+        # Forked before this engine's threads, the progress reporter included,
+        # run, so none of them holds a lock the processes get a copy of.  The
+        # caller's own threads should be started after this.
+        for p in self.processes:
+            p.start()
+        self.progress.start()
+        self.feeder.start()
+        self.collector.start()
+
+    def close(self):
+        """
+        Signals no more items will be added, see ParallelFetch.close()
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.toSyncQ.put(END_OF_ITEMS)
+
+    def stop(self):
+        self._stop.set()
+        self.stopEvent.set()
+        self.close()
+
+    def isAnyAlive(self):
+        for p in self.processes:
+            if p.is_alive():
+                return True
+        return False
+
+    def putShared(self, item):
+        """
+        Puts item on the shared queue once a process has room for it.
+        Returns False if stop() is called or the processes have died first.
+        """
+        while not self._stop.isSet():
+            try:
+                self.sharedQ.put(item, True, 1.0)
+                return True
+            except Queue.Full:
+                if not self.isAnyAlive():
+                    return False
+        return False
+
+    def feed(self):
+        while not self._stop.isSet():
+            item = self.toSyncQ.get()
+            if item is not END_OF_ITEMS:
+                if not self.putShared(item):
+                    break
+                continue
+            # Every process has to have said how many workers it runs
+            while not self.started.isSet() and not self._stop.isSet() and self.isAnyAlive():
+                self.started.wait(1.0)
+            self.lock.acquire()
+            try:
+                numConsumers = sum(self.numConsumers.values())
+            finally:
+                self.lock.release()
+            for i in range(numConsumers):
+                if not self.putShared(END_OF_ITEMS):
+                    break
+            break
+        LOG.debug("Feeder ending")
+
+    def collect(self):
+        while len(self.reports) < self.numProcesses:
+            try:
+                msg = self.resultQ.get(True, 1.0)
+            except Queue.Empty:
+                if not self.isAnyAlive():
+                    LOG.error("%s of %s fetch processes ended without reporting" % \
+                            (self.numProcesses - len(self.reports), self.numProcesses))
+                    # Don't keep the feeder waiting on them
+                    self.started.set()
+                    break
+                continue
+            kind, index = msg[0], msg[1]
+            if kind == "started":
+                self.lock.acquire()
+                try:
+                    self.numConsumers[index] = msg[2]
+                    if len(self.numConsumers) == self.numProcesses:
+                        self.started.set()
+                finally:
+                    self.lock.release()
+            elif kind == "progress":
+                self.progress.update(index, msg[2])
+            elif kind == "done":
+                notifyCompletion(self.completionListeners, msg[2], msg[3])
+            elif kind == "finished":
+                report, successList, errorList = msg[2:]
+                self.reports[index] = report
+                for item in successList:
+                    self.syncCompleteQ.put(item)
+                for item in errorList:
+                    self.syncErrorQ.put(item)
+        LOG.debug("Collector ending")
+
+    def runProcess(self, index):
+        """
+        Runs in the worker process 'index'
+        """
+        # A ^C reaches the whole process group, the parent stops us through stopEvent
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            if hasattr(self.fetcher, "resetAfterFork"):
+                self.fetcher.resetAfterFork()
+            if getattr(self.fetcher, "rateLimiter", None):
+                self.fetcher.rateLimiter.setShare(1.0 / self.numProcesses)
+            engine = self.createEngine(self.sharedQ)
+            self.resultQ.put(("started", index, engine.getNumConsumers()))
+            engine.addProgressListener(lambda s: self.resultQ.put(("progress", index, s)),
+                    ProcessFetch.PROGRESS_INTERVAL)
+            if self.completionListeners:
+                engine.addCompletionListener(lambda item, status: \
+                        self.resultQ.put(("done", index, item, status)))
+            finished = threading.Event()
+            watcher = Thread(target=self.watchStop, args=(engine, finished))
+            watcher.setDaemon(True)
+            watcher.start()
+            engine.start()
+            report = engine.waitForFinish()
+            finished.set()
+            successList = []
+            while not engine.syncCompleteQ.empty():
+                successList.append(engine.syncCompleteQ.get_nowait())
+            errorList = []
+            while not engine.syncErrorQ.empty():
+                errorList.append(engine.syncErrorQ.get_nowait())
+            self.resultQ.put(("finished", index, report, successList, errorList))
+        except Exception, e:
+            tb_info = traceback.format_exc()
+            LOG.debug("%s" % (tb_info))
+            LOG.critical("Caught exception<%s> in fetch process %s" % (e, index))
+        if self.stopEvent.is_set():
+            # Items left on the shared queue are dropped
+            self.sharedQ.cancel_join_thread()
+
+    def watchStop(self, engine, finished):
+        while not finished.isSet():
+            self.stopEvent.wait(1.0)
+            if not self.stopEvent.is_set():
+                continue
+            engine.stop()
+            # Wake the workers waiting for items.  A full queue is emptied by
+            # the workers still taking items, so keep trying until they end.
+            numEnds = engine.getNumConsumers()
+            while numEnds and not finished.isSet():
+                try:
+                    self.sharedQ.put(END_OF_ITEMS, True, 1.0)
+                    numEnds -= 1
+                except Queue.Full:
+                    pass
+            break
+
+    def waitForFinish(self):
+        """
+        Closes the queue, see close(), and waits for all processes to finish
+        Returns a SyncReport
+        """
+        self.close()
+        for t in [self.feeder, self.collector]:
+            while t.isAlive():
+                # An untimed join can't be interrupted by a signal
+                t.join(1.0)
+        if self._stop.isSet():
+            self.sharedQ.cancel_join_thread()
+        for p in self.processes:
+            while p.is_alive():
+                # An untimed join can't be interrupted by a signal
+                p.join(1.0)
+        self.progress.finish()
+        LOG.info("All fetch processes have finished.")
+        report = SyncReport()
+        for r in self.reports.values():
+            report.successes += r.successes
+            report.downloads += r.downloads
+            report.errors += r.errors
+            for host, protocols in r.protocols.items():
+                merged = report.protocols.setdefault(host, [])
+                for protocol in protocols:
+                    if protocol not in merged:
+                        merged.append(protocol)
+                merged.sort()
+            if self.priorities:
+                self.priorities.merge(r.priorityClasses)
+        if self.priorities:
+            report.priorityClasses = self.priorities.getCompletion()
+            logClasses(report)
+        if getattr(self.fetcher, "checksumCache", None):
+            # Pick up the checksums the processes stored
+            self.fetcher.checksumCache.reload()
+        LOG.info("ProcessFetch: %s items successfully processed, %s downloaded, %s items had errors" %
+            (report.successes, report.downloads, report.errors))
+        return report
@@ -14,7 +14,9 @@
 # in this software or its documentation.
 #
 import os
+import socket
 import logging
+import threading
 import httplib
 import urllib
 import xmlrpclib
@@ -24,15 +26,47 @@ LOG = logging.getLogger("grinder.RHNComm")
 
 from GrinderExceptions import GetRequestException
 
+class TimeoutHTTPConnection(httplib.HTTPConnection):
+    """
+    HTTPConnection whose socket times out, python 2.4's takes no timeout argument
+    """
+    def __init__(self, host, timeout=None):
+        httplib.HTTPConnection.__init__(self, host)
+        self.timeout = timeout
+
+    def connect(self):
+        msg = "getaddrinfo returns an empty list"
+        for res in socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM):
+            af, socktype, proto, canonname, sa = res
+            try:
+                self.sock = socket.socket(af, socktype, proto)
+                self.sock.settimeout(self.timeout)
+                self.sock.connect(sa)
+            except socket.error, msg:
+                if self.sock:
+                    self.sock.close()
+                self.sock = None
+                continue
+            break
+        if not self.sock:
+            raise socket.error, msg
+
 class RHNComm(object):
     """
         This class is responsible for handling communication to RHN APIs.
     It uses a mixture of XMLRPC calls as well as wrappers around regular 'GET' calls
     """
-    def __init__(self, satelliteURL, systemId):
+    # Seconds a 'GET' request may wait to connect or for data
+    DEFAULT_TIMEOUT = 60
+
+    def __init__(self, satelliteURL, systemId, timeout=DEFAULT_TIMEOUT):
         self.baseURL = satelliteURL
         self.authMap = None
         self.systemId = systemId
+        self.timeout = timeout
+        # Each thread keeps its connection open across 'GET' requests, so the
+        # server is resolved and connected to once rather than per request
+        self._local = threading.local()
 
     def login(self, refresh=False):
         """
@@ -56,6 +90,43 @@ class RHNComm(object):
         return self.authMap
 
 
+    def getConnection(self):
+        """
+        Returns the calling thread's connection to the server, opening it if needed
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            r = urlparse.urlsplit(self.baseURL)
+            if hasattr(r, 'netloc'):
+                netloc = r.netloc
+            else:
+                netloc = r[1]
+            conn = TimeoutHTTPConnection(netloc, self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def closeConnection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def __request(self, relativeURL, headers):
+        """
+        Sends a 'GET' on the calling thread's connection, reconnecting once if
+        the server closed the kept alive connection
+        """
+        for attempt in [0, 1]:
+            conn = self.getConnection()
+            try:
+                conn.request("GET", relativeURL, headers=headers)
+                return conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                self.closeConnection()
+                if attempt:
+                    raise
+                LOG.debug("Reconnecting to %s after <%s>" % (self.baseURL, e))
+
     def __getRequest(self, relativeURL, headers={}):
         """
         Input:
@@ -69,27 +140,24 @@ class RHNComm(object):
         authMap = self.login()
         for key in authMap:
             headers[key] = self.authMap[key]
-        r = urlparse.urlsplit(self.baseURL)
-        if hasattr(r, 'netloc'):
-            netloc = r.netloc
-        else:
-            netloc = r[1]
-        conn = httplib.HTTPConnection(netloc)
-        conn.request("GET", relativeURL, headers=headers)
-        resp = conn.getresponse()
+        resp = self.__request(relativeURL, headers)
         if resp.status == 401:
             LOG.warn("Got a response of %s:%s, Will refresh authentication credentials and retry" \
                 % (resp.status, resp.reason))
+            # The body has to be read before the connection can be used again
+            resp.read()
             authMap = self.login(refresh=True)
-            conn.request("GET", relativeURL, params=params, headers=headers)
-            resp = conn.getresponse()
+            for key in authMap:
+                headers[key] = authMap[key]
+            resp = self.__request(relativeURL, headers)
         if resp.status != 200:
             LOG.critical("ERROR: Response = %s 'GET' %s.  Our Authentication Info is : %s" \
                 % (resp.status, relativeURL, authMap))
-            conn.close()
+            self.closeConnection()
             raise GetRequestException(relativeURL, resp.status)
         data = resp.read()
-        conn.close()
+        if resp.will_close:
+            self.closeConnection()
         return data
 
     def getRepodata(self, channelLabel, fileName):
@@ -32,7 +32,13 @@ except:
     import md5
 import logging
 import signal
+import threading
+import traceback
+import Queue
 from ParallelFetch import ParallelFetch
+from ParallelFetch import createParallelFetch, SyncReport, STREAM_QUEUE_SIZE
+from FetchProgress import FetchProgress
+from PriorityClasses import DEFAULT_PRIORITY_CLASSES, createPackagePriorities, createGroupPriorities
 from KickstartFetch import KickstartFetch
 
 from xmlrpclib import Fault
@@ -46,10 +52,39 @@ from GrinderExceptions import *
 from SatDumpClient import SatDumpClient
 from RHNComm import RHNComm
 from BaseSync import BaseSync
+from ChecksumCache import getChecksumCache, ChecksumCacheSet
+from SyncJournal import getSyncJournal
+from RateLimiter import createRateLimiter
+from PackageStore import getPackageStore
+from HedgeTracker import DEFAULT_HEDGE_FACTOR
+from BaseFetch import BaseFetch
 
 LOG = logging.getLogger("grinder.RHNSync")
 
+class ChannelSync(object):
+    """
+    State of one channel of RHNSync.syncChannels()
+    """
+    def __init__(self, label, savePath):
+        self.label = label
+        self.savePath = savePath
+        self.journal = getSyncJournal(savePath)
+        # Set if its packages are those left by the last sync, see RHNSync.planChannel()
+        self.resumed = False
+        self.started = time.time()
+        self.numAdded = 0
+        self.numDone = 0
+        # Set once all its packages have been added
+        self.allAdded = False
+        # Set once all its packages are done with, it is then finished
+        self.drained = False
+        # status -> number of packages, see SyncReport.addStatusCounts()
+        self.statusCounts = {}
+
 class RHNSync(BaseSync):
+    # Channels whose package metadata syncChannels() reads at once
+    METADATA_THREADS = 4
+
     def __init__(self):
         BaseSync.__init__(self)
         self.baseURL = "http://satellite.rhn.redhat.com"
@@ -68,9 +103,39 @@ class RHNSync(BaseSync):
         self.username = None
         self.password = None
         self.parallel = 5
+        # If maxParallel is set the number of fetches is tuned between these
+        self.minParallel = 0
+        self.maxParallel = 0
+        # Most fetches in flight to one host, and limits of particular hosts
+        self.maxPerHost = 0
+        self.hostLimits = {}
+        self.fetchEngine = "threads"
+        # More than 1 spreads the fetches over this many processes
+        self.fetchProcesses = 0
+        self.concurrentChannels = False
+        self.resume = False
+        self.retryFailed = False
+        # Classes of packages fetched one after the other, see PriorityClasses
+        self.priorityClasses = DEFAULT_PRIORITY_CLASSES
+        self.deepVerify = False
+        self.maxBandwidth = 0
+        self.maxRequestsPerSec = 0
+        self.bandwidthProfiles = []
+        self.rateLimiter = None
+        self.segmentThreshold = 100
+        self.numSegments = 4
+        self.usePackageStore = False
+        self.connectTimeout = BaseFetch.DEFAULT_CONNECT_TIMEOUT
+        self.stallTimeout = BaseFetch.DEFAULT_STALL_TIMEOUT
+        self.stallSpeed = BaseFetch.DEFAULT_STALL_SPEED
+        self.hedgeFactor = DEFAULT_HEDGE_FACTOR
+        self.useHttp2 = True
         self.fetchAll = False
         self.parallelFetchPkgs = None
         self.parallelFetchKickstarts = None
+        self.stopped = False
+        # (callback, interval) of the progress listeners to add to each download engine
+        self.progressListeners = []
         self.skipProductList = ["rh-public", "k12ltsp", "education"]
         self.debug = False
         self.killcount = 0
@@ -122,6 +187,203 @@ class RHNSync(BaseSync):
     def getParallel(self):
         return self.parallel
 
+    def setMinParallel(self, minParallel):
+        LOG.debug("setMinParallel(%s)" % (minParallel))
+        self.minParallel = minParallel
+
+    def getMinParallel(self):
+        return self.minParallel
+
+    def setMaxParallel(self, maxParallel):
+        LOG.debug("setMaxParallel(%s)" % (maxParallel))
+        self.maxParallel = maxParallel
+
+    def getMaxParallel(self):
+        return self.maxParallel
+
+    def setMaxPerHost(self, maxPerHost):
+        LOG.debug("setMaxPerHost(%s)" % (maxPerHost))
+        self.maxPerHost = maxPerHost
+
+    def getMaxPerHost(self):
+        return self.maxPerHost
+
+    def setHostLimits(self, hostLimits):
+        """
+        hostLimits = dict of host to the most fetches in flight to it,
+            overriding the max per host
+        """
+        LOG.debug("setHostLimits(%s)" % (hostLimits))
+        self.hostLimits = hostLimits
+
+    def getHostLimits(self):
+        return self.hostLimits
+
+    def setFetchEngine(self, engine):
+        LOG.debug("setFetchEngine(%s)" % (engine))
+        self.fetchEngine = engine
+
+    def getFetchEngine(self):
+        return self.fetchEngine
+
+    def setFetchProcesses(self, num):
+        LOG.debug("setFetchProcesses(%s)" % (num))
+        self.fetchProcesses = num
+
+    def getFetchProcesses(self):
+        return self.fetchProcesses
+
+    def setConcurrentChannels(self, value):
+        """
+        value = if True channels are synced at once, see syncChannels()
+        """
+        LOG.debug("setConcurrentChannels(%s)" % (value))
+        self.concurrentChannels = value
+
+    def getConcurrentChannels(self):
+        return self.concurrentChannels
+
+    def setResume(self, value):
+        """
+        value = if True a channel's sync continues with the packages its
+            last sync, if killed, didn't get to, see SyncJournal
+        """
+        LOG.debug("setResume(%s)" % (value))
+        self.resume = value
+
+    def getResume(self):
+        return self.resume
+
+    def setRetryFailed(self, value):
+        """
+        value = if True the packages which failed in a channel's last sync
+            are fetched again, see SyncJournal
+        """
+        LOG.debug("setRetryFailed(%s)" % (value))
+        self.retryFailed = value
+
+    def getRetryFailed(self):
+        return self.retryFailed
+
+    def setPriorityClasses(self, names):
+        """
+        names = list of package classes, e.g. ['newest', 'security', 'older'],
+            in the order they are fetched.  An empty list fetches in no
+            particular order.
+        """
+        LOG.debug("setPriorityClasses(%s)" % (names))
+        self.priorityClasses = names
+
+    def getPriorityClasses(self):
+        return self.priorityClasses
+
+    def setDeepVerify(self, value):
+        LOG.debug("setDeepVerify(%s)" % (value))
+        self.deepVerify = value
+
+    def getDeepVerify(self):
+        return self.deepVerify
+
+    def setMaxBandwidth(self, mbit):
+        LOG.debug("setMaxBandwidth(%s)" % (mbit))
+        self.maxBandwidth = mbit
+        self.rateLimiter = None
+
+    def getMaxBandwidth(self):
+        return self.maxBandwidth
+
+    def setMaxRequestsPerSec(self, num):
+        LOG.debug("setMaxRequestsPerSec(%s)" % (num))
+        self.maxRequestsPerSec = num
+        self.rateLimiter = None
+
+    def getMaxRequestsPerSec(self):
+        return self.maxRequestsPerSec
+
+    def setBandwidthProfiles(self, profiles):
+        LOG.debug("setBandwidthProfiles(%s)" % (profiles))
+        self.bandwidthProfiles = profiles
+        self.rateLimiter = None
+
+    def getBandwidthProfiles(self):
+        return self.bandwidthProfiles
+
+    def setSegmentThreshold(self, mb):
+        LOG.debug("setSegmentThreshold(%s)" % (mb))
+        self.segmentThreshold = mb
+
+    def getSegmentThreshold(self):
+        return self.segmentThreshold
+
+    def setNumSegments(self, num):
+        LOG.debug("setNumSegments(%s)" % (num))
+        self.numSegments = num
+
+    def getNumSegments(self):
+        return self.numSegments
+
+    def setUsePackageStore(self, value):
+        LOG.debug("setUsePackageStore(%s)" % (value))
+        self.usePackageStore = value
+
+    def getUsePackageStore(self):
+        return self.usePackageStore
+
+    def setConnectTimeout(self, seconds):
+        LOG.debug("setConnectTimeout(%s)" % (seconds))
+        self.connectTimeout = seconds
+
+    def getConnectTimeout(self):
+        return self.connectTimeout
+
+    def setStallTimeout(self, seconds):
+        LOG.debug("setStallTimeout(%s)" % (seconds))
+        self.stallTimeout = seconds
+
+    def getStallTimeout(self):
+        return self.stallTimeout
+
+    def setStallSpeed(self, bytesPerSec):
+        LOG.debug("setStallSpeed(%s)" % (bytesPerSec))
+        self.stallSpeed = bytesPerSec
+
+    def getStallSpeed(self):
+        return self.stallSpeed
+
+    def setHedgeFactor(self, factor):
+        LOG.debug("setHedgeFactor(%s)" % (factor))
+        self.hedgeFactor = factor
+
+    def getHedgeFactor(self):
+        return self.hedgeFactor
+
+    def setHttp2(self, useHttp2):
+        LOG.debug("setHttp2(%s)" % (useHttp2))
+        self.useHttp2 = useHttp2
+
+    def getHttp2(self):
+        return self.useHttp2
+
+    def getPackageStore(self):
+        """
+        Returns the PackageStore under the base path, or None if it's not in use
+        """
+        if not self.usePackageStore:
+            return None
+        basePath = self.getBasePath()
+        if not basePath:
+            basePath = "./"
+        return getPackageStore(basePath)
+
+    def getRateLimiter(self):
+        """
+        Returns the RateLimiter shared by every fetch this RHNSync runs
+        """
+        if self.rateLimiter is None:
+            self.rateLimiter = createRateLimiter(self.maxBandwidth,
+                    self.maxRequestsPerSec, self.bandwidthProfiles)
+        return self.rateLimiter
+
     def setRemoveOldPackages(self, value):
         LOG.debug("setRemoveOldPackages(%s)" % (value))
         self.removeOldPackages = value
@@ -196,6 +458,49 @@ class RHNSync(BaseSync):
             self.setSystemId(sysid)
         if configInfo.has_key("parallel"):
             self.setParallel(int(configInfo["parallel"]))
+        if configInfo.has_key("min_parallel"):
+            self.setMinParallel(int(configInfo["min_parallel"]))
+        if configInfo.has_key("max_parallel"):
+            self.setMaxParallel(int(configInfo["max_parallel"]))
+        if configInfo.has_key("max_per_host"):
+            self.setMaxPerHost(int(configInfo["max_per_host"]))
+        if configInfo.has_key("host_limits") and configInfo["host_limits"]:
+            hostLimits = {}
+            for host, limit in configInfo["host_limits"].items():
+                hostLimits[host] = int(limit)
+            self.setHostLimits(hostLimits)
+        if configInfo.has_key("fetch_engine"):
+            self.setFetchEngine(configInfo["fetch_engine"])
+        if configInfo.has_key("fetch_processes"):
+            self.setFetchProcesses(int(configInfo["fetch_processes"]))
+        if configInfo.has_key("concurrent_channels"):
+            self.setConcurrentChannels(configInfo["concurrent_channels"])
+        if configInfo.has_key("priority_classes"):
+            self.setPriorityClasses(configInfo["priority_classes"] or [])
+        if configInfo.has_key("deep_verify"):
+            self.setDeepVerify(configInfo["deep_verify"])
+        if configInfo.has_key("max_bandwidth"):
+            self.setMaxBandwidth(float(configInfo["max_bandwidth"]))
+        if configInfo.has_key("max_requests_per_sec"):
+            self.setMaxRequestsPerSec(float(configInfo["max_requests_per_sec"]))
+        if configInfo.has_key("bandwidth_profiles") and configInfo["bandwidth_profiles"]:
+            self.setBandwidthProfiles(configInfo["bandwidth_profiles"])
+        if configInfo.has_key("segment_threshold"):
+            self.setSegmentThreshold(float(configInfo["segment_threshold"]))
+        if configInfo.has_key("segments"):
+            self.setNumSegments(int(configInfo["segments"]))
+        if configInfo.has_key("package_store"):
+            self.setUsePackageStore(configInfo["package_store"])
+        if configInfo.has_key("connect_timeout"):
+            self.setConnectTimeout(int(configInfo["connect_timeout"]))
+        if configInfo.has_key("stall_timeout"):
+            self.setStallTimeout(int(configInfo["stall_timeout"]))
+        if configInfo.has_key("stall_speed"):
+            self.setStallSpeed(int(configInfo["stall_speed"]))
+        if configInfo.has_key("hedge_factor"):
+            self.setHedgeFactor(float(configInfo["hedge_factor"]))
+        if configInfo.has_key("http2"):
+            self.setHttp2(configInfo["http2"])
         if configInfo.has_key("url"):
             self.setURL(configInfo["url"])
         if configInfo.has_key("removeold"):
@@ -257,7 +562,16 @@ class RHNSync(BaseSync):
             client.auth.logout(key)        
             LOG.debug("Activated!")
 
+    def addProgressListener(self, callback, interval=FetchProgress.DEFAULT_INTERVAL):
+        """
+        callback = function called with a ProgressSnapshot every interval
+            seconds while packages or kickstart files are downloaded, see
+            ParallelFetch.addProgressListener()
+        """
+        self.progressListeners.append((callback, interval))
+
     def stop(self):
+        self.stopped = True
         if (self.parallelFetchPkgs):
             self.parallelFetchPkgs.stop()
         if (self.parallelFetchKickstarts):
@@ -335,11 +649,23 @@ class RHNSync(BaseSync):
                 info["hashtype"] = ksFile["hashtype"]
                 ksFiles.append(info)
         ksFetch = KickstartFetch(self.systemid, self.baseURL)
+        checksumCache = getChecksumCache(savePath)
+        ksFetch.setChecksumCache(checksumCache, self.deepVerify)
+        ksFetch.setRateLimiter(self.getRateLimiter())
+        ksFetch.setSegmentation(int(self.segmentThreshold * 1024 * 1024), self.numSegments)
+        ksFetch.setPackageStore(self.getPackageStore())
+        ksFetch.setTimeouts(self.connectTimeout, self.stallTimeout, self.stallSpeed)
+        ksFetch.setHttp2(self.useHttp2)
         numThreads = int(self.parallel)
-        self.parallelFetchKickstarts = ParallelFetch(ksFetch, numThreads)
+        self.parallelFetchKickstarts = createParallelFetch(ksFetch, numThreads, self.fetchEngine,
+                self.hedgeFactor, self.minParallel, self.maxParallel, self.maxPerHost, self.hostLimits,
+                self.fetchProcesses)
+        for callback, interval in self.progressListeners:
+            self.parallelFetchKickstarts.addProgressListener(callback, interval)
         self.parallelFetchKickstarts.addItemList(ksFiles)
         self.parallelFetchKickstarts.start()
         report = self.parallelFetchKickstarts.waitForFinish()
+        checksumCache.close()
         endTime = time.time()
         LOG.info("Processed %s %s %s kickstart files, %s errors, completed in %s seconds" \
                 % (channelLabel, ksLabels[channelLabel], report.successes, 
@@ -352,42 +678,323 @@ class RHNSync(BaseSync):
         savePath - path to save packages, relative to basePath if basePath has been set
         verbose - if true display more output
         """
-        if self.getBasePath():
-            savePath = os.path.join(self.getBasePath(), savePath)
-            LOG.info("Adjusting save path to: %s" % (savePath))
+        savePath = self.getChannelSavePath(savePath)
         startTime = time.time()
         if channelLabel == "":
             LOG.critical("No channel label specified to sync, abort sync.")
             raise NoChannelLabelException()
         LOG.info("sync(%s, %s) invoked" % (channelLabel, verbose))
         satDump = SatDumpClient(self.baseURL, verbose=verbose)
-        LOG.debug("*** calling product_names ***")
-        packages = satDump.getChannelPackages(self.systemid, channelLabel)
-        LOG.info("%s packages are available, getting list of short metadata now." % (len(packages)))
-        pkgInfo = satDump.getShortPackageInfo(self.systemid, packages, filterLatest = not self.fetchAll)
-        LOG.info("%s packages have been marked to be fetched" % (len(pkgInfo.values())))
-
         numThreads = int(self.parallel)
-        LOG.info("Running in parallel fetch mode with %s threads" % (numThreads))
+        LOG.info("Running in parallel fetch mode with %s threads, using '%s' engine" % (numThreads, self.fetchEngine))
         pkgFetch = PackageFetch(self.systemid, self.baseURL, channelLabel, savePath)
-        self.parallelFetchPkgs = ParallelFetch(pkgFetch, numThreads)
-        self.parallelFetchPkgs.addItemList(pkgInfo.values())
+        checksumCache = getChecksumCache(savePath)
+        pkgFetch.setChecksumCache(checksumCache, self.deepVerify)
+        self.setupPackageFetch(pkgFetch)
+        journal = getSyncJournal(savePath)
+        packages, priorities, resumed = self.planChannel(satDump, channelLabel, savePath, journal)
+        recordPlan = None
+        if not resumed:
+            recordPlan = journal.addPlanned
+        if self.fetchAll and not resumed:
+            # Every package is fetched, so they are streamed to the workers as
+            # their metadata comes in, newest first, rather than read in full
+            # before the first download starts
+            self.parallelFetchPkgs = self.createPackageFetch(pkgFetch, numThreads, priorities,
+                    STREAM_QUEUE_SIZE)
+            self.parallelFetchPkgs.addCompletionListener(journal.itemDone)
+            self.parallelFetchPkgs.start()
+            try:
+                numPackages = self.addPackages(self.parallelFetchPkgs, packages, recordPlan)
+            except:
+                # Don't leave the workers waiting for more items
+                self.parallelFetchPkgs.stop()
+                raise
+            LOG.info("%s packages have been marked to be fetched" % (numPackages))
+        else:
+            self.parallelFetchPkgs = self.createPackageFetch(pkgFetch, numThreads, priorities)
+            self.parallelFetchPkgs.addCompletionListener(journal.itemDone)
+            numPackages = self.addPackages(self.parallelFetchPkgs, packages, recordPlan)
+            self.parallelFetchPkgs.start()
+        if not resumed and not self.stopped:
+            journal.setPlanComplete()
+        report = self.parallelFetchPkgs.waitForFinish()
+        checksumCache.close()
+        endTime = time.time()
+        LOG.info("Processed <%s> %s packages, %s errors, completed in %s seconds" \
+                % (channelLabel, report.successes, report.errors, (endTime-startTime)))
+        if self.stopped:
+            # Left unfinished, for --resume to fetch the rest and finish it
+            LOG.warn("Sync of %s was stopped, its repodata was not updated" % (channelLabel))
+        elif numPackages or not journal.isFinished():
+            self.finishChannel(savePath)
+            journal.setFinished()
+        journal.close()
+        return report
+
+    def syncChannels(self, channels, verbose=0):
+        """
+        Syncs the packages of several channels at once through one download
+        engine, rather than one channel after the other.  The channels get a
+        fair share of the fetches, see FairQueue, while the metadata of up to
+        METADATA_THREADS channels is read.  Each channel is finished, old
+        packages removed and its repodata created, as soon as its last
+        package is done, while the others are still fetched.
+        channels - list of dicts with the 'label' and 'relpath' of a channel,
+            see getChannelSyncList()
+        verbose - if true display more output
+        Returns dict of channel label to the SyncReport of its packages, for
+        the channels finished
+        """
+        startTime = time.time()
+        numThreads = int(self.parallel)
+        LOG.info("Syncing %s channels in parallel fetch mode with %s threads, using '%s' engine" % \
+                (len(channels), numThreads, self.fetchEngine))
+        pkgFetch = PackageFetch(self.systemid, self.baseURL)
+        checksumCaches = ChecksumCacheSet()
+        pkgFetch.setChecksumCache(checksumCaches, self.deepVerify)
+        self.setupPackageFetch(pkgFetch)
+        toSync = {}
+        for info in channels:
+            channel = ChannelSync(info['label'], self.getChannelSavePath(info['relpath']))
+            toSync[channel.label] = channel
+            # Added before the engine starts, so its worker processes have them too
+            checksumCaches.add(channel.savePath, getChecksumCache(channel.savePath))
+        # channel label -> PriorityClasses of its packages
+        channelPriorities = {}
+        getChannel = lambda info: info['channel_label']
+        priorities = createGroupPriorities(self.priorityClasses, channelPriorities, getChannel)
+        maxQueued = 0
+        if self.fetchAll:
+            maxQueued = STREAM_QUEUE_SIZE
+        self.parallelFetchPkgs = self.createPackageFetch(pkgFetch, numThreads, priorities,
+                maxQueued, getChannel)
+        lock = threading.Lock()
+        finishQ = Queue.Queue()
+        def channelDrained(channel):
+            """
+            Queues channel to be finished once all its packages are added
+            and done, called holding lock
+            """
+            if channel.allAdded and channel.numDone == channel.numAdded and not channel.drained:
+                channel.drained = True
+                finishQ.put(channel)
+        def itemDone(itemInfo, status):
+            channel = toSync[itemInfo['channel_label']]
+            channel.journal.itemDone(itemInfo, status)
+            lock.acquire()
+            try:
+                channel.numDone += 1
+                channel.statusCounts[status] = channel.statusCounts.get(status, 0) + 1
+                channelDrained(channel)
+            finally:
+                lock.release()
+        self.parallelFetchPkgs.addCompletionListener(itemDone)
+        remaining = Queue.Queue()
+        for info in channels:
+            remaining.put(toSync[info['label']])
+        def readChannels():
+            satDump = SatDumpClient(self.baseURL, verbose=verbose)
+            while not self.stopped:
+                try:
+                    channel = remaining.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    packages, channelPriorities[channel.label], channel.resumed = \
+                            self.planChannel(satDump, channel.label, channel.savePath, channel.journal)
+                    def addedPackage(info, channel=channel):
+                        if not channel.resumed:
+                            channel.journal.addPlanned(info)
+                        info['channel_label'] = channel.label
+                        info['save_path'] = channel.savePath
+                        lock.acquire()
+                        try:
+                            channel.numAdded += 1
+                        finally:
+                            lock.release()
+                    numPackages = self.addPackages(self.parallelFetchPkgs, packages, addedPackage)
+                    LOG.info("%s packages of %s have been marked to be fetched" % \
+                            (numPackages, channel.label))
+                except Exception, e:
+                    tb_info = traceback.format_exc()
+                    LOG.debug("%s" % (tb_info))
+                    LOG.critical("Unable to read the packages of %s: %s" % (channel.label, e))
+                    continue
+                if self.stopped:
+                    break
+                if not channel.resumed:
+                    channel.journal.setPlanComplete()
+                lock.acquire()
+                try:
+                    channel.allAdded = True
+                    channelDrained(channel)
+                finally:
+                    lock.release()
+        readers = []
+        for i in range(min(len(channels), RHNSync.METADATA_THREADS)):
+            readers.append(threading.Thread(target=readChannels, name="ChannelReader-%s" % (i)))
+        reports = {}
+        finisher = threading.Thread(target=self.finishChannels,
+                args=(finishQ, checksumCaches, reports), name="ChannelFinisher")
         self.parallelFetchPkgs.start()
+        finisher.start()
+        for t in readers:
+            t.start()
+        for t in readers:
+            while t.isAlive():
+                # An untimed join can't be interrupted by a signal
+                t.join(1.0)
         report = self.parallelFetchPkgs.waitForFinish()
+        finishQ.put(None)
+        while finisher.isAlive():
+            finisher.join(1.0)
+        for channel in toSync.values():
+            if not channel.drained:
+                LOG.warn("Sync of %s didn't complete, its repodata was not updated" % (channel.label))
+                channel.journal.close()
+        checksumCaches.close()
+        endTime = time.time()
+        LOG.info("Processed %s channels, %s packages, %s errors, completed in %s seconds" \
+                % (len(reports), report.successes, report.errors, (endTime-startTime)))
+        return reports
+
+    def finishChannels(self, finishQ, checksumCaches, reports):
+        """
+        Finishes the channels of syncChannels() as they are put on finishQ,
+        until None is
+        """
+        while True:
+            channel = finishQ.get()
+            if channel is None:
+                break
+            checksumCache = checksumCaches.remove(channel.savePath)
+            if checksumCache:
+                # Pick up the checksums stored by worker processes
+                checksumCache.reload()
+                checksumCache.close()
+            report = SyncReport()
+            report.addStatusCounts(channel.statusCounts)
+            reports[channel.label] = report
+            LOG.info("Processed <%s> %s packages, %s errors, completed in %s seconds" \
+                    % (channel.label, report.successes, report.errors, (time.time() - channel.started)))
+            if self.stopped:
+                LOG.warn("Sync of %s was stopped, its repodata was not updated" % (channel.label))
+                channel.journal.close()
+                continue
+            try:
+                if channel.numAdded or not channel.journal.isFinished():
+                    self.finishChannel(channel.savePath)
+                    channel.journal.setFinished()
+            except Exception, e:
+                tb_info = traceback.format_exc()
+                LOG.debug("%s" % (tb_info))
+                LOG.critical("Unable to finish %s: %s" % (channel.label, e))
+            channel.journal.close()
+
+    def planChannel(self, satDump, channelLabel, savePath, journal):
+        """
+        Returns (packages, priorities, resumed) for the packages of a channel
+        to fetch, see getChannelItems().  With resume or retryFailed set and
+        a complete plan in the channel's journal, packages are those its last
+        sync left or failed and resumed is True, no metadata is read.
+        Otherwise journal is started anew.
+        """
+        if self.resume or self.retryFailed:
+            if journal.load() and journal.label == channelLabel and journal.isPlanComplete():
+                packages = journal.getItems(self.resume, self.retryFailed)
+                LOG.info("Resuming sync of %s from its journal, %s packages to fetch" % \
+                        (channelLabel, len(packages)))
+                journal.reopen()
+                priorities = createPackagePriorities(self.priorityClasses, packages,
+                        os.path.join(savePath, "updateinfo.xml"))
+                return packages, priorities, True
+            LOG.info("No complete plan of an earlier sync of %s in its journal, syncing it in full" % \
+                    (channelLabel))
+        journal.start(channelLabel)
+        packages, priorities = self.getChannelItems(satDump, channelLabel, savePath)
+        return packages, priorities, False
+
+    def getChannelSavePath(self, savePath):
+        """
+        Returns savePath, relative to basePath if basePath has been set
+        """
+        if self.getBasePath():
+            savePath = os.path.join(self.getBasePath(), savePath)
+            LOG.info("Adjusting save path to: %s" % (savePath))
+        return savePath
+
+    def getChannelItems(self, satDump, channelLabel, savePath):
+        """
+        Fetches the channel's comps.xml and updateinfo, and returns
+        (packages, priorities) for its packages to fetch.  If all packages
+        are fetched packages is a generator reading their metadata as it is
+        iterated over, otherwise the list of the latest packages.
+        """
+        LOG.debug("*** calling product_names ***")
+        packages = satDump.getChannelPackages(self.systemid, channelLabel)
+        LOG.info("%s packages are available, getting list of short metadata now." % (len(packages)))
+        # Metadata first, so clients can use the channel while packages are still coming in
         LOG.debug("Attempting to fetch comps.xml info from RHN")
         self.fetchCompsXML(savePath, channelLabel)
         self.fetchUpdateinfo(savePath, channelLabel)
-        endTime = time.time()
-        LOG.info("Processed <%s> %s packages, %s errors, completed in %s seconds" \
-                % (channelLabel, report.successes, report.errors, (endTime-startTime)))
+        updateinfoPath = os.path.join(savePath, "updateinfo.xml")
+        if self.fetchAll:
+            priorities = createPackagePriorities(self.priorityClasses, None, updateinfoPath)
+            return satDump.iterShortPackageInfo(self.systemid, packages), priorities
+        # Only the latest of each package is known once all are read
+        pkgInfo = satDump.getShortPackageInfo(self.systemid, packages, filterLatest=True)
+        LOG.info("%s packages have been marked to be fetched" % (len(pkgInfo.values())))
+        priorities = createPackagePriorities(self.priorityClasses, pkgInfo.values(),
+                updateinfoPath)
+        return pkgInfo.values(), priorities
+
+    def setupPackageFetch(self, pkgFetch):
+        pkgFetch.setRateLimiter(self.getRateLimiter())
+        pkgFetch.setSegmentation(int(self.segmentThreshold * 1024 * 1024), self.numSegments)
+        pkgFetch.setPackageStore(self.getPackageStore())
+        pkgFetch.setTimeouts(self.connectTimeout, self.stallTimeout, self.stallSpeed)
+        pkgFetch.setHttp2(self.useHttp2)
+
+    def createPackageFetch(self, pkgFetch, numThreads, priorities, maxQueued=0, getGroup=None):
+        """
+        Returns the download engine for a channel's packages, with the
+        progress listeners added
+        """
+        engine = createParallelFetch(pkgFetch, numThreads, self.fetchEngine,
+                self.hedgeFactor, self.minParallel, self.maxParallel, self.maxPerHost, self.hostLimits,
+                self.fetchProcesses, priorities=priorities, maxQueued=maxQueued, getGroup=getGroup)
+        for callback, interval in self.progressListeners:
+            engine.addProgressListener(callback, interval)
+        return engine
+
+    def addPackages(self, engine, packages, added=None):
+        """
+        Adds packages to engine until stop() is called, returns how many were
+        added.  added is called with each package before it is.
+        """
+        numPackages = 0
+        for info in packages:
+            if self.stopped:
+                break
+            if added:
+                added(info)
+            engine.addItem(info)
+            numPackages += 1
+        return numPackages
+
+    def finishChannel(self, savePath):
+        """
+        Removes old packages, if asked to, and updates the repodata of a
+        channel synced into savePath
+        """
         if self.removeOldPackages:
             LOG.info("Remove old packages from %s" % (savePath))
             self.runRemoveOldPackages(savePath)
         self.createRepo(savePath)
         self.updateRepo(os.path.join(savePath,"updateinfo.xml"),
                 os.path.join(savePath,"repodata/"))
-        return report
-    
+
     def fetchCompsXML(self, savePath, channelLabel):
         ###
         # Fetch comps.xml, used by createrepo for "groups" info
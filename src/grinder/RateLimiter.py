@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import time
+import logging
+import threading
+
+LOG = logging.getLogger("grinder.RateLimiter")
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket, refilled at 'rate' tokens a second and holding
+    at most one second worth of tokens.  A rate of 0 means no limit.
+    """
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.tokens = 0
+        self.last = time.time()
+        self.setRate(rate)
+        self.tokens = self.rate
+
+    def setRate(self, rate):
+        self.lock.acquire()
+        try:
+            self.rate = float(rate)
+            self.tokens = min(self.tokens, self.rate)
+        finally:
+            self.lock.release()
+
+    def consume(self, amount):
+        """
+        Takes amount tokens, sleeping until the bucket has refilled enough to cover them
+        """
+        self.lock.acquire()
+        try:
+            if not self.rate:
+                return
+            now = time.time()
+            self.tokens = min(self.tokens + (now - self.last) * self.rate, self.rate)
+            self.last = now
+            # Go into debt for what isn't there, the caller sleeps it off.
+            # Later callers then wait their turn behind it.
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        finally:
+            self.lock.release()
+        if wait > 0:
+            time.sleep(wait)
+
+class RateLimitProfile(object):
+    """
+    Limits that apply between 'start' and 'end', given as "HH:MM" local time.
+    A profile may wrap past midnight, e.g. start "22:00", end "06:00".
+    """
+    def __init__(self, start, end, bytesPerSec=0, requestsPerSec=0):
+        self.start = parseTimeOfDay(start)
+        self.end = parseTimeOfDay(end)
+        self.bytesPerSec = bytesPerSec
+        self.requestsPerSec = requestsPerSec
+
+    def isActive(self, now=None):
+        if now is None:
+            now = time.localtime()
+        minute = now[3] * 60 + now[4]
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+class RateLimiter(object):
+    """
+    Caps the bandwidth and request rate of every fetcher it is shared by.
+    bytesPerSec and requestsPerSec of 0 mean no limit.  The first active
+    profile in 'profiles' overrides the default limits.
+    """
+    # How often, in seconds, to check which profile applies
+    PROFILE_CHECK_INTERVAL = 60
+
+    def __init__(self, bytesPerSec=0, requestsPerSec=0, profiles=None):
+        if profiles is None:
+            profiles = []
+        self.bytesPerSec = bytesPerSec
+        self.requestsPerSec = requestsPerSec
+        self.profiles = profiles
+        # Fraction of the limits enforced here, see setShare()
+        self.share = 1.0
+        # Transfers running at once under the limits, see setTransfers()
+        self.transfers = 1
+        self.byteBucket = TokenBucket(bytesPerSec)
+        self.requestBucket = TokenBucket(requestsPerSec)
+        self.lastProfileCheck = 0
+        self.updateLimits()
+
+    def getLimits(self):
+        """
+        Returns (bytesPerSec, requestsPerSec) which apply right now
+        """
+        for p in self.profiles:
+            if p.isActive():
+                return (p.bytesPerSec, p.requestsPerSec)
+        return (self.bytesPerSec, self.requestsPerSec)
+
+    def setShare(self, share):
+        """
+        share = fraction of the limits to enforce, for one of several
+            processes which together keep to them
+        """
+        self.share = share
+        self.lastProfileCheck = 0
+        self.updateLimits()
+
+    def setTransfers(self, transfers):
+        """
+        transfers = most transfers run at once under these limits, a
+            download engine sets this to its number of concurrent fetches
+        """
+        self.transfers = max(int(transfers), 1)
+
+    def getTransferRate(self):
+        """
+        Returns the bytes/sec each transfer gets when all of them are
+        running, 0 if bandwidth isn't limited
+        """
+        self.updateLimits()
+        return self.byteBucket.rate / self.transfers
+
+    def updateLimits(self):
+        now = time.time()
+        if now - self.lastProfileCheck < RateLimiter.PROFILE_CHECK_INTERVAL:
+            return
+        self.lastProfileCheck = now
+        bytesPerSec, requestsPerSec = self.getLimits()
+        bytesPerSec = bytesPerSec * self.share
+        requestsPerSec = requestsPerSec * self.share
+        if bytesPerSec != self.byteBucket.rate or requestsPerSec != self.requestBucket.rate:
+            LOG.info("Limiting downloads to %s bytes/sec and %s requests/sec (0 is unlimited)" % \
+                    (bytesPerSec, requestsPerSec))
+            self.byteBucket.setRate(bytesPerSec)
+            self.requestBucket.setRate(requestsPerSec)
+
+    def acquireRequest(self):
+        """
+        Blocks until another request may be started
+        """
+        self.updateLimits()
+        self.requestBucket.consume(1)
+
+    def acquireBytes(self, numBytes):
+        """
+        Blocks until numBytes more may be transferred
+        """
+        self.updateLimits()
+        self.byteBucket.consume(numBytes)
+
+    def limitWrites(self, writeFunction):
+        """
+        Returns writeFunction wrapped to block until the data it is passed may be transferred
+        """
+        def write(data):
+            self.acquireBytes(len(data))
+            return writeFunction(data)
+        return write
+
+def parseTimeOfDay(value):
+    """
+    Returns minutes past midnight for a "HH:MM" string
+    """
+    if isinstance(value, int):
+        # YAML reads an unquoted 18:00 as the base 60 number 18*60+0
+        return value
+    hours, minutes = str(value).split(":")
+    return int(hours) * 60 + int(minutes)
+
+def mbitToBytes(mbit):
+    return int(float(mbit) * 1000000 / 8)
+
+def createRateLimiter(maxBandwidth=0, maxRequests=0, profiles=None):
+    """
+    Builds a RateLimiter from config style values:
+      maxBandwidth = Mbit/s
+      maxRequests = requests/sec
+      profiles = list of dicts with keys 'start', 'end' and optionally
+                 'max_bandwidth', 'max_requests_per_sec'
+    """
+    limiterProfiles = []
+    if profiles:
+        for p in profiles:
+            limiterProfiles.append(RateLimitProfile(p["start"], p["end"],
+                    mbitToBytes(p.get("max_bandwidth", 0)), float(p.get("max_requests_per_sec", 0))))
+    return RateLimiter(mbitToBytes(maxBandwidth), float(maxRequests), limiterProfiles)
@@ -24,10 +24,18 @@ import logging
 import shutil
 import pycurl
 import traceback
+import urlparse
 
 from PrestoParser import PrestoParser
-from ParallelFetch import ParallelFetch
+from ParallelFetch import createParallelFetch, STREAM_QUEUE_SIZE
+from FetchProgress import FetchProgress
+from PriorityClasses import DEFAULT_PRIORITY_CLASSES, NEWEST, createPackagePriorities
 from BaseFetch import BaseFetch
+from ChecksumCache import getChecksumCache
+from RateLimiter import createRateLimiter
+from PackageStore import getPackageStore
+from HedgeTracker import DEFAULT_HEDGE_FACTOR
+from MirrorSelector import MirrorSelector
 
 LOG = logging.getLogger("grinder.RepoFetch")
 
@@ -43,6 +51,10 @@ class RepoFetch(BaseFetch):
         self.mirrorlist = mirrorlist
         self.local_dir = download_dir
         self.repo_dir = os.path.join(self.local_dir, self.repo_label)
+        self.mirrorSelector = None
+        self.updateinfo = None
+        # relative path -> urls picked for the item by getItemHost()
+        self.pickedURLs = {}
 
     def setupRepo(self):
         self.repo = yum.yumRepo.YumRepository(self.repo_label)
@@ -77,13 +89,107 @@ class RepoFetch(BaseFetch):
         sack = PrestoParser(self.deltamd).getDeltas()
         return sack.values()
     
+    def setupMirrors(self, probePath="repodata/repomd.xml"):
+        """
+        Spreads package fetches over the mirrors yum resolved for the repo,
+        from its mirrorlist or baseurl, after probing how they respond
+        """
+        self.mirrorSelector = MirrorSelector(self.repo.urls)
+        self.probeMirrors(probePath)
+
+    def probeMirrors(self, probePath, timeout=10):
+        """
+        Fetches probePath from every mirror at once, recording their latency.
+        Mirrors which don't answer are left out until they recover.
+        """
+        multi = pycurl.CurlMulti()
+        handles = {}
+        for url in self.mirrorSelector.getURLs():
+            curl = pycurl.Curl()
+            curl.setopt(curl.URL, str(url + '/' + probePath))
+            # Through the share handle probes also warm the DNS and TLS
+            # session caches for the downloads
+            self.setupConnection(curl)
+            curl.setopt(curl.WRITEFUNCTION, lambda data: None)
+            curl.setopt(curl.FOLLOWLOCATION, 1)
+            curl.setopt(curl.NOSIGNAL, 1)
+            curl.setopt(curl.CONNECTTIMEOUT, timeout)
+            curl.setopt(curl.TIMEOUT, timeout)
+            multi.add_handle(curl)
+            handles[curl] = url
+        numLeft = len(handles)
+        while numLeft:
+            while 1:
+                ret, numHandles = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while 1:
+                numQueued, okList, errList = multi.info_read()
+                for curl in okList:
+                    ok = curl.getinfo(curl.HTTP_CODE) == 200
+                    if not urlparse.urlparse(handles[curl])[0].startswith("http"):
+                        # e.g. file://, which has no response code, the
+                        # transfer not failing is all there is to go on
+                        ok = True
+                    self.mirrorSelector.recordProbe(handles[curl], ok, curl.getinfo(curl.STARTTRANSFER_TIME))
+                for curl, errno, errmsg in errList:
+                    LOG.warn("Mirror %s did not answer: %s" % (handles[curl], errmsg))
+                    self.mirrorSelector.recordProbe(handles[curl], False)
+                numLeft -= len(okList) + len(errList)
+                if numQueued == 0:
+                    break
+            if numLeft:
+                multi.select(1.0)
+        for curl in handles.keys():
+            multi.remove_handle(curl)
+            curl.close()
+        multi.close()
+        LOG.info("Probed %s mirrors:\n%s" % (len(handles), self.mirrorSelector))
+
+    def transferFinished(self, fetchURL, status, curl):
+        BaseFetch.transferFinished(self, fetchURL, status, curl)
+        if self.mirrorSelector is None:
+            return
+        ok = status in [BaseFetch.STATUS_DOWNLOADED, BaseFetch.STATUS_NOOP]
+        self.mirrorSelector.recordTransfer(fetchURL, ok, curl.getinfo(curl.SIZE_DOWNLOAD),
+                curl.getinfo(curl.TOTAL_TIME), curl.getinfo(curl.STARTTRANSFER_TIME))
+
+    def getItemHost(self, info):
+        """
+        Picks the mirrors to fetch info from now, rather than when the fetch
+        starts, so the host returned is the one the fetch goes to.  The pick
+        is kept, e.g. while the item is deferred for its host to have room,
+        until it is used up by the next getFetchRequest() for info.
+        """
+        if self.mirrorSelector and info.has_key('relativepath'):
+            urls = self.pickedURLs.get(info['relativepath'])
+            if urls is None:
+                urls = self.mirrorSelector.getItemURLs(info['relativepath'])
+                self.pickedURLs[info['relativepath']] = urls
+            return urlparse.urlparse(str(urls[0]))[1]
+        return BaseFetch.getItemHost(self, info)
+
+    def getFetchRequest(self, info):
+        fetchURL = info['downloadurl']
+        mirrorURLs = []
+        if self.mirrorSelector and info.has_key('relativepath'):
+            # Taken out whether or not the fetch goes ahead, e.g. the file
+            # may already be there
+            urls = self.pickedURLs.pop(info['relativepath'], None)
+            if urls is None:
+                urls = self.mirrorSelector.getItemURLs(info['relativepath'])
+            fetchURL = urls[0]
+            mirrorURLs = urls[1:]
+        return {'fileName': info['fileName'],
+                'fetchURL': str(fetchURL),
+                'itemSize': info['size'],
+                'hashtype': info['checksumtype'],
+                'checksum': info['checksum'],
+                'savePath': info['savepath'],
+                'mirrorURLs': mirrorURLs}
+
     def fetchItem(self, info):
-        return self.fetch(info['fileName'], 
-                          str(info['downloadurl']), 
-                          info['size'], 
-                          info['checksumtype'], 
-                          info['checksum'],
-                          info['savepath'])
+        return self.fetch(**self.getFetchRequest(info))
 
     def fetchAll(self):
         plist = self.getPackageList()
@@ -111,6 +217,8 @@ class RepoFetch(BaseFetch):
                 shutil.copyfile(ftypefile, destfile)
                 if ftype == "prestodelta": 
                     self.deltamd = destfile 
+                elif ftype == "updateinfo":
+                    self.updateinfo = destfile
             except Exception, e:
                 tb_info = traceback.format_exc()
                 LOG.debug("%s" % (tb_info))
@@ -126,12 +234,36 @@ class YumRepoGrinder(object):
       Driver module to initiate the repo fetching
     """
     def __init__(self, repo_label, repo_url, parallel, mirrors=None, \
-                       cacert=None, clicert=None, clikey=None):
+                       cacert=None, clicert=None, clikey=None, engine="threads", \
+                       deepVerify=False, maxBandwidth=0, segmentThreshold=100, numSegments=4, \
+                       usePackageStore=False, hedgeFactor=DEFAULT_HEDGE_FACTOR, minParallel=0, \
+                       maxParallel=0, maxPerHost=0, numProcesses=0, \
+                       priorityClasses=DEFAULT_PRIORITY_CLASSES):
         self.repo_label = repo_label
         self.repo_url = repo_url
         self.mirrors = mirrors
         self.numThreads = int(parallel)
+        # If maxParallel is set the number of fetches is tuned between these
+        self.minParallel = minParallel
+        self.maxParallel = maxParallel
+        # Most fetches in flight to one mirror, 0 for no limit
+        self.maxPerHost = maxPerHost
+        # More than 1 spreads the fetches over this many processes
+        self.numProcesses = numProcesses
+        # Classes of packages fetched one after the other, see PriorityClasses
+        self.priorityClasses = priorityClasses
+        self.fetchEngine = engine
+        self.deepVerify = deepVerify
+        self.rateLimiter = createRateLimiter(maxBandwidth)
+        # MB
+        self.segmentThreshold = segmentThreshold
+        self.numSegments = numSegments
+        self.usePackageStore = usePackageStore
+        self.hedgeFactor = hedgeFactor
         self.fetchPkgs = None
+        self.stopped = False
+        # (callback, interval) of the progress listeners to add to fetchPkgs
+        self.progressListeners = []
         self.downloadinfo = []
         self.yumFetch = None
         self.sslcacert = cacert
@@ -139,34 +271,67 @@ class YumRepoGrinder(object):
         self.sslclientkey = clikey
 
     def prepareRPMS(self):
+        for info in self.iterRPMS():
+            self.downloadinfo.append(info)
+
+    def prepareDRPMS(self):
+        for info in self.iterDRPMS():
+            self.downloadinfo.append(info)
+
+    def iterRPMS(self):
+        """
+        Generator of the download info of the repo's packages
+        """
         pkglist = self.yumFetch.getPackageList()
+        LOG.info("%s packages have been marked to be fetched" % len(pkglist))
         for pkg in pkglist:
             info = {}
             #urljoin doesnt like epoch in rpm name so using string concat
             info['fileName'] = pkg.__str__() + ".rpm"
             info['downloadurl'] = self.yumFetch.repourl + '/' + pkg.relativepath
+            info['relativepath'] = pkg.relativepath
             info['savepath'] = self.yumFetch.repo_dir + '/' + os.path.dirname(pkg.relativepath)
             info['checksumtype'], info['checksum'], status = pkg.checksums[0]
             info['size'] = pkg.size
-            self.downloadinfo.append(info)
-        LOG.info("%s packages have been marked to be fetched" % len(pkglist))
+            # Used to sort the packages into priority classes
+            info['name'] = pkg.name
+            info['epoch'] = pkg.epoch
+            info['version'] = pkg.version
+            info['release'] = pkg.release
+            info['arch'] = pkg.arch
+            yield info
 
-    def prepareDRPMS(self):
+    def iterDRPMS(self):
+        """
+        Generator of the download info of the repo's delta rpms
+        """
         deltarpms = self.yumFetch.getDeltaPackageList()
         if not deltarpms:
             return
 
+        LOG.info("%s delta rpms have been marked to be fetched" % len(deltarpms))
         for dpkg in deltarpms:
             info = {}
             relativepath = dpkg.deltas.values()[0].filename
             info['fileName'] = dpkg.deltas.values()[0].filename
             info['downloadurl'] = self.yumFetch.repourl + '/' + relativepath
+            info['relativepath'] = relativepath
             info['savepath'] = self.yumFetch.repo_dir + '/' + os.path.dirname(relativepath)
             info['checksumtype'] = dpkg.deltas.values()[0].checksum_type
             info['checksum'] = dpkg.deltas.values()[0].checksum
             info['size'] = dpkg.deltas.values()[0].size
-            self.downloadinfo.append(info)
-        LOG.info("%s delta rpms have been marked to be fetched" % len(deltarpms))
+            yield info
+
+    def getNewestPackages(self):
+        """
+        Returns the name, epoch, version, release and arch of the newest
+        build of each package in the repo
+        """
+        newest = []
+        for pkg in self.yumFetch.getPackageList(newest=True):
+            newest.append({'name': pkg.name, 'epoch': pkg.epoch, 'version': pkg.version,
+                    'release': pkg.release, 'arch': pkg.arch})
+        return newest
 
     def fetchYumRepo(self, basepath="./"):
         startTime = time.time()
@@ -178,22 +343,65 @@ class YumRepoGrinder(object):
         LOG.info("Fetching repo metadata...")
         # first fetch the metadata
         self.yumFetch.getRepoData()
-        LOG.info("Determining downloadable Content bits...")
-        # get rpms to fetch
-        self.prepareRPMS()
-        # get drpms to fetch
-        self.prepareDRPMS()
         # prepare for download
-        self.fetchPkgs = ParallelFetch(self.yumFetch, self.numThreads)
-        self.fetchPkgs.addItemList(self.downloadinfo)
+        self.yumFetch.setupMirrors()
+        checksumCache = getChecksumCache(self.yumFetch.repo_dir)
+        self.yumFetch.setChecksumCache(checksumCache, self.deepVerify)
+        self.yumFetch.setRateLimiter(self.rateLimiter)
+        self.yumFetch.setSegmentation(int(self.segmentThreshold * 1024 * 1024), self.numSegments)
+        if self.usePackageStore:
+            self.yumFetch.setPackageStore(getPackageStore(basepath))
+        newest = []
+        if NEWEST in self.priorityClasses:
+            newest = self.getNewestPackages()
+        priorities = createPackagePriorities(self.priorityClasses, newest,
+                self.yumFetch.updateinfo)
+        # The downloads start while the rest of the packages are still being
+        # prepared, at most STREAM_QUEUE_SIZE are queued ahead of them
+        self.fetchPkgs = createParallelFetch(self.yumFetch, self.numThreads, self.fetchEngine,
+                self.hedgeFactor, self.minParallel, self.maxParallel, self.maxPerHost, None,
+                self.numProcesses, priorities=priorities, maxQueued=STREAM_QUEUE_SIZE)
+        for callback, interval in self.progressListeners:
+            self.fetchPkgs.addProgressListener(callback, interval)
         self.fetchPkgs.start()
+        LOG.info("Determining downloadable Content bits...")
+        numPackages = 0
+        try:
+            # rpms, then drpms to fetch
+            for items in [self.iterRPMS(), self.iterDRPMS()]:
+                for info in items:
+                    if self.stopped:
+                        break
+                    self.fetchPkgs.addItem(info)
+                    numPackages += 1
+        except:
+            # Don't leave the workers waiting for more items
+            self.fetchPkgs.stop()
+            raise
         report = self.fetchPkgs.waitForFinish()
+        checksumCache.close()
         endTime = time.time()
-        LOG.info("Processed <%s> packages in [%d] seconds" % (len(self.downloadinfo), \
+        LOG.info("Processed <%s> packages in [%d] seconds" % (numPackages, \
                   (endTime - startTime)))
         return report
 
+    def addProgressListener(self, callback, interval=FetchProgress.DEFAULT_INTERVAL):
+        """
+        callback = function called with a ProgressSnapshot of the package
+            downloads every interval seconds, see ParallelFetch.addProgressListener()
+        """
+        self.progressListeners.append((callback, interval))
+
+    def getProgress(self):
+        """
+        Returns a ProgressSnapshot of the package downloads, None before they start
+        """
+        if self.fetchPkgs:
+            return self.fetchPkgs.getProgress()
+        return None
+
     def stop(self):
+        self.stopped = True
         if self.fetchPkgs:
             self.fetchPkgs.stop()
 
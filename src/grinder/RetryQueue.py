@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import time
+import heapq
+import random
+import logging
+import threading
+
+from BaseFetch import BaseFetch
+
+LOG = logging.getLogger("grinder.RetryQueue")
+
+class RetryPolicy(object):
+    """
+    How often and how soon an item which failed with a given class of error
+    is tried again.  The n'th retry waits baseDelay * 2**(n-1) seconds, capped
+    at maxDelay, randomized by +/- 50% so failed items don't all come back at once.
+    """
+    def __init__(self, retries, baseDelay, maxDelay):
+        self.retries = retries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+
+    def getDelay(self, attempt):
+        delay = min(self.baseDelay * (2 ** (attempt - 1)), self.maxDelay)
+        return delay * random.uniform(0.5, 1.5)
+
+DEFAULT_RETRY_POLICIES = {
+    # Server side trouble, give it time to recover
+    BaseFetch.ERROR_SERVER: RetryPolicy(4, 10, 300),
+    BaseFetch.ERROR_TIMEOUT: RetryPolicy(3, 5, 120),
+    # Corrupt or truncated data, usually fine on the next attempt
+    BaseFetch.ERROR_CHECKSUM: RetryPolicy(2, 1, 30),
+    BaseFetch.ERROR_OTHER: RetryPolicy(2, 2, 60),
+}
+
+class RetryQueue(object):
+    """
+    Holds failed items until their backoff delay has passed, so fetch workers
+    keep busy with other items in the meantime.
+    """
+    def __init__(self, policies=None):
+        if policies is None:
+            policies = DEFAULT_RETRY_POLICIES
+        self.policies = policies
+        self.heap = []
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, itemInfo, errorClass, attempt):
+        """
+        Queues itemInfo for retry number 'attempt' after an error of errorClass.
+        Returns False if the item has no retries left under that class' policy.
+        """
+        policy = self.policies.get(errorClass, self.policies[BaseFetch.ERROR_OTHER])
+        if attempt > policy.retries:
+            return False
+        delay = policy.getDelay(attempt)
+        LOG.warn("Retrying %s (%s error) in %.1f seconds, attempt %s of %s" % \
+                (itemInfo, errorClass, delay, attempt, policy.retries))
+        self.lock.acquire()
+        try:
+            # seq keeps the ordering stable and items themselves out of the comparison
+            self.seq += 1
+            heapq.heappush(self.heap, (time.time() + delay, self.seq, itemInfo, attempt))
+        finally:
+            self.lock.release()
+        return True
+
+    def getReady(self):
+        """
+        Returns (itemInfo, attempt) for an item whose delay has passed, or None
+        """
+        self.lock.acquire()
+        try:
+            if self.heap and self.heap[0][0] <= time.time():
+                readyTime, seq, itemInfo, attempt = heapq.heappop(self.heap)
+                return (itemInfo, attempt)
+            return None
+        finally:
+            self.lock.release()
+
+    def timeUntilReady(self):
+        """
+        Returns seconds until the next item is ready, or None if nothing is queued
+        """
+        self.lock.acquire()
+        try:
+            if not self.heap:
+                return None
+            return max(self.heap[0][0] - time.time(), 0)
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.heap)
@@ -22,6 +22,9 @@ from rhn_transport import RHNTransport
 
 LOG = logging.getLogger("grinder.SatDumpClient")
 class SatDumpClient(object):
+    # Packages asked for per packages_short call
+    BATCH_SIZE = 500
+
     def __init__(self, url, verbose=False, transport=None):
         self.baseURL = url
         if not transport:
@@ -116,17 +119,10 @@ class SatDumpClient(object):
           dict of short package info
             key is the name.arch if filterLatest=True, or NEVRA if filterLatest=False
         """
-        dom = self.client.dump.packages_short(systemId, listOfPackages)
-        #Example of data
-        # <rhn-package-short name="perl-Sys-Virt" package-size="137602" 
-        #  md5sum="dfd888260a1618e0a2cb6b3b5b1feff9" 
-        #  package-arch="i386" last-modified="1251397645" epoch="" version="0.2.0" release="4.el5" 
-        #  id="rhn-package-492050"/>
-        #
-        rhn_package_shorts = dom.getElementsByTagName("rhn-package-short")
         packages = {}
-        for pkgShort in rhn_package_shorts:
-            pkgName, nevra, info = self.convertPkgShortToDict(pkgShort)
+        for info in self.iterShortPackageInfo(systemId, listOfPackages):
+            pkgName = info["name"]
+            nevra = info["nevra"]
             if filterLatest:
                 # only fetching latest packages, so dict key of 
                 # 'name'.'arch' is what we want to be unique
@@ -149,6 +145,45 @@ class SatDumpClient(object):
                 packages[nevra] = info
         return packages
 
+    def iterShortPackageInfo(self, systemId, listOfPackages, batchSize=None):
+        """
+        Generator of the short package info dicts of listOfPackages, see
+        getShortPackageInfo().  The info is asked for batchSize packages at
+        a time, so the packages read so far can be worked on while the rest
+        is still coming in, and only one batch is parsed in memory at once.
+        Packages with higher ids, which RHN gives the builds pushed later,
+        come first.
+        """
+        if batchSize is None:
+            batchSize = SatDumpClient.BATCH_SIZE
+        listOfPackages = list(listOfPackages)
+        listOfPackages.sort(lambda a, b: cmp(self.getPackageNumber(b), self.getPackageNumber(a)))
+        for start in range(0, len(listOfPackages), batchSize):
+            batch = listOfPackages[start:start + batchSize]
+            LOG.debug("Getting short metadata of packages %s to %s of %s" % \
+                    (start + 1, start + len(batch), len(listOfPackages)))
+            dom = self.client.dump.packages_short(systemId, batch)
+            #Example of data
+            # <rhn-package-short name="perl-Sys-Virt" package-size="137602" 
+            #  md5sum="dfd888260a1618e0a2cb6b3b5b1feff9" 
+            #  package-arch="i386" last-modified="1251397645" epoch="" version="0.2.0" release="4.el5" 
+            #  id="rhn-package-492050"/>
+            #
+            for pkgShort in dom.getElementsByTagName("rhn-package-short"):
+                pkgName, nevra, info = self.convertPkgShortToDict(pkgShort)
+                yield info
+            dom.unlink()
+
+    def getPackageNumber(self, packageId):
+        """
+        Returns the number of a rhn-package-id, e.g. 492050 for
+        'rhn-package-492050', or -1 if it has none
+        """
+        try:
+            return int(packageId.split("-")[-1])
+        except ValueError:
+            return -1
+
     def isNewerEVR(self, pkgOne, pkgTwo):
         # Only check for packages of same arch
         if pkgOne["arch"] != pkgTwo["arch"]:
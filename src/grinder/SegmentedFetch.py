@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import os
+import logging
+import pycurl
+
+from FileUtils import WRITE_BUFFER_SIZE, preallocate
+
+LOG = logging.getLogger("grinder.SegmentedFetch")
+
+class Segment(object):
+    """
+    One byte range of a SegmentedDownload, written in place into the part file.
+    Has the write()/header()/offset interface BaseFetch.setupCurl() expects.
+    """
+    def __init__(self, partPath, start, end, urlIndex, control=None):
+        self.partPath = partPath
+        self.control = control
+        self.start = start
+        self.end = end
+        self.urlIndex = urlIndex
+        self.received = 0
+        self.attempts = 0
+        self.offset = 0
+        self.status = None
+        self.rangeIgnored = False
+        self.file = None
+        # Set once the transfer has ended with the whole range received
+        self.done = False
+
+    def open(self):
+        self.status = None
+        self.file = open(self.partPath, "r+b", WRITE_BUFFER_SIZE)
+        self.file.seek(self.start + self.received)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def getRange(self):
+        return "%s-%s" % (self.start + self.received, self.end)
+
+    def isComplete(self):
+        return self.start + self.received > self.end
+
+    def header(self, line):
+        if line.startswith("HTTP/"):
+            try:
+                self.status = int(line.split()[1])
+            except (IndexError, ValueError):
+                self.status = None
+
+    def progress(self, downloadTotal, downloaded, uploadTotal, uploaded):
+        return self.control is not None and self.control.cancelled
+
+    def write(self, data):
+        # Returning a count other than len(data) makes curl abort the transfer
+        if self.control is not None and self.control.cancelled:
+            return 0
+        if self.status == 200:
+            # Server ignored the Range request
+            self.rangeIgnored = True
+            return 0
+        if self.status != 206:
+            # Error page, don't let it into the file
+            return
+        if self.start + self.received + len(data) > self.end + 1:
+            LOG.error("Received more data than requested for range %s-%s of %s" % \
+                    (self.start, self.end, self.partPath))
+            return 0
+        self.file.write(data)
+        self.received += len(data)
+
+class SegmentedDownload(object):
+    """
+    Downloads one large file as numSegments byte ranges fetched concurrently,
+    spread over the given mirror urls.  Each range is written in place into
+    filePath + ".part", which is left for the caller to validate and commit.
+    A failed range is retried on the next mirror, resuming where it stopped.
+    Cancelling control aborts every range.
+    """
+    MAX_SEGMENT_ATTEMPTS = 3
+
+    def __init__(self, fetcher, filePath, urls, itemSize, headers=None, numSegments=4, control=None):
+        self.fetcher = fetcher
+        self.control = control
+        self.filePath = filePath
+        self.partPath = filePath + ".part"
+        self.urls = urls
+        self.itemSize = int(itemSize)
+        self.headers = headers
+        self.segments = []
+        self.handles = {}
+        self.failed = False
+        self.rangeIgnored = False
+        # Size the part file up front, each segment writes into its own region
+        f = open(self.partPath, "wb")
+        f.truncate(self.itemSize)
+        preallocate(f, 0, self.itemSize, keepSize=False)
+        f.close()
+        segmentSize = self.itemSize / numSegments
+        for i in range(numSegments):
+            start = i * segmentSize
+            end = start + segmentSize - 1
+            if i == numSegments - 1:
+                end = self.itemSize - 1
+            self.segments.append(Segment(self.partPath, start, end, i % len(urls), control))
+        LOG.info("Fetching %s bytes: %s as %s segments from %s mirror(s)" % \
+                (self.itemSize, os.path.basename(filePath), numSegments, len(urls)))
+
+    def start(self, multi):
+        """
+        Adds a transfer for every segment to the CurlMulti object
+        """
+        for segment in self.segments:
+            curl = pycurl.Curl()
+            self.handles[curl] = segment
+            self.startSegment(multi, curl, segment)
+
+    def startSegment(self, multi, curl, segment):
+        curl.reset()
+        segment.open()
+        self.fetcher.setupCurl(curl, self.urls[segment.urlIndex], self.headers, segment)
+        curl.setopt(pycurl.RANGE, segment.getRange())
+        multi.add_handle(curl)
+
+    def finish(self, multi, curl, errmsg):
+        """
+        Handles a segment transfer ending, errmsg is set if curl reported an error.
+        Returns True once the whole download is done, successfully or not.
+        """
+        segment = self.handles.get(curl)
+        if segment is None:
+            # Already aborted
+            return True
+        multi.remove_handle(curl)
+        segment.close()
+        if segment.rangeIgnored:
+            LOG.info("%s does not support range requests" % (self.urls[segment.urlIndex]))
+            self.rangeIgnored = True
+            return self.abort(multi)
+        if self.control is not None and self.control.cancelled:
+            self.failed = True
+            return self.abort(multi)
+        if not errmsg and segment.status == 206 and segment.isComplete():
+            segment.done = True
+            if self.isComplete():
+                self.close()
+                return True
+            return False
+        segment.attempts += 1
+        LOG.warn("Segment %s of %s failed with <%s> (response %s), %s bytes received" % \
+                (segment.getRange(), self.partPath, errmsg, segment.status, segment.received))
+        if segment.attempts >= SegmentedDownload.MAX_SEGMENT_ATTEMPTS:
+            self.failed = True
+            return self.abort(multi)
+        # Try the next mirror for the rest of the range
+        segment.urlIndex = (segment.urlIndex + 1) % len(self.urls)
+        self.startSegment(multi, curl, segment)
+        return False
+
+    def abort(self, multi):
+        for curl, segment in self.handles.items():
+            if segment.file:
+                multi.remove_handle(curl)
+                segment.close()
+        self.close()
+        return True
+
+    def isComplete(self):
+        for segment in self.segments:
+            if not segment.done:
+                return False
+        return True
+
+    def getHandles(self):
+        return self.handles.keys()
+
+    def close(self):
+        for curl in self.handles.keys():
+            curl.close()
+        self.handles = {}
+
+    def perform(self):
+        """
+        Runs the download to completion with its own CurlMulti object
+        """
+        multi = pycurl.CurlMulti()
+        self.start(multi)
+        done = False
+        while not done:
+            while 1:
+                ret, numHandles = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while not done:
+                numQueued, okList, errList = multi.info_read()
+                for curl in okList:
+                    done = self.finish(multi, curl, None) or done
+                for curl, errno, errmsg in errList:
+                    done = self.finish(multi, curl, errmsg) or done
+                if numQueued == 0:
+                    break
+            if not done:
+                multi.select(1.0)
+        multi.close()
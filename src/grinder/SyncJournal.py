@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+import os
+import time
+import logging
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from BaseFetch import BaseFetch
+
+LOG = logging.getLogger("grinder.SyncJournal")
+
+JOURNAL_FILENAME = ".grinder-journal"
+
+# Record types
+START = 'start'
+ITEM = 'item'
+PLANNED = 'planned'
+DONE = 'done'
+FINISHED = 'finished'
+
+class SyncJournal(object):
+    """
+    On disk record of the sync of one channel: the plan, every item to be
+    fetched, and the final status of each item done.  Records are appended
+    as they happen and flushed, so they survive the sync being killed, and
+    a later run can fetch just the items left or those which failed, see
+    getItems(), without reading the channel's metadata again.
+    A record cut short by a crash ends the journal, it is dropped when the
+    journal is appended to again.
+    """
+    def __init__(self, journalPath, getKey):
+        """
+        getKey = function returning the key identifying an item, e.g. the
+            file name of a package
+        """
+        self.journalPath = journalPath
+        self.getKey = getKey
+        self.lock = threading.Lock()
+        self.file = None
+        self.reset()
+
+    def reset(self):
+        self.label = None
+        self.started = None
+        # Keys of the items, in the order they were planned
+        self.keys = []
+        # key -> itemInfo
+        self.items = {}
+        # key -> final status
+        self.statuses = {}
+        self.planComplete = False
+        self.finished = False
+        # Offset after the last whole record
+        self.validLength = 0
+
+    def load(self):
+        """
+        Reads the journal, returns False if there is none
+        """
+        self.reset()
+        if not os.path.exists(self.journalPath):
+            return False
+        f = open(self.journalPath, "rb")
+        try:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception, e:
+                    LOG.warn("Journal %s ends in an incomplete record: %s" % (self.journalPath, e))
+                    break
+                self.apply(record)
+                self.validLength = f.tell()
+        finally:
+            f.close()
+        LOG.debug("Loaded journal %s: %s items planned, %s done" % \
+                (self.journalPath, len(self.keys), len(self.statuses)))
+        return True
+
+    def apply(self, record):
+        kind = record[0]
+        if kind == START:
+            self.reset()
+            self.label, self.started = record[1:3]
+        elif kind == ITEM:
+            key, itemInfo = record[1:3]
+            if not self.items.has_key(key):
+                self.keys.append(key)
+            self.items[key] = itemInfo
+        elif kind == PLANNED:
+            self.planComplete = True
+        elif kind == DONE:
+            key, status = record[1:3]
+            self.statuses[key] = status
+        elif kind == FINISHED:
+            self.finished = True
+
+    def start(self, label):
+        """
+        Starts a new journal for the sync of 'label', dropping the old one
+        """
+        self.lock.acquire()
+        try:
+            self.closeFile()
+            self.reset()
+            self.label = label
+            self.started = time.time()
+            self.file = open(self.journalPath, "wb")
+            self.write((START, label, self.started))
+        finally:
+            self.lock.release()
+
+    def reopen(self):
+        """
+        Appends to the journal loaded, after its last whole record
+        """
+        self.lock.acquire()
+        try:
+            self.closeFile()
+            self.file = open(self.journalPath, "r+b")
+            self.file.truncate(self.validLength)
+            self.file.seek(self.validLength)
+        finally:
+            self.lock.release()
+
+    def write(self, record):
+        """
+        Appends record, called holding the lock
+        """
+        if self.file is None:
+            return
+        pickle.dump(record, self.file, 2)
+        self.file.flush()
+
+    def record(self, record):
+        self.lock.acquire()
+        try:
+            self.apply(record)
+            self.write(record)
+        finally:
+            self.lock.release()
+
+    def addPlanned(self, itemInfo):
+        # Only written, the items are kept in memory just when loaded
+        self.lock.acquire()
+        try:
+            self.write((ITEM, self.getKey(itemInfo), itemInfo))
+        finally:
+            self.lock.release()
+
+    def setPlanComplete(self):
+        """
+        Records that all items of the sync have been planned
+        """
+        self.record((PLANNED,))
+
+    def itemDone(self, itemInfo, status):
+        """
+        Records the final status of an item, may be used as a completion
+        listener, see ParallelFetch.addCompletionListener()
+        """
+        self.record((DONE, self.getKey(itemInfo), status))
+
+    def setFinished(self):
+        """
+        Records that the sync has been finished, e.g. its repodata created
+        """
+        self.record((FINISHED,))
+
+    def isPlanComplete(self):
+        return self.planComplete
+
+    def isFinished(self):
+        return self.finished
+
+    def isFailed(self, status):
+        return status in BaseFetch.RETRY_STATUSES
+
+    def getItems(self, unfinished=True, failed=False):
+        """
+        Returns the items planned, in the order they were
+          unfinished = if True, those without a final status
+          failed = if True, those which failed, see isFailed()
+        """
+        items = []
+        self.lock.acquire()
+        try:
+            for key in self.keys:
+                status = self.statuses.get(key)
+                if (unfinished and status is None) or (failed and status is not None and self.isFailed(status)):
+                    items.append(self.items[key])
+        finally:
+            self.lock.release()
+        return items
+
+    def closeFile(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.closeFile()
+        finally:
+            self.lock.release()
+
+def getSyncJournal(savePath):
+    """
+    Returns the SyncJournal kept alongside the packages synced into
+    savePath, its items are keyed by their 'filename'
+    """
+    if not os.path.isdir(savePath):
+        os.makedirs(savePath)
+    return SyncJournal(os.path.join(savePath, JOURNAL_FILENAME), lambda itemInfo: itemInfo['filename'])
@@ -0,0 +1,355 @@
+import unittest
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+import BaseHTTPServer
+sys.path.append("../src/")
+from grinder.BaseFetch import BaseFetch
+from grinder.MultiFetch import MultiFetch
+from grinder.ChecksumCache import getChecksumCache
+from grinder.PackageStore import PackageStore
+from grinder import GrinderLog
+
+class FileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves server.files, honouring a Range header only if server.ranges is set
+    """
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        rangeHeader = self.headers.getheader("Range")
+        self.server.requests.append((self.path, rangeHeader))
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if rangeHeader and self.server.ranges:
+            start = int(rangeHeader.split("=")[1].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%s" % (len(data)))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %s-%s/%s" % (start, len(data) - 1, len(data)))
+            data = data[start:]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class TestFetcher(BaseFetch):
+    def __init__(self, baseURL, savePath):
+        BaseFetch.__init__(self)
+        self.baseURL = baseURL
+        self.savePath = savePath
+
+    def getFetchRequest(self, itemInfo):
+        return {'fileName': itemInfo['name'], 'fetchURL': self.baseURL + itemInfo['name'],
+                'itemSize': itemInfo['size'], 'hashtype': 'sha256', 'checksum': itemInfo['checksum'],
+                'savePath': self.savePath}
+
+    def fetchItem(self, itemInfo):
+        return self.fetch(**self.getFetchRequest(itemInfo))
+
+class TestPartFiles(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.data = "".join([chr(i % 251) for i in range(20000)])
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), FileHandler)
+        self.server.files = {"/item.bin": self.data}
+        self.server.ranges = True
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.baseURL = "http://127.0.0.1:%s/" % (self.server.server_address[1])
+        self.savePath = tempfile.mkdtemp()
+        self.filePath = os.path.join(self.savePath, "item.bin")
+        self.partPath = self.filePath + ".part"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.savePath)
+
+    def getItem(self, size=None, checksum=None):
+        if size is None:
+            size = len(self.data)
+        if checksum is None:
+            checksum = hashlib.sha256(self.data).hexdigest()
+        return {'name': 'item.bin', 'size': size, 'checksum': checksum}
+
+    def fetch(self, item=None):
+        if item is None:
+            item = self.getItem()
+        return TestFetcher(self.baseURL, self.savePath).fetchItem(item)
+
+    def writePart(self, data):
+        f = open(self.partPath, "wb")
+        f.write(data)
+        f.close()
+
+    def assertFetched(self):
+        self.assertFalse(os.path.exists(self.partPath))
+        self.assertEqual(open(self.filePath, "rb").read(), self.data)
+
+    def test_resumeFromPartial(self):
+        """
+        Test a partial file is resumed from with a range request
+        """
+        self.writePart(self.data[:1000])
+        self.assertEqual(self.fetch(), BaseFetch.STATUS_DOWNLOADED)
+        self.assertEqual(self.server.requests, [("/item.bin", "bytes=1000-")])
+        self.assertFetched()
+
+    def test_partTooBig(self):
+        """
+        Test a part file at least as big as the item is dropped, not resumed from
+        """
+        self.writePart(self.data + "garbage")
+        self.assertEqual(self.fetch(), BaseFetch.STATUS_DOWNLOADED)
+        self.assertEqual(self.server.requests, [("/item.bin", None)])
+        self.assertFetched()
+
+    def test_commitAfterValidation(self):
+        """
+        Test a download is only moved into place once its checksum is verified
+        """
+        self.assertEqual(self.fetch(self.getItem(checksum="0" * 64)), BaseFetch.STATUS_MD5_MISSMATCH)
+        self.assertFalse(os.path.exists(self.filePath))
+        self.assertFalse(os.path.exists(self.partPath))
+        self.assertEqual(self.fetch(), BaseFetch.STATUS_DOWNLOADED)
+        self.assertFetched()
+
+    def test_shortDownloadKept(self):
+        """
+        Test a download cut short is kept to resume from, not moved into place
+        """
+        self.server.files["/item.bin"] = self.data[:5000]
+        self.assertEqual(self.fetch(), BaseFetch.STATUS_SIZE_MISSMATCH)
+        self.assertFalse(os.path.exists(self.filePath))
+        self.assertEqual(os.path.getsize(self.partPath), 5000)
+
+    def test_rangeNotSatisfiable(self):
+        """
+        Test a 416 response to a resumed fetch discards the part file
+        """
+        self.server.files["/item.bin"] = self.data[:500]
+        self.writePart(self.data[:1000])
+        self.assertEqual(self.fetch(), BaseFetch.STATUS_ERROR)
+        self.assertFalse(os.path.exists(self.partPath))
+        self.assertFalse(os.path.exists(self.filePath))
+
+    def test_rangeNotSupported(self):
+        """
+        Test a part file is dropped and the item fetched from the start when
+        the server ignores range requests
+        """
+        self.server.ranges = False
+        self.writePart(self.data[:1000])
+        self.assertEqual(self.fetch(), BaseFetch.STATUS_DOWNLOADED)
+        self.assertEqual(self.server.requests, [("/item.bin", "bytes=1000-"), ("/item.bin", None)])
+        self.assertFetched()
+
+    def test_rangeNotSupportedMultiFetch(self):
+        """
+        Test MultiFetch starts over too when the server ignores range requests
+        """
+        self.server.ranges = False
+        self.writePart(self.data[:1000])
+        engine = MultiFetch(TestFetcher(self.baseURL, self.savePath), 2)
+        engine.addItem(self.getItem())
+        engine.start()
+        report = engine.waitForFinish()
+        self.assertEqual(report.downloads, 1)
+        self.assertEqual(report.errors, 0)
+        self.assertFetched()
+
+class CountingStore(PackageStore):
+    """
+    PackageStore counting the files added to it
+    """
+    def __init__(self, storePath):
+        PackageStore.__init__(self, storePath)
+        self.numAdded = 0
+
+    def add(self, filePath, hashtype, checksum):
+        self.numAdded += 1
+        PackageStore.add(self, filePath, hashtype, checksum)
+
+class TestExistingFiles(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.data = "existing package"
+        self.checksum = hashlib.sha256(self.data).hexdigest()
+        self.savePath = tempfile.mkdtemp()
+        f = open(os.path.join(self.savePath, "item.bin"), "wb")
+        f.write(self.data)
+        f.close()
+        self.store = CountingStore(os.path.join(self.savePath, "store"))
+        self.cache = getChecksumCache(self.savePath)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.savePath)
+
+    def prepareFetch(self, deepVerify=False):
+        fetcher = TestFetcher(None, self.savePath)
+        fetcher.setChecksumCache(self.cache, deepVerify)
+        fetcher.setPackageStore(self.store)
+        return fetcher.prepareFetch("item.bin", "sha256", self.checksum, self.savePath)
+
+    def test_recordedOnce(self):
+        """
+        Test an existing file is recorded in the checksum cache and package
+        store when it is hashed, not again while the cache vouches for it
+        """
+        self.assertEqual(self.prepareFetch(), None)
+        self.assertEqual(self.store.numAdded, 1)
+        self.assertTrue(self.store.hasBlob("sha256", self.checksum))
+        numLines = self.cache.numLines
+        self.assertEqual(self.prepareFetch(), None)
+        self.assertEqual(self.store.numAdded, 1)
+        self.assertEqual(self.cache.numLines, numLines)
+
+    def test_alreadyStored(self):
+        """
+        Test a file hashed again but already linked into the package store
+        isn't added to it again
+        """
+        self.assertEqual(self.prepareFetch(), None)
+        self.assertEqual(self.prepareFetch(deepVerify=True), None)
+        self.assertEqual(self.store.numAdded, 1)
+        self.assertTrue(self.store.isStored(os.path.join(self.savePath, "item.bin"),
+                "sha256", self.checksum))
+
+    def test_storedLater(self):
+        """
+        Test a file the checksum cache vouches for, from a sync without the
+        package store, is added to the store once
+        """
+        store = self.store
+        self.store = None
+        self.assertEqual(self.prepareFetch(), None)
+        self.store = store
+        self.assertEqual(self.prepareFetch(), None)
+        self.assertEqual(self.prepareFetch(), None)
+        self.assertEqual(self.store.numAdded, 1)
+        self.assertTrue(self.store.hasBlob("sha256", self.checksum))
+
+    def test_changedFile(self):
+        """
+        Test an existing file with the wrong checksum is fetched and not stored
+        """
+        self.checksum = "0" * 64
+        filePath = os.path.join(self.savePath, "item.bin")
+        self.assertEqual(self.prepareFetch(), filePath)
+        self.assertEqual(self.store.numAdded, 0)
+        self.assertEqual(self.prepareFetch(), filePath)
+        self.assertEqual(self.cache.numLines, 1)
+class TestCurlHandles(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.data = "".join([chr(i % 251) for i in range(20000)])
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), FileHandler)
+        self.server.files = {"/item.bin": self.data, "/other.bin": self.data}
+        self.server.ranges = True
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.savePath = tempfile.mkdtemp()
+        self.fetcher = TestFetcher("http://127.0.0.1:%s/" % (self.server.server_address[1]), self.savePath)
+
+    def tearDown(self):
+        self.fetcher.closeCurl()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.savePath)
+
+    def getCurlInThread(self):
+        """
+        Returns the handle getCurl() gives another thread, closed
+        """
+        handles = []
+        def run():
+            handles.append(self.fetcher.getCurl())
+            self.fetcher.closeCurl()
+        t = threading.Thread(target=run)
+        t.start()
+        t.join()
+        return handles[0]
+
+    def test_handlePerThread(self):
+        """
+        Test each thread gets a handle of its own, kept until closeCurl()
+        """
+        curl = self.fetcher.getCurl()
+        self.assertTrue(self.fetcher.getCurl() is curl)
+        self.assertFalse(self.getCurlInThread() is curl)
+        self.assertTrue(self.fetcher.getCurl() is curl)
+        self.fetcher.closeCurl()
+        self.assertFalse(self.fetcher.getCurl() is curl)
+
+    def test_resetBetweenFetches(self):
+        """
+        Test a thread's fetches share its handle, with no options left over
+        from the fetch before, e.g. the offset it resumed from
+        """
+        f = open(os.path.join(self.savePath, "item.bin.part"), "wb")
+        f.write(self.data[:1000])
+        f.close()
+        checksum = hashlib.sha256(self.data).hexdigest()
+        item = {'name': "item.bin", 'size': len(self.data), 'checksum': checksum}
+        self.assertEqual(self.fetcher.fetchItem(item), BaseFetch.STATUS_DOWNLOADED)
+        curl = self.fetcher.getCurl()
+        item = {'name': "other.bin", 'size': len(self.data), 'checksum': checksum}
+        self.assertEqual(self.fetcher.fetchItem(item), BaseFetch.STATUS_DOWNLOADED)
+        self.assertTrue(self.fetcher.getCurl() is curl)
+        self.assertEqual(self.server.requests, [("/item.bin", "bytes=1000-"), ("/other.bin", None)])
+        self.assertEqual(open(os.path.join(self.savePath, "other.bin"), "rb").read(), self.data)
+
+    def test_share(self):
+        """
+        Test the handles of all threads are attached to the fetcher's share
+        handle once, and a forked process starts with handles and a share of
+        its own
+        """
+        share = self.fetcher.curlShare
+        if share is None:
+            # pycurl can't share anything
+            return
+        curl = self.fetcher.getCurl()
+        self.fetcher.setupConnection(curl)
+        self.assertTrue(curl.curlShare is share)
+        # Attaching it again would fail
+        self.fetcher.setupConnection(self.fetcher.getCurl())
+        self.fetcher.resetAfterFork()
+        self.assertFalse(self.fetcher.curlShare is share)
+        self.assertFalse(self.fetcher.getCurl() is curl)
+        curl.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+
+import sys
+import threading
+sys.path.append("../src/")
+from grinder import ConcurrencyControl as concurrencycontrol
+from grinder.ConcurrencyControl import ConcurrencyController
+from grinder.BaseFetch import BaseFetch
+from grinder import GrinderLog
+from test_RetryQueue import FakeClock
+
+class TestConcurrencyController(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.realTime = concurrencycontrol.time
+        concurrencycontrol.time = self.clock
+
+    def tearDown(self):
+        concurrencycontrol.time = self.realTime
+
+    def runWindow(self, controller, numBytes=1000, seconds=1.0, ok=True):
+        """
+        Records a fetch ending a window of controller.interval seconds,
+        returns the limit it was adjusted to
+        """
+        self.clock.sleep(controller.interval)
+        controller.record(numBytes, seconds, ok)
+        return controller.getLimit()
+
+    def test_limits(self):
+        """
+        Test the initial limit is clamped between the minimum and maximum,
+        and the minimum is at least 1
+        """
+        self.assertEqual(ConcurrencyController(10, 1, 4).getLimit(), 4)
+        self.assertEqual(ConcurrencyController(1, 2, 4).getLimit(), 2)
+        controller = ConcurrencyController(0, 0, 4)
+        self.assertEqual(controller.minimum, 1)
+        self.assertEqual(controller.getLimit(), 1)
+        controller = ConcurrencyController(3, 5, 2)
+        self.assertEqual(controller.maximum, 5)
+        self.assertEqual(controller.getLimit(), 5)
+
+    def test_increase(self):
+        """
+        Test the limit grows by one each window which goes well, up to the
+        maximum, and not before the window is over
+        """
+        controller = ConcurrencyController(2, 1, 4)
+        self.clock.sleep(controller.interval - 1)
+        controller.record(1000, 1.0, True)
+        self.assertEqual(controller.getLimit(), 2)
+        self.assertEqual(self.runWindow(controller), 3)
+        # Same throughput and latency, nothing says the server is struggling
+        self.assertEqual(self.runWindow(controller), 4)
+        self.assertEqual(self.runWindow(controller), 4)
+
+    def test_decreaseOnErrors(self):
+        """
+        Test the limit is halved each window with too many failed fetches,
+        down to the minimum
+        """
+        controller = ConcurrencyController(10, 2, 10)
+        self.assertEqual(self.runWindow(controller, ok=False), 5)
+        self.assertEqual(self.runWindow(controller, ok=False), 2)
+        self.assertEqual(self.runWindow(controller, ok=False), 2)
+        # Few enough failures among the window's fetches
+        for i in range(20):
+            controller.record(1000, 1.0, True)
+        self.assertEqual(self.runWindow(controller, ok=False), 3)
+
+    def test_decreaseOnQueueing(self):
+        """
+        Test the limit is halved when the fetches take much longer per byte
+        without the throughput growing, but not when it grew
+        """
+        controller = ConcurrencyController(4, 1, 10)
+        self.assertEqual(self.runWindow(controller, 1000, 1.0), 5)
+        self.assertEqual(self.runWindow(controller, 1000, 3.0), 2)
+        # Twice the throughput makes up for the latency
+        self.assertEqual(self.runWindow(controller, 2000, 6.0), 3)
+
+    def test_recordStatus(self):
+        """
+        Test fetches which say nothing about the server are left out, retried
+        statuses count as failures
+        """
+        controller = ConcurrencyController(4, 1, 10)
+        self.clock.sleep(controller.interval)
+        for status in [BaseFetch.STATUS_NOOP, BaseFetch.STATUS_CANCELLED, BaseFetch.STATUS_UNAUTHORIZED]:
+            controller.recordStatus(status, 1.0, 1000)
+        self.assertEqual(controller.windowFetches, 0)
+        self.assertEqual(controller.getLimit(), 4)
+        controller.recordStatus(BaseFetch.STATUS_DOWNLOADED, 1.0, "1000")
+        self.assertEqual(controller.getLimit(), 5)
+        self.clock.sleep(controller.interval)
+        controller.recordStatus(BaseFetch.STATUS_MD5_MISSMATCH, 1.0, 1000)
+        self.assertEqual(controller.getLimit(), 2)
+
+    def test_acquire(self):
+        """
+        Test no more than limit fetches are let through, and a waiting
+        acquire() gives up once stopEvent is set
+        """
+        controller = ConcurrencyController(2, 1, 4)
+        self.assertTrue(controller.acquire())
+        self.assertTrue(controller.acquire())
+        stopEvent = threading.Event()
+        stopEvent.set()
+        self.assertFalse(controller.acquire(stopEvent))
+        controller.release()
+        self.assertTrue(controller.acquire(stopEvent))
+        self.assertEqual(controller.active, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import unittest
+
+import sys
+import time
+import threading
+sys.path.append("../src/")
+from grinder import FetchProgress as fetchprogress
+from grinder.FetchProgress import FetchProgress, WorkerState
+from grinder import GrinderLog
+from test_RetryQueue import FakeClock
+
+class Recorder(object):
+    """
+    Progress listener keeping the snapshots it is called with
+    """
+    def __init__(self):
+        self.snapshots = []
+        self.lock = threading.Lock()
+
+    def __call__(self, snapshot):
+        self.lock.acquire()
+        try:
+            self.snapshots.append(snapshot)
+        finally:
+            self.lock.release()
+
+    def getCount(self):
+        self.lock.acquire()
+        try:
+            return len(self.snapshots)
+        finally:
+            self.lock.release()
+
+class TestSnapshot(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.realTime = fetchprogress.time
+        fetchprogress.time = self.clock
+
+    def tearDown(self):
+        fetchprogress.time = self.realTime
+
+    def test_counts(self):
+        """
+        Test the snapshot adds up the items and bytes added and finished,
+        failed items counting as done
+        """
+        progress = FetchProgress()
+        for size in [1000, 2000, 3000]:
+            progress.itemAdded(size)
+        progress.itemFinished(1000)
+        progress.itemFinished(2000, failed=True)
+        s = progress.getSnapshot()
+        self.assertEqual((s.itemsTotal, s.itemsDone, s.itemsFailed), (3, 2, 1))
+        self.assertEqual(s.getItemsRemaining(), 1)
+        self.assertEqual((s.bytesTotal, s.bytesDone), (6000, 3000))
+        self.assertEqual(s.getBytesRemaining(), 3000)
+        self.assertFalse(s.finished)
+
+    def test_rate(self):
+        """
+        Test the rate is averaged over the seconds since the start, at most
+        RATE_WINDOW of them, and the ETA follows from it
+        """
+        progress = FetchProgress()
+        progress.itemAdded(10000)
+        write = progress.countWrites(lambda data: None)
+        write("x" * 1000)
+        self.clock.sleep(1)
+        progress.countBytes(1000)
+        self.clock.sleep(1)
+        s = progress.getSnapshot()
+        self.assertEqual(s.bytesReceived, 2000)
+        self.assertAlmostEqual(s.bytesPerSec, 1000.0)
+        self.assertAlmostEqual(s.eta, 10.0)
+        self.assertAlmostEqual(s.elapsed, 2.0)
+        # Nothing received within the window
+        self.clock.sleep(FetchProgress.RATE_WINDOW + 1)
+        s = progress.getSnapshot()
+        self.assertEqual(s.bytesPerSec, 0.0)
+        self.assertEqual(s.eta, None)
+        self.assertEqual(s.bytesReceived, 2000)
+        for i in range(FetchProgress.RATE_WINDOW * 2):
+            progress.countBytes(10)
+            self.clock.sleep(1)
+        self.assertEqual(len(progress.buckets), FetchProgress.RATE_WINDOW + 1)
+
+    def test_workers(self):
+        """
+        Test the workers are listed in the order they were first seen, with
+        their latest state
+        """
+        progress = FetchProgress()
+        progress.setWorkerState("w1", WorkerState.IDLE)
+        progress.setWorkerState("w0", WorkerState.IDLE)
+        progress.setWorkerState("w2", WorkerState.IDLE)
+        progress.setWorkerState("w1", WorkerState.FETCHING, "a.rpm", "host")
+        progress.removeWorker("w2")
+        progress.removeWorker("missing")
+        workers = progress.getSnapshot().workers
+        self.assertEqual([w.name for w in workers], ["w1", "w0"])
+        self.assertEqual((workers[0].state, workers[0].itemInfo, workers[0].host),
+                (WorkerState.FETCHING, "a.rpm", "host"))
+        self.assertTrue("1 of 2 workers fetching" in str(progress.getSnapshot()))
+
+class TestListeners(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def test_intervals(self):
+        """
+        Test each listener is called every interval seconds of its own once
+        the engine has started, not before
+        """
+        progress = FetchProgress()
+        fast = Recorder()
+        slow = Recorder()
+        progress.addListener(fast, 0.05)
+        progress.addListener(slow, 0.5)
+        time.sleep(0.2)
+        self.assertEqual(fast.getCount(), 0)
+        try:
+            progress.start()
+            time.sleep(0.7)
+        finally:
+            progress.finish()
+        # Called as it starts, then after 0.5 seconds, then by finish()
+        self.assertEqual(slow.getCount(), 3)
+        self.assertTrue(fast.getCount() >= 8)
+
+    def test_finish(self):
+        """
+        Test finish() sends one last snapshot with finished set to every
+        listener, also one that failed before, and nothing after
+        """
+        progress = FetchProgress()
+        progress.itemAdded(1000)
+        progress.itemFinished(1000)
+        listener = Recorder()
+        def failing(snapshot):
+            raise Exception("listener failed")
+        progress.addListener(failing, 0.05)
+        progress.addListener(listener, 0.05)
+        progress.start()
+        time.sleep(0.2)
+        progress.finish()
+        count = listener.getCount()
+        last = listener.snapshots[-1]
+        self.assertTrue(count >= 2)
+        self.assertTrue(last.finished)
+        self.assertEqual(last.eta, 0)
+        self.assertEqual(last.itemsDone, 1)
+        self.assertEqual([s.finished for s in listener.snapshots].count(True), 1)
+        self.assertFalse(progress.reporter)
+        time.sleep(0.2)
+        self.assertEqual(listener.getCount(), count)
+
+    def test_finishWithoutStart(self):
+        """
+        Test listeners of an engine which finished without starting still get
+        the final snapshot
+        """
+        progress = FetchProgress()
+        listener = Recorder()
+        progress.addListener(listener)
+        progress.finish()
+        self.assertEqual(len(listener.snapshots), 1)
+        self.assertTrue(listener.snapshots[0].finished)
+        # Too late to start reporting
+        progress.start()
+        self.assertEqual(progress.reporter, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+sys.path.append("../src/")
+from grinder import FileUtils as fileutils
+from grinder.FileUtils import preallocate
+from grinder.BaseFetch import DownloadFile
+from grinder import GrinderLog
+
+class TestPreallocate(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.realFallocate = fileutils._fallocate
+        self.tempDir = tempfile.mkdtemp()
+        self.filePath = os.path.join(self.tempDir, "item.bin")
+
+    def tearDown(self):
+        fileutils._fallocate = self.realFallocate
+        shutil.rmtree(self.tempDir)
+
+    def test_preallocate(self):
+        """
+        Test space is reserved, leaving the file's size alone with keepSize
+        """
+        if fileutils._fallocate is None:
+            # Nothing to test without fallocate()
+            return
+        f = open(self.filePath, "wb")
+        self.assertTrue(preallocate(f, 0, 1048576))
+        self.assertEqual(os.fstat(f.fileno()).st_size, 0)
+        self.assertTrue(os.fstat(f.fileno()).st_blocks * 512 >= 1048576)
+        self.assertTrue(preallocate(f, 0, 1000, keepSize=False))
+        self.assertEqual(os.fstat(f.fileno()).st_size, 1000)
+        f.close()
+
+    def test_unavailable(self):
+        """
+        Test nothing is reserved without fallocate(), and downloads are
+        still written in full
+        """
+        fileutils._fallocate = None
+        f = open(self.filePath, "wb")
+        self.assertFalse(preallocate(f, 0, 1000))
+        self.assertFalse(preallocate(f, 0, 1000, keepSize=False))
+        f.close()
+        self.assertEqual(os.path.getsize(self.filePath), 0)
+        data = "x" * 5000
+        downloadFile = DownloadFile(self.filePath, "sha256", len(data))
+        downloadFile.write(data)
+        downloadFile.close()
+        self.assertEqual(downloadFile.hexdigest(), hashlib.sha256(data).hexdigest())
+        downloadFile.commit()
+        self.assertEqual(open(self.filePath, "rb").read(), data)
+
+    def test_refused(self):
+        """
+        Test a filesystem refusing to reserve the space is reported, not raised
+        """
+        calls = []
+        def refuse(fd, mode, offset, length):
+            calls.append((mode, offset, length))
+            return -1
+        fileutils._fallocate = refuse
+        f = open(self.filePath, "wb")
+        self.assertFalse(preallocate(f, 10, 1000))
+        self.assertFalse(preallocate(f, 0, 1000, keepSize=False))
+        # Nothing left to reserve
+        self.assertFalse(preallocate(f, 1000, 0))
+        f.close()
+        self.assertEqual(calls, [(fileutils.FALLOC_FL_KEEP_SIZE, 10, 1000), (0, 0, 1000)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import unittest
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+import BaseHTTPServer
+sys.path.append("../src/")
+from grinder import BaseFetch as basefetch
+from grinder import HedgeTracker as hedgetracker
+from grinder.BaseFetch import BaseFetch, FetchControl
+from grinder.HedgeTracker import HedgeTracker
+from grinder import GrinderLog
+from test_BaseFetch import FileHandler, TestFetcher
+from test_RetryQueue import FakeClock
+
+class TestHedgeTracker(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.realTimes = (hedgetracker.time, basefetch.time)
+        hedgetracker.time = self.clock
+        basefetch.time = self.clock
+
+    def tearDown(self):
+        hedgetracker.time, basefetch.time = self.realTimes
+
+    def addSamples(self, tracker, rate=1000, numSamples=HedgeTracker.MIN_SAMPLES):
+        """
+        Finishes numSamples downloads of 10 seconds at rate bytes a second
+        """
+        for i in range(numSamples):
+            item = {'name': "sample%s" % (i)}
+            control = tracker.start(item, rate * 10)
+            self.clock.sleep(10)
+            tracker.finish(item, control, BaseFetch.STATUS_DOWNLOADED)
+
+    def test_noHedgeWithoutSamples(self):
+        """
+        Test nothing is hedged until enough downloads have finished to know
+        the median rate
+        """
+        tracker = HedgeTracker(4, minTime=1)
+        self.addSamples(tracker, numSamples=HedgeTracker.MIN_SAMPLES - 1)
+        tracker.start({'name': "slow"}, 1000)
+        self.clock.sleep(1000)
+        self.assertEqual(tracker.getHedge(), None)
+        self.addSamples(tracker, numSamples=1)
+        self.assertEqual(tracker.getHedge()[0], {'name': "slow"})
+
+    def test_threshold(self):
+        """
+        Test an item is hedged once it has run factor times longer than its
+        size over the median rate, and at least minTime
+        """
+        tracker = HedgeTracker(4, minTime=30)
+        # Median of 1000 bytes a second, 10000 bytes should take 10 seconds
+        self.addSamples(tracker, 500, 2)
+        self.addSamples(tracker, 1000, 1)
+        self.addSamples(tracker, 2000, 2)
+        item = {'name': "item"}
+        tracker.start(item, 10000, attempt=1)
+        self.clock.sleep(39)
+        self.assertEqual(tracker.getHedge(), None)
+        self.clock.sleep(1)
+        hedgedItem, attempt, control = tracker.getHedge()
+        self.assertEqual(hedgedItem, item)
+        self.assertEqual(attempt, 1)
+        self.assertTrue(control.hedge)
+        # Each item is hedged once
+        self.assertEqual(tracker.getHedge(), None)
+        # Expected to take 1 second, but isn't hedged before minTime
+        small = {'name': "small"}
+        tracker.start(small, 1000)
+        self.clock.sleep(29)
+        self.assertEqual(tracker.getHedge(), None)
+        self.clock.sleep(1)
+        self.assertEqual(tracker.getHedge()[0], small)
+        self.assertFalse(tracker.hasHedgeable())
+
+    def test_firstSuccessWins(self):
+        """
+        Test the first attempt to succeed is reported and the other cancelled,
+        a failed attempt only once the other has failed too
+        """
+        tracker = HedgeTracker(2, minTime=0)
+        self.addSamples(tracker)
+        item = {'name': "item"}
+        first = tracker.start(item, 10000)
+        self.clock.sleep(100)
+        hedge = tracker.getHedge()[2]
+        self.assertEqual(tracker.finish(item, hedge, BaseFetch.STATUS_DOWNLOADED), BaseFetch.STATUS_DOWNLOADED)
+        self.assertTrue(first.cancelled)
+        self.assertEqual(tracker.finish(item, first, BaseFetch.STATUS_CANCELLED), None)
+        other = {'name': "other"}
+        first = tracker.start(other, 10000)
+        self.clock.sleep(100)
+        hedge = tracker.getHedge()[2]
+        self.assertEqual(tracker.finish(other, first, BaseFetch.STATUS_ERROR), None)
+        self.assertFalse(hedge.cancelled)
+        self.assertEqual(tracker.finish(other, hedge, BaseFetch.STATUS_ERROR), BaseFetch.STATUS_ERROR)
+        self.assertEqual(tracker.inFlight, {})
+
+class TestHedgePartFiles(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.data = "".join([chr(i % 251) for i in range(20000)])
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), FileHandler)
+        self.server.files = {"/item.bin": self.data}
+        self.server.ranges = True
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.savePath = tempfile.mkdtemp()
+        self.filePath = os.path.join(self.savePath, "item.bin")
+        self.fetcher = TestFetcher("http://127.0.0.1:%s/" % (self.server.server_address[1]), self.savePath)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.savePath)
+
+    def hedgedFetch(self, checksum=None):
+        if checksum is None:
+            checksum = hashlib.sha256(self.data).hexdigest()
+        self.fetcher.setFetchControl(FetchControl(hedge=True))
+        try:
+            return self.fetcher.fetchItem({'name': "item.bin", 'size': len(self.data), 'checksum': checksum})
+        finally:
+            self.fetcher.setFetchControl(None)
+
+    def writeFile(self, path, data):
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+
+    def test_hedgeKeepsOwnPart(self):
+        """
+        Test a hedge downloads from the start to its own part file, leaving
+        the part file of the item's first attempt alone
+        """
+        self.writeFile(self.filePath + ".part", self.data[:1000])
+        self.writeFile(self.filePath + ".hedge.part", self.data[:2000])
+        self.assertEqual(self.hedgedFetch(), BaseFetch.STATUS_DOWNLOADED)
+        self.assertEqual(self.server.requests, [("/item.bin", None)])
+        self.assertEqual(open(self.filePath, "rb").read(), self.data)
+        self.assertFalse(os.path.exists(self.filePath + ".hedge.part"))
+        self.assertEqual(os.path.getsize(self.filePath + ".part"), 1000)
+
+    def test_failedHedgeCleanedUp(self):
+        """
+        Test the part file of a hedge that failed is removed, even when it
+        was cut short
+        """
+        self.server.files["/item.bin"] = self.data[:5000]
+        self.assertEqual(self.hedgedFetch(), BaseFetch.STATUS_SIZE_MISSMATCH)
+        self.assertFalse(os.path.exists(self.filePath + ".hedge.part"))
+        self.server.files["/item.bin"] = self.data
+        self.assertEqual(self.hedgedFetch("0" * 64), BaseFetch.STATUS_MD5_MISSMATCH)
+        self.assertFalse(os.path.exists(self.filePath + ".hedge.part"))
+        self.assertFalse(os.path.exists(self.filePath))
+
+    def test_cancelledHedgeCleanedUp(self):
+        """
+        Test a cancelled hedge removes its part file
+        """
+        control = FetchControl(hedge=True)
+        control.cancel()
+        self.fetcher.setFetchControl(control)
+        status = self.fetcher.fetchItem({'name': "item.bin", 'size': len(self.data),
+                'checksum': hashlib.sha256(self.data).hexdigest()})
+        self.assertEqual(status, BaseFetch.STATUS_CANCELLED)
+        self.assertFalse(os.path.exists(self.filePath + ".hedge.part"))
+
+if __name__ == '__main__':
+    unittest.main()
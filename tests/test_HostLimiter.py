@@ -0,0 +1,208 @@
+import unittest
+
+import sys
+import time
+import random
+import Queue
+import threading
+sys.path.append("../src/")
+from grinder.BaseFetch import BaseFetch
+from grinder.HostLimiter import HostLimiter, DEFAULT_MAX_DEFERRED
+from grinder.ParallelFetch import ParallelFetch, WorkerThread, END_OF_ITEMS
+from grinder import GrinderLog
+
+class HostFetcher(object):
+    """
+    Stub fetcher for items (name, host) or (name, host, size), records the
+    most fetches it saw in flight to each host at once.  If 'proceed' is
+    set fetches wait for it.
+    """
+    def __init__(self, delay=0.01, proceed=None):
+        self.delay = delay
+        self.proceed = proceed
+        self.inFlight = {}
+        self.maxInFlight = {}
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def getFetchRequest(self, itemInfo):
+        if len(itemInfo) > 2:
+            return {'itemSize': itemInfo[2]}
+        return {'itemSize': 1}
+
+    def getItemHost(self, itemInfo):
+        return itemInfo[1]
+
+    def fetchItem(self, itemInfo):
+        host = itemInfo[1]
+        self.lock.acquire()
+        try:
+            self.inFlight[host] = self.inFlight.get(host, 0) + 1
+            self.maxInFlight[host] = max(self.maxInFlight.get(host, 0), self.inFlight[host])
+        finally:
+            self.lock.release()
+        time.sleep(self.delay)
+        if self.proceed is not None:
+            self.proceed.wait()
+        self.lock.acquire()
+        try:
+            self.inFlight[host] -= 1
+            self.fetched.append(itemInfo)
+        finally:
+            self.lock.release()
+        return BaseFetch.STATUS_NOOP
+
+class TestHostLimiter(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def test_limits(self):
+        """
+        Test a host never gets more than its limit, per host limits override the default
+        """
+        limiter = HostLimiter(1, {"b": 2})
+        self.assertTrue(limiter.tryAcquire("a"))
+        self.assertFalse(limiter.tryAcquire("a"))
+        self.assertTrue(limiter.tryAcquire("b"))
+        self.assertTrue(limiter.tryAcquire("b"))
+        self.assertFalse(limiter.tryAcquire("b"))
+        limiter.release("a")
+        self.assertTrue(limiter.tryAcquire("a"))
+        # Unknown hosts aren't limited
+        self.assertTrue(limiter.tryAcquire(None))
+
+    def test_getDeferred(self):
+        """
+        Test a deferred item is only handed out once its host has room, with the host acquired
+        """
+        limiter = HostLimiter(1)
+        self.assertTrue(limiter.tryAcquire("a"))
+        limiter.defer("a", ("x", 0, None))
+        self.assertEqual(limiter.getDeferred(), None)
+        limiter.release("a")
+        self.assertEqual(limiter.getDeferred(), ("a", ("x", 0, None)))
+        self.assertFalse(limiter.hasDeferred())
+        self.assertFalse(limiter.tryAcquire("a"))
+
+    def test_deferredInOrder(self):
+        """
+        Test deferred items go in the order of their keys, then the order deferred,
+        and not ahead of the limit key
+        """
+        limiter = HostLimiter(1)
+        limiter.tryAcquire("a")
+        limiter.defer("a", ("small", 0, None), (0, -1))
+        limiter.defer("a", ("big", 0, None), (0, -9))
+        limiter.defer("a", ("big2", 0, None), (0, -9))
+        limiter.release("a")
+        self.assertEqual(limiter.getDeferred((0, -10)), None)
+        self.assertEqual(limiter.getDeferred((0, -9)), ("a", ("big", 0, None)))
+        limiter.release("a")
+        self.assertEqual(limiter.getDeferred(), ("a", ("big2", 0, None)))
+        limiter.release("a")
+        self.assertEqual(limiter.getDeferred(), ("a", ("small", 0, None)))
+
+    def test_full(self):
+        """
+        Test the limiter is full once maxDeferred items are deferred, and
+        waiting for a deferred item returns once its host has room
+        """
+        limiter = HostLimiter(1, maxDeferred=2)
+        limiter.tryAcquire("a")
+        limiter.defer("a", ("x1", 0, None))
+        self.assertFalse(limiter.isFull())
+        limiter.defer("a", ("x2", 0, None))
+        self.assertTrue(limiter.isFull())
+        self.assertEqual(limiter.getDeferred(None, 0.05), None)
+        threading.Timer(0.05, limiter.release, ["a"]).start()
+        self.assertEqual(limiter.getDeferred(None, None), ("a", ("x1", 0, None)))
+        self.assertFalse(limiter.isFull())
+
+    def test_deferredFirst(self):
+        """
+        Test a worker hands out deferred items before new ones once their host has room
+        """
+        limiter = HostLimiter(1)
+        toSyncQ = Queue.Queue()
+        for item in [("x1", "a"), ("x2", "a"), ("y1", "b")]:
+            toSyncQ.put(item)
+        worker = WorkerThread(toSyncQ, Queue.Queue(), Queue.Queue(), HostFetcher(), hostLimiter=limiter)
+        self.assertEqual(worker.getNextItem(), (("x1", "a"), 0, None, "a"))
+        # x2 is deferred behind x1
+        self.assertEqual(worker.getNextItem(), (("y1", "b"), 0, None, "b"))
+        limiter.release("a")
+        toSyncQ.put(("z1", "b"))
+        self.assertEqual(worker.getNextItem(), (("x2", "a"), 0, None, "a"))
+
+    def test_noneLeftBehind(self):
+        """
+        Test every item is fetched, none left deferred at the end, and no host exceeds its limit
+        """
+        limiter = HostLimiter(1, {"b": 2})
+        fetcher = HostFetcher()
+        engine = ParallelFetch(fetcher, 5, hostLimiter=limiter)
+        items = []
+        for i in range(20):
+            items.append(("a%s" % (i), "a"))
+            items.append(("b%s" % (i), "b"))
+        items.append(("c0", "c"))
+        engine.addItemList(items)
+        engine.start()
+        report = engine.waitForFinish()
+        self.assertEqual(report.successes, len(items))
+        self.assertEqual(sorted(fetcher.fetched), sorted(items))
+        self.assertEqual(fetcher.maxInFlight["a"], 1)
+        self.assertTrue(fetcher.maxInFlight["b"] <= 2)
+        self.assertFalse(limiter.hasDeferred())
+        self.assertEqual(limiter.inFlight, {})
+
+    def test_fetchOrder(self):
+        """
+        Test items for a host at its limit are still fetched largest first
+        """
+        sizes = range(40)
+        random.shuffle(sizes)
+        fetcher = HostFetcher(0.002)
+        engine = ParallelFetch(fetcher, 4, hostLimiter=HostLimiter(1))
+        engine.addItemList([(str(size), "a", size) for size in sizes])
+        engine.start()
+        report = engine.waitForFinish()
+        self.assertEqual(report.successes, 40)
+        self.assertEqual([int(item[2]) for item in fetcher.fetched], range(39, -1, -1))
+        self.assertEqual(fetcher.maxInFlight["a"], 1)
+
+    def test_queueBounded(self):
+        """
+        Test deferring items for a host at its limit doesn't take more than
+        maxQueued + DEFAULT_MAX_DEFERRED, and one for each worker already
+        waiting for an item, off the producer
+        """
+        proceed = threading.Event()
+        fetcher = HostFetcher(0, proceed)
+        limiter = HostLimiter(1)
+        engine = ParallelFetch(fetcher, 4, hostLimiter=limiter, maxQueued=5)
+        engine.start()
+        added = []
+        def produce():
+            for i in range(200):
+                engine.addItem(("x%s" % (i), "a", i))
+                added.append(i)
+        producer = threading.Thread(target=produce)
+        producer.setDaemon(True)
+        producer.start()
+        try:
+            time.sleep(0.3)
+            self.assertTrue(len(added) <= 5 + DEFAULT_MAX_DEFERRED + 4, len(added))
+            self.assertTrue(len(limiter.deferred) < DEFAULT_MAX_DEFERRED + 4)
+        finally:
+            proceed.set()
+        producer.join()
+        report = engine.waitForFinish()
+        self.assertEqual(report.successes, 200)
+        self.assertEqual(fetcher.maxInFlight["a"], 1)
+        self.assertFalse(limiter.hasDeferred())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import unittest
+
+import os
+import sys
+import time
+import random
+import shutil
+import socket
+import tempfile
+sys.path.append("../src/")
+from grinder.MirrorSelector import MirrorSelector, MirrorStats
+from grinder.RepoFetch import RepoFetch
+from grinder import GrinderLog
+
+class TestMirrorSelector(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.realUniform = random.uniform
+        # Always pick the best scored mirror
+        random.uniform = lambda a, b: 0.0
+
+    def tearDown(self):
+        random.uniform = self.realUniform
+
+    def createSelector(self, numMirrors=3):
+        return MirrorSelector(["http://mirror%s/repo/" % (i) for i in range(numMirrors)])
+
+    def getMirrors(self, urls):
+        return [url.split("/")[2] for url in urls]
+
+    def test_scores(self):
+        """
+        Test mirrors are ordered by the time they'd take for a typical item,
+        unmeasured mirrors assumed as fast as the fastest
+        """
+        selector = self.createSelector()
+        selector.recordProbe("http://mirror0/repo", True, 0.5)
+        selector.recordProbe("http://mirror1/repo", True, 0.1)
+        selector.recordProbe("http://mirror2/repo", True, 0.1)
+        # 1MB/s after the first byte
+        size = MirrorSelector.TYPICAL_SIZE
+        selector.recordTransfer("http://mirror1/repo/a.rpm", True, size, 1.1, 0.1)
+        self.assertEqual(self.getMirrors(selector.getItemURLs("b.rpm")),
+                ["mirror1", "mirror2", "mirror0"])
+        self.assertAlmostEqual(selector.getScore(selector.mirrors[1], selector.getDefaultThroughput()),
+                1.0 / 1.1)
+        # Too small a transfer to tell its rate
+        selector.recordTransfer("http://mirror2/repo/a.rpm", True, 1000, 0.1, 0.05)
+        self.assertEqual(selector.mirrors[2].throughput, None)
+        selector.recordTransfer("http://mirror2/repo/c.rpm", True, size * 4, 1.0, 0.0)
+        self.assertEqual(self.getMirrors(selector.getItemURLs("b.rpm"))[0], "mirror2")
+        self.assertEqual(selector.getItemURLs("dir/b.rpm")[0], "http://mirror2/repo/dir/b.rpm")
+
+    def test_itemFailures(self):
+        """
+        Test a mirror an item failed on isn't used for that item again, until
+        the item succeeds somewhere
+        """
+        selector = self.createSelector(2)
+        selector.recordTransfer("http://mirror0/repo/a.rpm", False)
+        self.assertEqual(self.getMirrors(selector.getItemURLs("a.rpm")), ["mirror1"])
+        self.assertEqual(self.getMirrors(selector.getItemURLs("b.rpm")), ["mirror0", "mirror1"])
+        selector.recordTransfer("http://mirror1/repo/a.rpm", True, 0, 1.0, 0.1)
+        self.assertEqual(selector.itemFailures, {})
+
+    def test_disabled(self):
+        """
+        Test a mirror failing MAX_FAILURES times in a row sits out, for longer
+        every further failure, and is back once the time is up or it succeeds
+        """
+        selector = self.createSelector(2)
+        for i in range(MirrorStats.MAX_FAILURES):
+            self.assertTrue(selector.mirrors[0].isEnabled())
+            selector.recordTransfer("http://mirror0/repo/p%s.rpm" % (i), False)
+        mirror = selector.mirrors[0]
+        self.assertFalse(mirror.isEnabled())
+        now = time.time()
+        self.assertTrue(mirror.isEnabled(now + MirrorStats.DISABLE_TIME + 1))
+        selector.recordTransfer("http://mirror0/repo/x.rpm", False)
+        self.assertFalse(mirror.isEnabled(now + MirrorStats.DISABLE_TIME + 1))
+        self.assertTrue(mirror.isEnabled(now + MirrorStats.DISABLE_TIME * 2 + 1))
+        self.assertEqual(self.getMirrors(selector.getItemURLs("b.rpm")), ["mirror1"])
+        selector.recordProbe("http://mirror0/repo/", True, 0.1)
+        self.assertTrue(mirror.isEnabled())
+        self.assertEqual(mirror.failures, 0)
+
+    def test_maxDisableTime(self):
+        """
+        Test the time a mirror sits out is capped
+        """
+        mirror = MirrorStats("http://mirror0/repo")
+        for i in range(20):
+            mirror.recordFailure()
+        self.assertTrue(mirror.isEnabled(time.time() + MirrorStats.MAX_DISABLE_TIME + 1))
+
+    def test_allDisabled(self):
+        """
+        Test the items are still fetched from the disabled mirrors when all
+        of them are, from those the item didn't fail on
+        """
+        selector = self.createSelector(2)
+        selector.recordProbe("http://mirror0/repo", False)
+        selector.recordProbe("http://mirror1/repo", False)
+        self.assertEqual(len(selector.getItemURLs("a.rpm")), 2)
+        selector.recordTransfer("http://mirror1/repo/a.rpm", False)
+        self.assertEqual(self.getMirrors(selector.getItemURLs("a.rpm")), ["mirror0"])
+        selector.recordTransfer("http://mirror0/repo/a.rpm", False)
+        # Failed everywhere, every mirror is tried again
+        self.assertEqual(len(selector.getItemURLs("a.rpm")), 2)
+
+class TestRepoFetchMirrors(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def createFetch(self, urls):
+        fetch = RepoFetch("repo", urls[0], download_dir=self.tempDir)
+        fetch.mirrorSelector = MirrorSelector(urls)
+        return fetch
+
+    def getPackage(self):
+        return {'relativepath': "Packages/a.rpm", 'downloadurl': "http://unused/Packages/a.rpm",
+                'fileName': "a.rpm", 'size': 10, 'checksumtype': "sha256", 'checksum': "0" * 64,
+                'savepath': self.tempDir}
+
+    def test_pickKept(self):
+        """
+        Test the mirror picked for an item by getItemHost() is kept until
+        its fetch starts, however often it is asked again
+        """
+        fetch = self.createFetch(["http://mirror%s/repo" % (i) for i in range(3)])
+        info = self.getPackage()
+        host = fetch.getItemHost(info)
+        for i in range(20):
+            self.assertEqual(fetch.getItemHost(info), host)
+        request = fetch.getFetchRequest(info)
+        self.assertEqual(request['fetchURL'], "http://%s/repo/Packages/a.rpm" % (host))
+        self.assertEqual(len(request['mirrorURLs']), 2)
+        self.assertEqual(fetch.pickedURLs, {})
+
+    def test_probeFileMirror(self):
+        """
+        Test a file:// mirror which has the probed file is kept, a mirror
+        refusing connections is disabled
+        """
+        os.makedirs(os.path.join(self.tempDir, "mirror", "repodata"))
+        f = open(os.path.join(self.tempDir, "mirror", "repodata", "repomd.xml"), "w")
+        f.write("<repomd/>")
+        f.close()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(("127.0.0.1", 0))
+        closedURL = "http://127.0.0.1:%s/repo" % (s.getsockname()[1])
+        s.close()
+        fetch = self.createFetch(["file://" + os.path.join(self.tempDir, "mirror"), closedURL])
+        fetch.probeMirrors("repodata/repomd.xml", timeout=5)
+        self.assertTrue(fetch.mirrorSelector.mirrors[0].isEnabled())
+        self.assertFalse(fetch.mirrorSelector.mirrors[1].isEnabled())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+import unittest
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+sys.path.append("../src/")
+from grinder.BaseFetch import BaseFetch
+from grinder.MultiFetch import MultiFetch
+from grinder.RetryQueue import RetryPolicy
+from grinder import GrinderLog
+from test_BaseFetch import TestFetcher
+
+class SequenceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves server.files, a dict of path to the list of bodies served in turn,
+    the last one for every request after.  The requests for paths in
+    server.slow get the first half of their body, then the rest once
+    server.proceed is set.
+    """
+    def do_GET(self):
+        self.server.lock.acquire()
+        try:
+            self.server.requests.append((self.path, time.time()))
+            bodies = self.server.files.get(self.path)
+            data = None
+            if bodies:
+                data = bodies[0]
+                if len(bodies) > 1:
+                    bodies.pop(0)
+        finally:
+            self.server.lock.release()
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.path in self.server.slow:
+            self.wfile.write(data[:len(data) / 2])
+            self.wfile.flush()
+            self.server.proceed.wait(10)
+            data = data[len(data) / 2:]
+        try:
+            self.wfile.write(data)
+        except IOError:
+            # Hung up on by a stopped fetch
+            pass
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class TestMultiFetch(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.server = ThreadingServer(("127.0.0.1", 0), SequenceHandler)
+        self.server.files = {}
+        self.server.slow = []
+        self.server.proceed = threading.Event()
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.baseURL = "http://127.0.0.1:%s/" % (self.server.server_address[1])
+        self.savePath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.proceed.set()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.savePath)
+
+    def addFile(self, name, size=20000, bodies=None):
+        """
+        Serves a file of size bytes as name, returns its item
+        """
+        data = "".join([chr((i + len(name)) % 251) for i in range(size)])
+        if bodies is None:
+            bodies = []
+        self.server.files["/" + name] = bodies + [data]
+        return {'name': name, 'size': size, 'checksum': hashlib.sha256(data).hexdigest()}
+
+    def createEngine(self, numConnections=2, retryPolicies=None):
+        return MultiFetch(TestFetcher(self.baseURL, self.savePath), numConnections,
+                retryPolicies=retryPolicies)
+
+    def waitForRequests(self, numRequests):
+        for i in range(100):
+            if len(self.server.requests) >= numRequests:
+                return
+            time.sleep(0.05)
+        self.fail("%s requests expected, %s made" % (numRequests, len(self.server.requests)))
+
+    def assertFetched(self, item):
+        data = open(os.path.join(self.savePath, item['name']), "rb").read()
+        self.assertEqual(hashlib.sha256(data).hexdigest(), item['checksum'])
+
+    def test_fetch(self):
+        """
+        Test more items than connections are all fetched
+        """
+        items = [self.addFile("item%s.bin" % (i), 1000 * (i + 1)) for i in range(5)]
+        engine = self.createEngine()
+        engine.addItemList(items)
+        engine.start()
+        report = engine.waitForFinish()
+        self.assertEqual(report.downloads, 5)
+        self.assertEqual(report.errors, 0)
+        for item in items:
+            self.assertFetched(item)
+
+    def test_checksumRetry(self):
+        """
+        Test an item with the wrong checksum is fetched again, and counted as
+        an error once its retries run out
+        """
+        good = self.addFile("good.bin", bodies=["x" * 20000])
+        bad = self.addFile("bad.bin", bodies=["x" * 20000] * 3)
+        policies = {BaseFetch.ERROR_CHECKSUM: RetryPolicy(1, 0, 0),
+                BaseFetch.ERROR_OTHER: RetryPolicy(0, 0, 0)}
+        engine = self.createEngine(retryPolicies=policies)
+        engine.addItemList([good, bad])
+        engine.start()
+        report = engine.waitForFinish()
+        self.assertEqual(report.downloads, 1)
+        self.assertEqual(report.errors, 1)
+        self.assertFetched(good)
+        self.assertFalse(os.path.exists(os.path.join(self.savePath, "bad.bin")))
+        paths = [path for path, started in self.server.requests]
+        self.assertEqual(paths.count("/good.bin"), 2)
+        self.assertEqual(paths.count("/bad.bin"), 2)
+
+    def test_stop(self):
+        """
+        Test stop() abandons the transfers in flight without waiting for them
+        """
+        items = [self.addFile("slow%s.bin" % (i), 20000 + i) for i in range(2)]
+        self.server.slow = ["/slow0.bin", "/slow1.bin"]
+        engine = self.createEngine()
+        engine.addItemList(items)
+        engine.start()
+        try:
+            self.waitForRequests(2)
+            started = time.time()
+            engine.stop()
+            report = engine.waitForFinish()
+            self.assertTrue(time.time() - started < 0.5)
+        finally:
+            # Don't leave the engine running if the test failed
+            engine.stop()
+            self.server.proceed.set()
+        self.assertEqual(report.successes, 0)
+        self.assertEqual(report.errors, 0)
+        for item in items:
+            self.assertFalse(os.path.exists(os.path.join(self.savePath, item['name'])))
+
+    def test_endOfItems(self):
+        """
+        Test the engine waits for items added after it started, and ends once
+        they are done after waitForFinish() has queued END_OF_ITEMS
+        """
+        engine = self.createEngine()
+        engine.start()
+        time.sleep(0.2)
+        self.assertTrue(engine.thread.isAlive())
+        item = self.addFile("late.bin")
+        engine.addItem(item)
+        report = engine.waitForFinish()
+        self.assertFalse(engine.thread.isAlive())
+        self.assertTrue(engine.ended)
+        self.assertEqual(report.downloads, 1)
+        self.assertFetched(item)
+        self.assertRaises(ValueError, engine.addItem, item)
+
+    def test_wokenByItem(self):
+        """
+        Test an item added while a transfer is in flight starts right away,
+        not once the wait on that transfer times out
+        """
+        slow = self.addFile("slow.bin")
+        self.server.slow = ["/slow.bin"]
+        engine = self.createEngine()
+        engine.addItem(slow)
+        engine.start()
+        try:
+            self.waitForRequests(1)
+            # Let run() settle into waiting on the slow transfer
+            time.sleep(0.2)
+            fast = self.addFile("fast.bin")
+            added = time.time()
+            engine.addItem(fast)
+            self.waitForRequests(2)
+            self.assertTrue(self.server.requests[1][1] - added < 0.5)
+        except:
+            engine.stop()
+            self.server.proceed.set()
+            raise
+        self.server.proceed.set()
+        report = engine.waitForFinish()
+        self.assertEqual(report.downloads, 2)
+        self.assertFetched(fast)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+import unittest
+
+import sys
+import threading
+sys.path.append("../src/")
+from grinder.BaseFetch import BaseFetch
+from grinder.ParallelFetch import ParallelFetch, SizeOrderedQueue, FairQueue, END_OF_ITEMS, createQueue
+from grinder import GrinderLog
+
+class SizedFetcher(object):
+    """
+    Stub fetcher for items (name, size), records the order they are fetched in
+    """
+    def __init__(self):
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def getFetchRequest(self, itemInfo):
+        return {'itemSize': itemInfo[1]}
+
+    def fetchItem(self, itemInfo):
+        self.lock.acquire()
+        try:
+            self.fetched.append(itemInfo[0])
+        finally:
+            self.lock.release()
+        return BaseFetch.STATUS_NOOP
+
+def getAll(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+class TestSizeOrder(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def test_largestFirst(self):
+        """
+        Test items come out largest first, those of the same size in the order added
+        """
+        q = SizeOrderedQueue(lambda item: item[1])
+        for item in [("a", 10), ("b", 300), ("c", 10), ("d", 0), ("e", 300), ("f", 20)]:
+            q.put(item)
+        self.assertEqual([item[0] for item in getAll(q)], ["b", "e", "f", "a", "c", "d"])
+
+    def test_endOfItemsLast(self):
+        """
+        Test END_OF_ITEMS comes out after every item, even those put after it
+        """
+        q = SizeOrderedQueue(lambda item: item[1])
+        q.put(("a", 1))
+        q.put(END_OF_ITEMS)
+        q.put(("b", 0))
+        self.assertEqual(getAll(q), [("a", 1), ("b", 0), END_OF_ITEMS])
+
+    def test_endOfItemsNotCounted(self):
+        """
+        Test END_OF_ITEMS goes on a full queue without waiting for room
+        """
+        q = SizeOrderedQueue(lambda item: item[1], 2)
+        q.put(("a", 1))
+        q.put(("b", 2))
+        self.assertTrue(q.full())
+        q.put(END_OF_ITEMS, False)
+        q.put(END_OF_ITEMS, False)
+        self.assertEqual(q.qsize(), 4)
+        self.assertEqual(getAll(q), [("b", 2), ("a", 1), END_OF_ITEMS, END_OF_ITEMS])
+
+    def test_unknownSize(self):
+        """
+        Test an item the fetcher can't size is queued as size 0
+        """
+        q = createQueue(SizedFetcher())
+        q.put(("a", "unknown"))
+        q.put(("b", 5))
+        self.assertEqual(getAll(q), [("b", 5), ("a", "unknown")])
+
+    def test_fifo(self):
+        """
+        Test items come out in the order added when sizes aren't scheduled by
+        """
+        q = createQueue(SizedFetcher(), scheduleBySize=False, maxQueued=10)
+        for item in [("a", 1), ("b", 300), ("c", 20)]:
+            q.put(item)
+        self.assertEqual([item[0] for item in getAll(q)], ["a", "b", "c"])
+
+    def test_fetchOrder(self):
+        """
+        Test a single worker fetches the items largest first
+        """
+        fetcher = SizedFetcher()
+        engine = ParallelFetch(fetcher, 1)
+        engine.addItemList([("a", 10), ("b", 3000), ("c", 500)])
+        engine.start()
+        report = engine.waitForFinish()
+        self.assertEqual(report.successes, 3)
+        self.assertEqual(fetcher.fetched, ["b", "c", "a"])
+
+    def test_sizedOnce(self):
+        """
+        Test the fetcher is asked the size of a dict item only when it is added
+        """
+        fetcher = SizedFetcher()
+        requests = []
+        def getFetchRequest(itemInfo):
+            requests.append(itemInfo['name'])
+            return {'itemSize': itemInfo['size']}
+        fetcher.getFetchRequest = getFetchRequest
+        fetcher.fetchItem = lambda itemInfo: BaseFetch.STATUS_NOOP
+        fetcher.setFetchControl = lambda control: None
+        engine = ParallelFetch(fetcher, 2, hedgeFactor=2)
+        engine.addItemList([{'name': "a", 'size': 10}, {'name': "b", 'size': 20}])
+        engine.start()
+        report = engine.waitForFinish()
+        self.assertEqual(report.successes, 2)
+        self.assertEqual(requests, ["a", "b"])
+
+class TestFairQueue(unittest.TestCase):
+    """
+    Items are (group, name, size)
+    """
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def createQueue(self, maxsize=0, getPriority=None):
+        return FairQueue(lambda item: item[2], lambda item: item[0], maxsize, getPriority)
+
+    def test_fairShares(self):
+        """
+        Test the group handed the fewest bytes so far comes next
+        """
+        q = self.createQueue()
+        for i in range(4):
+            q.put(("a", "a%s" % (i), 100))
+        q.put(("b", "b0", 300))
+        q.put(("b", "b1", 100))
+        self.assertEqual([item[1] for item in getAll(q)], ["a0", "b0", "a1", "a2", "a3", "b1"])
+
+    def test_lateGroup(self):
+        """
+        Test a group added late starts level with the least served group,
+        it doesn't get every fetch until it has caught up
+        """
+        q = self.createQueue()
+        for i in range(10):
+            q.put(("a", "a%s" % (i), 100))
+        for i in range(5):
+            self.assertEqual(q.get_nowait()[0], "a")
+        for i in range(5):
+            q.put(("b", "b%s" % (i), 100))
+        self.assertEqual([item[0] for item in getAll(q)], ["a", "b"] * 5)
+
+    def test_emptiedGroup(self):
+        """
+        Test a group whose items ran out and come in again keeps what it was handed
+        """
+        q = self.createQueue()
+        q.put(("a", "a0", 500))
+        q.put(("b", "b0", 100))
+        self.assertEqual(q.get_nowait()[1], "a0")
+        self.assertEqual(q.get_nowait()[1], "b0")
+        for i in range(3):
+            q.put(("b", "b%s" % (i + 1), 100))
+        q.put(("a", "a1", 100))
+        self.assertEqual([item[1] for item in getAll(q)], ["b1", "b2", "b3", "a1"])
+
+    def test_priorityFirst(self):
+        """
+        Test a lower priority number comes first whatever the shares
+        """
+        q = self.createQueue(getPriority=lambda item: item[1].startswith("low"))
+        q.put(("a", "a0", 100))
+        q.put(("a", "a1", 100))
+        q.put(("b", "low0", 1))
+        self.assertEqual([item[1] for item in getAll(q)], ["a0", "a1", "low0"])
+
+    def test_endOfItems(self):
+        """
+        Test END_OF_ITEMS comes last and doesn't count against maxsize
+        """
+        q = self.createQueue(1)
+        q.put(("a", "a0", 1))
+        q.put(END_OF_ITEMS, False)
+        self.assertEqual(q.qsize(), 2)
+        self.assertEqual(getAll(q), [("a", "a0", 1), END_OF_ITEMS])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import unittest
+
+import os
+import sys
+import shutil
+import tempfile
+sys.path.append("../src/")
+from grinder.PriorityClasses import PriorityClasses, createPackagePriorities, NEWEST, SECURITY, OLDER
+from grinder.ParallelFetch import createQueue
+from grinder import GrinderLog
+
+UPDATEINFO = """<?xml version="1.0"?>
+<updates>
+  <update type="security">
+    <pkglist><collection>
+      <package name="bash" epoch="0" version="2" release="1" arch="x86_64"/>
+    </collection></pkglist>
+  </update>
+  <update type="bugfix">
+    <pkglist><collection>
+      <package name="zsh" epoch="0" version="5" release="1" arch="x86_64"/>
+    </collection></pkglist>
+  </update>
+</updates>
+"""
+
+def package(name, version, release="1", arch="x86_64", size=1):
+    return {"name": name, "epoch": "0", "version": version, "release": release, "arch": arch,
+            "size": size}
+
+class PackageFetcher(object):
+    def getFetchRequest(self, itemInfo):
+        return {'itemSize': itemInfo['size']}
+
+def names(items):
+    return ["%s-%s-%s" % (p["name"], p["version"], p["release"]) for p in items]
+
+class TestPriorityClasses(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.updateinfoPath = os.path.join(self.tempDir, "updateinfo.xml")
+        f = open(self.updateinfoPath, "w")
+        f.write(UPDATEINFO)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def queueAll(self, priorities, packages):
+        q = createQueue(PackageFetcher(), priorities=priorities)
+        for p in packages:
+            priorities.itemAdded(p)
+            q.put(p)
+        items = []
+        while not q.empty():
+            items.append(q.get_nowait())
+        return items
+
+    def test_classes(self):
+        """
+        Test the newest builds come first, then security updates, then the rest,
+        by size within a class
+        """
+        packages = [package("bash", "1"), package("bash", "2"), package("bash", "3"),
+                package("zsh", "4", size=10), package("zsh", "5"), package("vim", "1", size=5)]
+        priorities = createPackagePriorities([NEWEST, SECURITY, OLDER], packages, self.updateinfoPath)
+        self.assertEqual(names(self.queueAll(priorities, packages)),
+                ["vim-1-1", "bash-3-1", "zsh-5-1", "bash-2-1", "zsh-4-1", "bash-1-1"])
+        self.assertEqual(priorities.getCompletion(), [(NEWEST, 0, 3, None), (SECURITY, 0, 1, None),
+                (OLDER, 0, 2, None)])
+
+    def test_classKept(self):
+        """
+        Test a dict item keeps the class it was given when added
+        """
+        priorities = PriorityClasses(["big", "small"], {"big": lambda p: p["size"] > 10})
+        p = package("bash", "1", size=20)
+        priorities.itemAdded(p)
+        self.assertEqual(p[PriorityClasses.CLASS_KEY], 0)
+        p["size"] = 1
+        self.assertEqual(priorities.getPriority(p), 0)
+        priorities.itemFinished(p)
+        self.assertEqual(priorities.getCompletion()[0][:3], ("big", 1, 1))
+
+    def test_unclassified(self):
+        """
+        Test items in none of the classes come last
+        """
+        priorities = createPackagePriorities([SECURITY], updateinfoPath=self.updateinfoPath)
+        packages = [package("zsh", "5", size=10), package("bash", "2")]
+        self.assertEqual(names(self.queueAll(priorities, packages)), ["bash-2-1", "zsh-5-1"])
+        self.assertEqual(priorities.getCompletion()[1][0], "unclassified")
+
+    def test_newestSoFar(self):
+        """
+        Test streamed in packages are newest if no newer build of their
+        name.arch was added before them
+        """
+        priorities = createPackagePriorities([NEWEST, OLDER])
+        packages = [package("bash", "3"), package("bash", "2"), package("bash", "3", arch="i686"),
+                package("bash", "4"), package("bash", "3", "2")]
+        for p in packages:
+            priorities.itemAdded(p)
+        self.assertEqual([p[PriorityClasses.CLASS_KEY] for p in packages], [0, 1, 0, 0, 1])
+
+    def test_newestSoFarNoName(self):
+        """
+        Test a streamed in item without a name, e.g. a delta rpm, isn't newest
+        """
+        priorities = createPackagePriorities([NEWEST, OLDER])
+        item = {"size": 1}
+        priorities.itemAdded(item)
+        self.assertEqual(item[PriorityClasses.CLASS_KEY], 1)
+
+    def test_newestSoFarAfterSecurity(self):
+        """
+        Test a streamed in security update counts as the newest build so far,
+        when it isn't classified as newest
+        """
+        priorities = createPackagePriorities([SECURITY, NEWEST, OLDER], updateinfoPath=self.updateinfoPath)
+        packages = [package("bash", "2"), package("bash", "1"), package("zsh", "5")]
+        for p in packages:
+            priorities.itemAdded(p)
+        self.assertEqual([p[PriorityClasses.CLASS_KEY] for p in packages], [0, 2, 1])
+
+    def test_classCached(self):
+        """
+        Test the class of an item that isn't a dict is worked out once, until
+        it is finished
+        """
+        tested = []
+        def isBig(item):
+            tested.append(item)
+            return item[1] > 10
+        priorities = PriorityClasses(["big", "small"], {"big": isBig})
+        item = ("bash", 20)
+        priorities.itemAdded(item)
+        for i in range(3):
+            self.assertEqual(priorities.getPriority(item), 0)
+        self.assertEqual(len(tested), 1)
+        priorities.itemFinished(item)
+        self.assertEqual(priorities.classes, {})
+        self.assertEqual(priorities.getCompletion()[0][:3], ("big", 1, 1))
+
+    def test_noClasses(self):
+        """
+        Test there are no priorities without class names
+        """
+        self.assertEqual(createPackagePriorities([]), None)
+
+if __name__ == '__main__':
+    unittest.main()
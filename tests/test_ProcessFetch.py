@@ -0,0 +1,107 @@
+import unittest
+
+import os
+import sys
+import time
+import threading
+sys.path.append("../src/")
+from grinder.BaseFetch import BaseFetch
+from grinder.ParallelFetch import ParallelFetch
+from grinder.ProcessFetch import ProcessFetch
+from grinder import GrinderLog
+
+class StubFetcher(object):
+    """
+    Stub fetcher for items {'name', 'size', 'status'}, each fetch takes delay
+    seconds and ends with the item's status
+    """
+    def __init__(self, delay=0):
+        self.delay = delay
+
+    def getFetchRequest(self, itemInfo):
+        return {'itemSize': itemInfo['size']}
+
+    def fetchItem(self, itemInfo):
+        time.sleep(self.delay)
+        return itemInfo['status']
+
+def createItems(numItems):
+    """
+    Returns numItems items, every other one already fetched
+    """
+    items = []
+    for i in range(numItems):
+        status = BaseFetch.STATUS_DOWNLOADED
+        if i % 2:
+            status = BaseFetch.STATUS_NOOP
+        items.append({'name': "item%s" % (i), 'size': i + 1, 'status': status})
+    return items
+
+class TestProcessFetch(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def createEngine(self, fetcher, numThreads=2):
+        def createEngine(sharedQ):
+            return ParallelFetch(fetcher, numThreads, toSyncQ=sharedQ)
+        engine = ProcessFetch(fetcher, 2, createEngine)
+        self.done = []
+        self.doneLock = threading.Lock()
+        def itemDone(itemInfo, status):
+            self.doneLock.acquire()
+            try:
+                self.done.append((itemInfo['name'], status, os.getpid()))
+            finally:
+                self.doneLock.release()
+        engine.addCompletionListener(itemDone)
+        return engine
+
+    def test_mergedReport(self):
+        """
+        Test the items are fetched by both processes, and their reports and
+        completions come back to this one
+        """
+        items = createItems(20)
+        engine = self.createEngine(StubFetcher(0.02))
+        engine.start()
+        engine.addItemList(items)
+        report = engine.waitForFinish()
+        self.assertEqual(report.successes, 20)
+        self.assertEqual(report.downloads, 10)
+        self.assertEqual(report.errors, 0)
+        self.assertEqual(len(engine.reports), 2)
+        self.assertEqual(sum([r.successes for r in engine.reports.values()]), 20)
+        for r in engine.reports.values():
+            self.assertTrue(r.successes > 0)
+        names = [name for name, status, pid in self.done]
+        names.sort()
+        expected = [item['name'] for item in items]
+        expected.sort()
+        self.assertEqual(names, expected)
+        for name, status, pid in self.done:
+            # Called in this process, from the collector thread
+            self.assertEqual(pid, os.getpid())
+            self.assertEqual(status, items[int(name[4:])]['status'])
+
+    def test_stop(self):
+        """
+        Test stop() ends the processes with items still queued, also while the
+        queue shared with them is full
+        """
+        engine = self.createEngine(StubFetcher(0.2), numThreads=1)
+        engine.start()
+        engine.addItemList(createItems(40))
+        time.sleep(0.5)
+        self.assertTrue(engine.sharedQ.full())
+        started = time.time()
+        engine.stop()
+        report = engine.waitForFinish()
+        self.assertTrue(time.time() - started < 5.0)
+        self.assertFalse(engine.isAnyAlive())
+        self.assertTrue(report.successes < 40)
+        self.assertEqual(len(self.done), report.successes)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+import sys
+import time
+import socket
+sys.path.append("../src/")
+from grinder.RHNComm import TimeoutHTTPConnection
+from grinder import GrinderLog
+
+class TestTimeoutHTTPConnection(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        # Accepts connections but never answers
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.host = "127.0.0.1:%s" % (self.listener.getsockname()[1])
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_responseTimeout(self):
+        """
+        Test waiting for a response from a server that doesn't answer times out
+        """
+        conn = TimeoutHTTPConnection(self.host, 0.5)
+        started = time.time()
+        try:
+            conn.request("GET", "/")
+            self.assertRaises(socket.timeout, conn.getresponse)
+        finally:
+            conn.close()
+        self.assertTrue(time.time() - started < 5.0)
+
+    def test_connectRefused(self):
+        """
+        Test a refused connection raises socket.error
+        """
+        self.listener.close()
+        conn = TimeoutHTTPConnection(self.host, 0.5)
+        self.assertRaises(socket.error, conn.request, "GET", "/")
+
+if __name__ == '__main__':
+    unittest.main()
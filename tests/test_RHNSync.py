@@ -1,9 +1,16 @@
 import unittest
 
 import sys
+import shutil
+import tempfile
 sys.path.append("../src/")
+from grinder import RHNSync as rhnsync
 from grinder.RHNSync import RHNSync
+from grinder.BaseFetch import BaseFetch
+from grinder.ParallelFetch import ParallelFetch
 from grinder import GrinderLog
+from test_SyncJournal import StubSync
+from test_ProcessFetch import StubFetcher
 
 
 class TestRHNSync(unittest.TestCase):
@@ -38,6 +45,63 @@ class TestRHNSync(unittest.TestCase):
         for c in expectedChannels:
             self.assertTrue(c in channels)
         return True
+class StreamSync(StubSync):
+    """
+    StubSync fetching its packages with a ParallelFetch of one worker and a
+    StubFetcher, counts how many packages are done
+    """
+    def __init__(self, packages, delay):
+        StubSync.__init__(self, packages)
+        self.delay = delay
+        self.numDone = 0
+        self.maxQueued = None
+
+    def createPackageFetch(self, pkgFetch, numThreads, priorities, maxQueued=0, getGroup=None):
+        self.maxQueued = maxQueued
+        engine = ParallelFetch(StubFetcher(self.delay), 1, maxQueued=maxQueued)
+        engine.addCompletionListener(self.itemDone)
+        return engine
+
+    def itemDone(self, itemInfo, status):
+        self.numDone += 1
+
+    def finishChannel(self, savePath):
+        pass
+
+class TestStreamedPackages(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.savePath = tempfile.mkdtemp()
+        self.realQueueSize = rhnsync.STREAM_QUEUE_SIZE
+        rhnsync.STREAM_QUEUE_SIZE = 5
+
+    def tearDown(self):
+        rhnsync.STREAM_QUEUE_SIZE = self.realQueueSize
+        shutil.rmtree(self.savePath)
+
+    def test_boundedQueue(self):
+        """
+        Test the metadata of all packages is read no further ahead of the
+        fetches than STREAM_QUEUE_SIZE packages
+        """
+        self.maxAhead = 0
+        def readPackages():
+            for i in range(30):
+                self.maxAhead = max(self.maxAhead, i - sync.numDone)
+                yield {'name': "p%s" % (i), 'filename': "p%s.rpm" % (i), 'size': 10,
+                        'status': BaseFetch.STATUS_DOWNLOADED}
+        sync = StreamSync(readPackages(), 0.01)
+        sync.setFetchAllPackages(True)
+        report = sync.syncPackages("chan", self.savePath)
+        self.assertEqual(sync.maxQueued, 5)
+        self.assertEqual(report.successes, 30)
+        # The queued packages, the one fetched and the one being added
+        self.assertTrue(self.maxAhead <= 5 + 2)
+        self.assertTrue(self.maxAhead >= 5)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,186 @@
+import unittest
+
+import sys
+import time
+sys.path.append("../src/")
+from grinder import RateLimiter as ratelimiter
+from grinder.RateLimiter import TokenBucket, RateLimiter, RateLimitProfile, createRateLimiter
+from grinder.BaseFetch import BaseFetch
+from grinder import GrinderLog
+
+class FakeClock(object):
+    """
+    Stands in for the time module, time only moves when sleep() is called
+    """
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.slept = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+    def localtime(self):
+        return time.localtime(self.now)
+
+class TestRateLimiter(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.realTime = ratelimiter.time
+        ratelimiter.time = self.clock
+
+    def tearDown(self):
+        ratelimiter.time = self.realTime
+
+    def test_burst(self):
+        """
+        Test a full bucket, one second worth of tokens, is taken without waiting
+        """
+        bucket = TokenBucket(100)
+        bucket.consume(100)
+        self.assertEqual(self.clock.slept, 0)
+
+    def test_refill(self):
+        """
+        Test taking more than there is waits for the bucket to refill at its rate
+        """
+        bucket = TokenBucket(100)
+        bucket.consume(100)
+        bucket.consume(50)
+        self.assertAlmostEqual(self.clock.slept, 0.5)
+        self.clock.sleep(0.25)
+        bucket.consume(50)
+        self.assertAlmostEqual(self.clock.slept, 0.25 + 0.5 + 0.25)
+
+    def test_debt(self):
+        """
+        Test a take larger than the bucket goes into debt, later takes wait behind it
+        """
+        bucket = TokenBucket(100)
+        bucket.consume(300)
+        self.assertAlmostEqual(self.clock.slept, 2.0)
+        bucket.consume(100)
+        self.assertAlmostEqual(self.clock.slept, 3.0)
+
+    def test_capped(self):
+        """
+        Test an idle bucket holds no more than one second worth of tokens
+        """
+        bucket = TokenBucket(100)
+        self.clock.sleep(60)
+        bucket.consume(200)
+        self.assertAlmostEqual(self.clock.slept, 60 + 1.0)
+
+    def test_unlimited(self):
+        """
+        Test a rate of 0 never waits
+        """
+        bucket = TokenBucket(0)
+        bucket.consume(10 ** 9)
+        self.assertEqual(self.clock.slept, 0)
+
+    def test_requestRate(self):
+        """
+        Test requests are spaced out to the request rate once the burst is used up
+        """
+        limiter = RateLimiter(0, 2)
+        for i in range(6):
+            limiter.acquireRequest()
+        self.assertAlmostEqual(self.clock.slept, 2.0)
+
+    def test_limitWrites(self):
+        """
+        Test a wrapped write function is throttled to the bandwidth and returns what it returns
+        """
+        limiter = RateLimiter(1000)
+        written = []
+        def write(data):
+            written.append(data)
+            return len(data)
+        write = limiter.limitWrites(write)
+        for i in range(4):
+            self.assertEqual(write("x" * 500), 500)
+        self.assertEqual(len(written), 4)
+        self.assertAlmostEqual(self.clock.slept, 1.0)
+
+    def test_setShare(self):
+        """
+        Test a share of the limiter enforces that fraction of the limits
+        """
+        limiter = RateLimiter(1000, 10)
+        limiter.setShare(0.25)
+        self.assertEqual(limiter.byteBucket.rate, 250)
+        self.assertEqual(limiter.requestBucket.rate, 2.5)
+        limiter.acquireBytes(250)
+        limiter.acquireBytes(250)
+        self.assertAlmostEqual(self.clock.slept, 1.0)
+
+    def test_transferRate(self):
+        """
+        Test each transfer's rate is the bandwidth split between the transfers
+        """
+        limiter = RateLimiter(1000)
+        limiter.setShare(0.5)
+        limiter.setTransfers(4)
+        self.assertEqual(limiter.getTransferRate(), 125)
+        self.assertEqual(RateLimiter().getTransferRate(), 0)
+
+    def test_stallSpeed(self):
+        """
+        Test the stall speed is lowered when the rate limiter allows each transfer less
+        """
+        fetcher = BaseFetch()
+        self.assertEqual(fetcher.getStallSpeed(), BaseFetch.DEFAULT_STALL_SPEED)
+        limiter = RateLimiter(100000)
+        fetcher.setRateLimiter(limiter)
+        limiter.setTransfers(50)
+        self.assertEqual(fetcher.getStallSpeed(), BaseFetch.DEFAULT_STALL_SPEED)
+        limiter.setTransfers(200)
+        self.assertEqual(fetcher.getStallSpeed(), 250)
+        limiter.setTransfers(10 ** 6)
+        self.assertEqual(fetcher.getStallSpeed(), 0)
+
+    def test_profiles(self):
+        """
+        Test an active profile overrides the default limits, rechecked every PROFILE_CHECK_INTERVAL
+        """
+        now = time.localtime(self.clock.now)
+        minute = now[3] * 60 + now[4]
+        start = "%02d:%02d" % ((minute + 1) / 60 % 24, (minute + 1) % 60)
+        end = "%02d:%02d" % ((minute + 3) / 60 % 24, (minute + 3) % 60)
+        limiter = RateLimiter(1000, 0, [RateLimitProfile(start, end, 100, 0)])
+        self.assertEqual(limiter.byteBucket.rate, 1000)
+        self.clock.sleep(30)
+        limiter.updateLimits()
+        self.assertEqual(limiter.byteBucket.rate, 1000)
+        self.clock.sleep(RateLimiter.PROFILE_CHECK_INTERVAL + 30)
+        limiter.updateLimits()
+        self.assertEqual(limiter.byteBucket.rate, 100)
+
+    def test_profileWrapsMidnight(self):
+        """
+        Test a profile ending before it starts spans midnight
+        """
+        profile = RateLimitProfile("22:00", "06:00")
+        self.assertTrue(profile.isActive((2010, 1, 1, 23, 30, 0, 0, 1, 0)))
+        self.assertTrue(profile.isActive((2010, 1, 1, 5, 59, 0, 0, 1, 0)))
+        self.assertFalse(profile.isActive((2010, 1, 1, 6, 0, 0, 0, 1, 0)))
+
+    def test_createRateLimiter(self):
+        """
+        Test the bandwidth is given in Mbit/s
+        """
+        limiter = createRateLimiter(8, 5)
+        self.assertEqual(limiter.byteBucket.rate, 1000000)
+        self.assertEqual(limiter.requestBucket.rate, 5)
+
+if __name__ == '__main__':
+    unittest.main()
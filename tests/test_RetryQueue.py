@@ -0,0 +1,104 @@
+import unittest
+
+import sys
+import random
+sys.path.append("../src/")
+from grinder import RetryQueue as retryqueue
+from grinder.RetryQueue import RetryQueue, RetryPolicy
+from grinder.BaseFetch import BaseFetch
+from grinder import GrinderLog
+
+class FakeClock(object):
+    """
+    Stands in for the time module, time only moves when sleep() is called
+    """
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class TestRetryQueue(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.realTime = retryqueue.time
+        retryqueue.time = self.clock
+        self.realUniform = random.uniform
+        # No jitter, so delays are exact
+        random.uniform = lambda a, b: 1.0
+
+    def tearDown(self):
+        retryqueue.time = self.realTime
+        random.uniform = self.realUniform
+
+    def test_backoff(self):
+        """
+        Test delays double with each attempt up to maxDelay
+        """
+        policy = RetryPolicy(10, 2, 20)
+        self.assertEqual([policy.getDelay(a) for a in range(1, 7)], [2, 4, 8, 16, 20, 20])
+
+    def test_jitter(self):
+        """
+        Test delays are randomized within +/- 50%
+        """
+        random.uniform = self.realUniform
+        policy = RetryPolicy(10, 4, 60)
+        for i in range(100):
+            delay = policy.getDelay(2)
+            self.assertTrue(4 <= delay <= 12, delay)
+
+    def test_retriesUsedUp(self):
+        """
+        Test an item isn't scheduled beyond the retries of its error class' policy
+        """
+        q = RetryQueue({BaseFetch.ERROR_OTHER: RetryPolicy(2, 1, 10),
+                BaseFetch.ERROR_SERVER: RetryPolicy(4, 1, 10)})
+        self.assertTrue(q.schedule("a", BaseFetch.ERROR_OTHER, 2))
+        self.assertFalse(q.schedule("a", BaseFetch.ERROR_OTHER, 3))
+        self.assertTrue(q.schedule("b", BaseFetch.ERROR_SERVER, 4))
+        # Unknown classes fall back to ERROR_OTHER's policy
+        self.assertFalse(q.schedule("c", "unknown", 3))
+        self.assertEqual(len(q), 2)
+
+    def test_ready(self):
+        """
+        Test items are only handed out once their delay has passed, soonest first
+        """
+        q = RetryQueue({BaseFetch.ERROR_OTHER: RetryPolicy(5, 10, 100)})
+        self.assertEqual(q.timeUntilReady(), None)
+        q.schedule("late", BaseFetch.ERROR_OTHER, 2)
+        q.schedule("early", BaseFetch.ERROR_OTHER, 1)
+        self.assertEqual(q.getReady(), None)
+        self.assertEqual(q.timeUntilReady(), 10)
+        self.clock.sleep(9.5)
+        self.assertEqual(q.getReady(), None)
+        self.assertEqual(q.timeUntilReady(), 0.5)
+        self.clock.sleep(0.5)
+        self.assertEqual(q.getReady(), ("early", 1))
+        self.assertEqual(q.getReady(), None)
+        self.clock.sleep(10)
+        self.assertEqual(q.timeUntilReady(), 0)
+        self.assertEqual(q.getReady(), ("late", 2))
+        self.assertEqual(len(q), 0)
+
+    def test_sameTimeInOrder(self):
+        """
+        Test items due at the same time come back in the order they were scheduled
+        """
+        q = RetryQueue({BaseFetch.ERROR_OTHER: RetryPolicy(5, 1, 10)})
+        for item in ["a", "b", "c"]:
+            q.schedule({"name": item}, BaseFetch.ERROR_OTHER, 1)
+        self.clock.sleep(1)
+        self.assertEqual([q.getReady()[0]["name"] for i in range(3)], ["a", "b", "c"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+import sys
+from xml.dom import minidom
+sys.path.append("../src/")
+from grinder.SatDumpClient import SatDumpClient
+from grinder import GrinderLog
+
+class FakeDump(object):
+    """
+    Stands in for client.dump, packages_short() answers with a
+    rhn-package-short element for each package id asked for
+    """
+    def __init__(self):
+        self.calls = []
+
+    def packages_short(self, systemId, packageIds):
+        self.calls.append(list(packageIds))
+        elements = []
+        for packageId in packageIds:
+            elements.append('<rhn-package-short name="pkg" package-size="10" md5sum="0" '
+                    'package-arch="noarch" last-modified="0" epoch="" version="1.0" '
+                    'release="1" id="%s"/>' % (packageId))
+        return minidom.parseString("<rhn-satellite>%s</rhn-satellite>" % ("".join(elements)))
+
+class TestSatDumpClient(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def createClient(self):
+        satDump = SatDumpClient("http://localhost")
+        satDump.client.dump = FakeDump()
+        return satDump
+
+    def test_getPackageNumber(self):
+        """
+        Test the number of a package id is read, malformed ids get -1
+        """
+        satDump = self.createClient()
+        self.assertEqual(satDump.getPackageNumber("rhn-package-492050"), 492050)
+        self.assertEqual(satDump.getPackageNumber("rhn-package-"), -1)
+        self.assertEqual(satDump.getPackageNumber("rhn-package-abc"), -1)
+        self.assertEqual(satDump.getPackageNumber("bogus"), -1)
+
+    def test_order(self):
+        """
+        Test the packages are asked for and yielded highest id first, those
+        with malformed ids last
+        """
+        satDump = self.createClient()
+        ids = ["rhn-package-5", "bogus", "rhn-package-12", "rhn-package-7", "rhn-package-100"]
+        infos = list(satDump.iterShortPackageInfo("sysid", ids, batchSize=2))
+        self.assertEqual([info['id'] for info in infos],
+                ["rhn-package-100", "rhn-package-12", "rhn-package-7", "rhn-package-5", "bogus"])
+        self.assertEqual(satDump.client.dump.calls, [["rhn-package-100", "rhn-package-12"],
+                ["rhn-package-7", "rhn-package-5"], ["bogus"]])
+        self.assertEqual(infos[0]['nevra'], "pkg-1.0-1.noarch.rpm")
+
+    def test_batches(self):
+        """
+        Test the info is asked for BATCH_SIZE packages at a time, each batch
+        only once the packages of the one before have been used
+        """
+        satDump = self.createClient()
+        numPackages = SatDumpClient.BATCH_SIZE * 2 + 1
+        ids = ["rhn-package-%s" % (i) for i in range(numPackages)]
+        infos = satDump.iterShortPackageInfo("sysid", ids)
+        calls = satDump.client.dump.calls
+        self.assertEqual(calls, [])
+        infos.next()
+        self.assertEqual(len(calls), 1)
+        for i in range(SatDumpClient.BATCH_SIZE - 1):
+            infos.next()
+        self.assertEqual(len(calls), 1)
+        infos.next()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(list(infos)), SatDumpClient.BATCH_SIZE)
+        self.assertEqual([len(batch) for batch in calls],
+                [SatDumpClient.BATCH_SIZE, SatDumpClient.BATCH_SIZE, 1])
+        self.assertEqual(calls[-1], ["rhn-package-0"])
+
+if __name__ == '__main__':
+    unittest.main()
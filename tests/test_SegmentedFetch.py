@@ -0,0 +1,148 @@
+import unittest
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+sys.path.append("../src/")
+from grinder.BaseFetch import BaseFetch
+from grinder.SegmentedFetch import SegmentedDownload
+from grinder import GrinderLog
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves server.data as any path, the byte range asked for if server.ranges
+    is set.  A range starting at server.corruptStart is served with its
+    bytes changed.
+    """
+    def do_GET(self):
+        data = self.server.data
+        rangeHeader = self.headers.getheader("Range")
+        self.server.requests.append(rangeHeader)
+        if rangeHeader and self.server.ranges:
+            start, end = rangeHeader.split("=")[1].split("-")
+            start = int(start)
+            end = int(end or len(data) - 1)
+            body = data[start:end + 1]
+            if start == self.server.corruptStart:
+                body = "x" * len(body)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %s-%s/%s" % (start, end, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except IOError:
+            # Hung up on once a range was found to be ignored
+            pass
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class SegmentFetcher(BaseFetch):
+    """
+    Fetches items of at least 1000 bytes as 4 segments
+    """
+    def __init__(self):
+        BaseFetch.__init__(self)
+        self.setSegmentation(1000, 4)
+
+class TestSegmentedFetch(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        # Doesn't divide evenly into 4 segments
+        self.data = "".join([chr(i % 251) for i in range(10003)])
+        self.servers = []
+        self.savePath = tempfile.mkdtemp()
+        self.filePath = os.path.join(self.savePath, "item.bin")
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.savePath)
+
+    def startServer(self, ranges=True):
+        """
+        Returns a mirror of self.data and the url of its copy
+        """
+        server = ThreadingServer(("127.0.0.1", 0), RangeHandler)
+        server.data = self.data
+        server.ranges = ranges
+        server.corruptStart = None
+        server.requests = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.servers.append(server)
+        return server, "http://127.0.0.1:%s/item.bin" % (server.server_address[1])
+
+    def fetch(self, urls):
+        return SegmentFetcher().fetch("item.bin", urls[0], len(self.data), "sha256",
+                hashlib.sha256(self.data).hexdigest(), self.savePath, mirrorURLs=urls[1:])
+
+    def test_boundaries(self):
+        """
+        Test the segments cover the item without gaps or overlaps, the last
+        one taking the bytes left over
+        """
+        download = SegmentedDownload(SegmentFetcher(), self.filePath, ["url0", "url1"], 10003)
+        self.assertEqual([(s.start, s.end, s.urlIndex) for s in download.segments],
+                [(0, 2499, 0), (2500, 4999, 1), (5000, 7499, 0), (7500, 10002, 1)])
+        self.assertEqual(os.path.getsize(download.partPath), 10003)
+        download.close()
+
+    def test_fetch(self):
+        """
+        Test an item is fetched as ranges spread over its mirrors and
+        reassembled in order
+        """
+        server0, url0 = self.startServer()
+        server1, url1 = self.startServer()
+        self.assertEqual(self.fetch([url0, url1]), BaseFetch.STATUS_DOWNLOADED)
+        self.assertEqual(open(self.filePath, "rb").read(), self.data)
+        self.assertFalse(os.path.exists(self.filePath + ".part"))
+        requests = server0.requests + server1.requests
+        requests.sort()
+        self.assertEqual(requests, ["bytes=0-2499", "bytes=2500-4999", "bytes=5000-7499",
+                "bytes=7500-10002"])
+        self.assertEqual(len(server1.requests), 2)
+
+    def test_mirrorIgnoresRange(self):
+        """
+        Test the item is fetched as a single stream from its first url when a
+        mirror answers a range request with the whole file
+        """
+        server0, url0 = self.startServer()
+        server1, url1 = self.startServer(ranges=False)
+        self.assertEqual(self.fetch([url0, url1]), BaseFetch.STATUS_DOWNLOADED)
+        self.assertEqual(open(self.filePath, "rb").read(), self.data)
+        self.assertTrue(None in server0.requests)
+        self.assertFalse(None in server1.requests)
+
+    def test_checksumMismatch(self):
+        """
+        Test a reassembled item with the wrong checksum is dropped
+        """
+        server, url = self.startServer()
+        server.corruptStart = 5000
+        self.assertEqual(self.fetch([url]), BaseFetch.STATUS_MD5_MISSMATCH)
+        self.assertFalse(os.path.exists(self.filePath))
+        self.assertFalse(os.path.exists(self.filePath + ".part"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+import unittest
+
+import os
+import sys
+import shutil
+import tempfile
+sys.path.append("../src/")
+from grinder.BaseFetch import BaseFetch
+from grinder.SyncJournal import SyncJournal, getSyncJournal, JOURNAL_FILENAME
+from grinder.RHNSync import RHNSync
+from grinder.ParallelFetch import SyncReport
+from grinder import GrinderLog
+
+def package(name):
+    return {'filename': name}
+
+class StubSync(RHNSync):
+    """
+    RHNSync whose channels are listed by getChannelItems() without reading any metadata
+    """
+    def __init__(self, packages):
+        RHNSync.__init__(self)
+        self.packages = packages
+        self.priorityClasses = []
+        self.itemsRead = 0
+
+    def getChannelItems(self, satDump, channelLabel, savePath):
+        self.itemsRead += 1
+        return self.packages, None
+
+class StubEngine(object):
+    """
+    Download engine that fetches nothing, stopSync is called once the items
+    are added, as if the sync was interrupted while they were fetched
+    """
+    def __init__(self, stopSync=None):
+        self.stopSync = stopSync
+        self.items = []
+
+    def addCompletionListener(self, callback):
+        pass
+
+    def addItem(self, itemInfo):
+        self.items.append(itemInfo)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def waitForFinish(self):
+        if self.stopSync:
+            self.stopSync()
+        return SyncReport()
+
+class FinishSync(StubSync):
+    """
+    StubSync syncing through StubEngine, records the channels finished
+    """
+    def __init__(self, packages, stopped=False):
+        StubSync.__init__(self, packages)
+        self.finished = []
+        self.stopWhileFetching = stopped
+
+    def createPackageFetch(self, pkgFetch, numThreads, priorities, maxQueued=0, getGroup=None):
+        if self.stopWhileFetching:
+            return StubEngine(self.stop)
+        return StubEngine()
+
+    def finishChannel(self, savePath):
+        self.finished.append(savePath)
+
+class TestSyncJournal(unittest.TestCase):
+
+    def __init__(self, arg):
+        unittest.TestCase.__init__(self,arg)
+        GrinderLog.setup(False)
+
+    def setUp(self):
+        self.savePath = tempfile.mkdtemp()
+        self.journalPath = os.path.join(self.savePath, JOURNAL_FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.savePath)
+
+    def createJournal(self):
+        return SyncJournal(self.journalPath, lambda itemInfo: itemInfo['filename'])
+
+    def writeJournal(self, label="chan", numItems=4, planned=True, done=None):
+        """
+        done = dict of item number to its final status
+        """
+        journal = self.createJournal()
+        journal.start(label)
+        for i in range(numItems):
+            journal.addPlanned(package("p%s" % (i)))
+        if planned:
+            journal.setPlanComplete()
+        if done:
+            for i, status in done.items():
+                journal.itemDone(package("p%s" % (i)), status)
+        journal.close()
+        return journal
+
+    def getNames(self, items):
+        return [p['filename'] for p in items]
+
+    def test_load(self):
+        """
+        Test a journal is read back as written
+        """
+        self.writeJournal(done={1: BaseFetch.STATUS_DOWNLOADED})
+        journal = self.createJournal()
+        self.assertTrue(journal.load())
+        self.assertEqual(journal.label, "chan")
+        self.assertTrue(journal.isPlanComplete())
+        self.assertFalse(journal.isFinished())
+        self.assertEqual(self.getNames(journal.getItems()), ["p0", "p2", "p3"])
+        self.assertEqual(journal.validLength, os.path.getsize(self.journalPath))
+        self.assertFalse(SyncJournal(self.journalPath + ".missing", None).load())
+
+    def test_truncatedRecord(self):
+        """
+        Test a journal ending in a record cut short loads up to it, and is
+        appended to after the last whole record
+        """
+        self.writeJournal(done={0: BaseFetch.STATUS_DOWNLOADED, 1: BaseFetch.STATUS_NOOP})
+        size = os.path.getsize(self.journalPath)
+        f = open(self.journalPath, "r+b")
+        f.truncate(size - 3)
+        f.close()
+        journal = self.createJournal()
+        self.assertTrue(journal.load())
+        self.assertTrue(journal.validLength < size - 3)
+        self.assertEqual(self.getNames(journal.getItems()), ["p1", "p2", "p3"])
+        journal.reopen()
+        self.assertEqual(os.path.getsize(self.journalPath), journal.validLength)
+        journal.itemDone(package("p2"), BaseFetch.STATUS_DOWNLOADED)
+        journal.close()
+        journal = self.createJournal()
+        self.assertTrue(journal.load())
+        self.assertEqual(journal.validLength, os.path.getsize(self.journalPath))
+        self.assertEqual(self.getNames(journal.getItems()), ["p1", "p3"])
+
+    def test_getItems(self):
+        """
+        Test the items left, the items failed, both and neither
+        """
+        self.writeJournal(numItems=5, done={0: BaseFetch.STATUS_DOWNLOADED, 1: BaseFetch.STATUS_ERROR,
+                2: BaseFetch.STATUS_NOOP, 3: BaseFetch.STATUS_MD5_MISSMATCH})
+        journal = self.createJournal()
+        journal.load()
+        self.assertEqual(self.getNames(journal.getItems(True, False)), ["p4"])
+        self.assertEqual(self.getNames(journal.getItems(False, True)), ["p1", "p3"])
+        self.assertEqual(self.getNames(journal.getItems(True, True)), ["p1", "p3", "p4"])
+        self.assertEqual(journal.getItems(False, False), [])
+
+    def test_lastStatusCounts(self):
+        """
+        Test an item retried in a resumed sync counts with its last status
+        """
+        self.writeJournal(done={1: BaseFetch.STATUS_ERROR})
+        journal = self.createJournal()
+        journal.load()
+        journal.reopen()
+        journal.itemDone(package("p1"), BaseFetch.STATUS_DOWNLOADED)
+        journal.close()
+        journal = self.createJournal()
+        journal.load()
+        self.assertEqual(journal.getItems(False, True), [])
+
+    def test_restart(self):
+        """
+        Test starting a journal drops the old one
+        """
+        self.writeJournal(label="old")
+        self.writeJournal(label="new", numItems=1, planned=False)
+        journal = self.createJournal()
+        journal.load()
+        self.assertEqual(journal.label, "new")
+        self.assertFalse(journal.isPlanComplete())
+        self.assertEqual(self.getNames(journal.getItems()), ["p0"])
+
+    def planChannel(self, label="chan", resume=True, retryFailed=False):
+        packages = [package("new0"), package("new1")]
+        sync = StubSync(packages)
+        sync.setResume(resume)
+        sync.setRetryFailed(retryFailed)
+        journal = getSyncJournal(self.savePath)
+        result = sync.planChannel(None, label, self.savePath, journal)
+        journal.close()
+        return result, sync
+
+    def test_planResumed(self):
+        """
+        Test a complete plan for the channel is resumed from without reading its metadata
+        """
+        self.writeJournal(done={0: BaseFetch.STATUS_DOWNLOADED, 1: BaseFetch.STATUS_ERROR})
+        (packages, priorities, resumed), sync = self.planChannel(retryFailed=True)
+        self.assertTrue(resumed)
+        self.assertEqual(sync.itemsRead, 0)
+        self.assertEqual(self.getNames(packages), ["p1", "p2", "p3"])
+
+    def test_planIncomplete(self):
+        """
+        Test a journal without its PLANNED record isn't resumed from
+        """
+        self.writeJournal(planned=False)
+        (packages, priorities, resumed), sync = self.planChannel()
+        self.assertFalse(resumed)
+        self.assertEqual(sync.itemsRead, 1)
+        self.assertEqual(self.getNames(packages), ["new0", "new1"])
+        journal = self.createJournal()
+        journal.load()
+        self.assertEqual(journal.getItems(), [])
+
+    def test_planOtherChannel(self):
+        """
+        Test the journal of another channel isn't resumed from
+        """
+        self.writeJournal(label="other")
+        (packages, priorities, resumed), sync = self.planChannel()
+        self.assertFalse(resumed)
+        self.assertEqual(self.getNames(packages), ["new0", "new1"])
+        journal = self.createJournal()
+        journal.load()
+        self.assertEqual(journal.label, "chan")
+
+    def test_planNotResuming(self):
+        """
+        Test the journal is ignored and started anew unless resuming or retrying
+        """
+        self.writeJournal()
+        (packages, priorities, resumed), sync = self.planChannel(resume=False)
+        self.assertFalse(resumed)
+        self.assertEqual(sync.itemsRead, 1)
+
+    def test_stoppedNotFinished(self):
+        """
+        Test a stopped sync doesn't update the repodata and leaves its journal
+        unfinished, for a resumed sync to finish the channel
+        """
+        sync = FinishSync([package("p0"), package("p1")], stopped=True)
+        sync.syncPackages("chan", self.savePath)
+        self.assertEqual(sync.finished, [])
+        journal = self.createJournal()
+        self.assertTrue(journal.load())
+        self.assertFalse(journal.isFinished())
+        sync = FinishSync([])
+        sync.setResume(True)
+        sync.syncPackages("chan", self.savePath)
+        self.assertEqual(sync.finished, [self.savePath])
+        journal = self.createJournal()
+        journal.load()
+        self.assertTrue(journal.isFinished())
+
+if __name__ == '__main__':
+    unittest.main()